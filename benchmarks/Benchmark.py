@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Throughput benchmarks for Assembler.py and VMtranslator.py.
+
+Times each phase of assembly and each command type of VM translation over
+the bundled programs and over generated scale-up inputs, and writes the
+results as JSON. The timings come from the tools' own Profiler, so the
+phases that time each command (encode and codegen) include that cost. Pass an earlier results file to --compare to flag
+regressions.
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, 'projects', '06'))
+sys.path.insert(0, os.path.join(ROOT, 'projects', '07'))
+import Assembler
+from Profiler import Profiler
+import VMtranslator
+
+ASM_PROGRAMS = ['add/Add.asm', 'max/Max.asm', 'max/MaxL.asm', 'rect/Rect.asm', 'rect/RectL.asm',
+                'pong/Pong.asm', 'pong/PongL.asm']
+VM_PROGRAMS = ['07/MemoryAccess/BasicTest', '07/MemoryAccess/PointerTest', '07/MemoryAccess/StaticTest',
+               '07/StackArithmetic/SimpleAdd', '07/StackArithmetic/StackTest',
+               '08/FunctionCalls/FibonacciElement', '08/FunctionCalls/NestedCall',
+               '08/FunctionCalls/SimpleFunction', '08/FunctionCalls/StaticsTest',
+               '08/ProgramFlow/BasicLoop', '08/ProgramFlow/FibonacciSeries']
+
+def best_of(repeat, func):
+    """Run `func` `repeat` times and keep the fastest set of phase timings."""
+    best = None
+    for _ in range(repeat):
+        timings = func()
+        if best is None or sum(timings.values()) < sum(best.values()):
+            best = timings
+    return best
+
+# assembler
+def time_assembler(infile, stream=False):
+    """Assemble `infile` through Assembler.main, returning the seconds of each phase its Profiler timed."""
+    profiler = Profiler()
+    Assembler.main(infile, stream=stream, profiler=profiler)
+    return {name: stats['seconds'] for name, stats in profiler.as_dict()['phases'].items()}
+
+def count_lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+def bench_asm(name, infile, workdir, repeat):
+    # the assembler writes next to its input, so it assembles a copy
+    copy = shutil.copy(infile, os.path.join(workdir, 'out.asm'))
+    phases = best_of(repeat, lambda: time_assembler(copy))
+    stream = best_of(repeat, lambda: time_assembler(copy, stream=True))
+    lines = count_lines(infile)
+    total = sum(phases.values())
+    return {
+        'tool': 'Assembler',
+        'name': name,
+        'lines': lines,
+        'phases': phases,
+        'total': total,
+        'lines_per_second': lines / total if total else None,
+        'stream_total': sum(stream.values())
+    }
+
+# vm translator
+def time_translator(path):
+    """Translate `path` through VMtranslator.main, returning its Profiler's phases and command timings."""
+    profiler = Profiler()
+    VMtranslator.main([path], profiler=profiler)
+    return profiler.as_dict()
+
+def bench_vm(name, path, workdir, repeat):
+    # the translator writes into the program's directory, so it translates a copy
+    copy = os.path.join(workdir, 'program')
+    shutil.rmtree(copy, ignore_errors=True)
+    shutil.copytree(path, copy)
+    best = None
+    for _ in range(repeat):
+        timings = time_translator(copy)
+        seconds = sum(stats['seconds'] for stats in timings['phases'].values())
+        if best is None or seconds < best_seconds:
+            best, best_seconds = timings, seconds
+    phases = {name: stats['seconds'] for name, stats in best['phases'].items()}
+    counts = {kind: stats['count'] for kind, stats in best['commands'].items()}
+    commands = sum(counts.values())
+    total = sum(phases.values())
+    return {
+        'tool': 'VMtranslator',
+        'name': name,
+        'commands': commands,
+        'phases': phases,
+        'codegen_by_type': {kind: stats['seconds'] for kind, stats in best['commands'].items()},
+        'counts': counts,
+        'total': total,
+        'commands_per_second': commands / total if total else None
+    }
+
+# synthetic inputs
+def generate_asm(path, n_lines, seed=0):
+    """Write an `n_lines` Hack assembly program with a realistic mix of commands."""
+    rng = random.Random(seed)
+    comps = ['D=M', 'M=D', 'D=A', 'AM=M-1', 'M=M+1', 'D=D+M', 'M=D|M', 'D;JGT', '0;JMP', 'A=M']
+    labels = []
+    with open(path, mode='w') as f:
+        for i in range(n_lines):
+            roll = rng.random()
+            if roll < 0.05:
+                label = f'LABEL_{i}'
+                labels.append(label)
+                f.write(f'({label})\n')
+            elif roll < 0.45:
+                if labels and rng.random() < 0.3:
+                    f.write(f'@{rng.choice(labels)}\n')
+                elif rng.random() < 0.5:
+                    f.write(f'@var{rng.randrange(1000)}\n')
+                else:
+                    f.write(f'@{rng.randrange(32768)}\n')
+            else:
+                f.write(f'{rng.choice(comps)} // comment\n')
+
+def generate_vm(directory, n_functions, n_files=10, seed=0):
+    """Write `n_functions` VM functions spread over `n_files` classes."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    names = [f'Class{i % n_files}.f{i}' for i in range(n_functions)]
+    files = defaultdict(list)
+    files[0].extend(['function Sys.init 0', f'call {names[0]} 0', 'label HALT', 'goto HALT'])
+    segments = ['local', 'argument', 'this', 'that', 'temp', 'static', 'pointer']
+    for i, name in enumerate(names):
+        lines = files[i % n_files]
+        lines.append(f'function {name} {rng.randrange(4)}')
+        for j in range(rng.randrange(10, 40)):
+            roll = rng.random()
+            if roll < 0.35:
+                segment = rng.choice(segments)
+                index = rng.randrange(2) if segment == 'pointer' else rng.randrange(8)
+                lines.append(f'push {segment} {index}')
+            elif roll < 0.45:
+                lines.append(f'push constant {rng.randrange(1000)}')
+            elif roll < 0.6:
+                segment = rng.choice(segments)
+                index = rng.randrange(2) if segment == 'pointer' else rng.randrange(8)
+                lines.append(f'pop {segment} {index}')
+            elif roll < 0.8:
+                lines.append(rng.choice(VMtranslator.VALID_ARITHMETIC))
+            elif roll < 0.85:
+                lines.append(f'label L{j}')
+                lines.append(f'if-goto L{j}')
+            elif roll < 0.9:
+                lines.append(f'goto END{j}')
+                lines.append(f'label END{j}')
+            else:
+                lines.append(f'call {rng.choice(names)} {rng.randrange(3)}')
+        lines.extend(['push constant 0', 'return'])
+    for n, lines in files.items():
+        with open(os.path.join(directory, f'Class{n}.vm'), mode='w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+# reporting
+def metadata():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+def compare(results, baseline, threshold):
+    """Print the change against `baseline` and return the benchmarks slower than `threshold`."""
+    old = {(r['tool'], r['name']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = old.get((result['tool'], result['name']))
+        if previous is None:
+            continue
+        for phase, seconds in result['phases'].items():
+            before = previous['phases'].get(phase)
+            if not before:
+                continue
+            ratio = seconds / before
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions.append((result['tool'], result['name'], phase, ratio))
+            print(f"{result['tool']:>12} {result['name']:<36} {phase:<8} {ratio:6.2f}x{flag}")
+    return regressions
+
+def main(repeat, quick, output, baseline=None, threshold=1.25):
+    asm_sizes = [10000, 100000] if quick else [100000, 1000000]
+    vm_sizes = [200, 1000] if quick else [1000, 5000]
+    results = []
+    workdir = tempfile.mkdtemp(prefix='n2t-bench-')
+    try:
+        for program in ASM_PROGRAMS:
+            path = os.path.join(ROOT, 'projects', '06', program)
+            results.append(bench_asm(program, path, workdir, repeat))
+        for n_lines in asm_sizes:
+            path = os.path.join(workdir, f'Synthetic{n_lines}.asm')
+            generate_asm(path, n_lines)
+            results.append(bench_asm(f'synthetic-{n_lines}-lines', path, workdir, repeat))
+        for program in VM_PROGRAMS:
+            path = os.path.join(ROOT, 'projects', program)
+            results.append(bench_vm(program, path, workdir, repeat))
+        results.append(bench_vm('tools/OS', os.path.join(ROOT, 'tools', 'OS'), workdir, repeat))
+        for n_functions in vm_sizes:
+            path = os.path.join(workdir, f'Synthetic{n_functions}')
+            generate_vm(path, n_functions)
+            results.append(bench_vm(f'synthetic-{n_functions}-functions', path, workdir, repeat))
+    finally:
+        shutil.rmtree(workdir)
+    report = {'meta': metadata(), 'results': results}
+    if output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, mode='w') as f:
+            json.dump(report, f, indent=2)
+        print(f'wrote {len(results)} results to {output}')
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('-o', '--output', default='bench_output.json', help='Results file, or - for stdout.')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=3, help='Keep the best of this many runs.')
+    arg_parser.add_argument('--quick', action='store_true', help='Use smaller synthetic inputs.')
+    arg_parser.add_argument('--compare', metavar='BASELINE', help='Earlier results file to compare against.')
+    arg_parser.add_argument('--threshold', type=float, default=1.25,
+                            help='Slowdown ratio reported as a regression by --compare.')
+    args = arg_parser.parse_args()
+    main(args.repeat, args.quick, args.output, baseline=args.compare, threshold=args.threshold)
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from Benchmark import ROOT, bench_asm, bench_vm, compare, generate_asm, generate_vm
+import Assembler
+import VMtranslator
+
+def test_bench_asm(tmp_path):
+    result = bench_asm('max/Max.asm', os.path.join(ROOT, 'projects', '06', 'max', 'Max.asm'), str(tmp_path), 1)
+    assert result['lines'] == 26
+    assert result['total'] == pytest.approx(sum(result['phases'].values()))
+    with open(tmp_path / 'out.hack') as f:
+        assert len(f.readlines()) == 16
+
+def test_bench_vm(tmp_path):
+    path = os.path.join(ROOT, 'projects', '08', 'FunctionCalls', 'FibonacciElement')
+    result = bench_vm('FibonacciElement', path, str(tmp_path), 1)
+    assert result['counts'] == {'C_PUSH': 8, 'C_ARITHMETIC': 4, 'C_IF': 1, 'C_GOTO': 2, 'C_RETURN': 2,
+                                'C_CALL': 3, 'C_FUNCTION': 2, 'C_LABEL': 3}
+    assert result['commands'] == 25
+
+def test_generated_asm_assembles(tmp_path):
+    path = str(tmp_path / 'Synthetic.asm')
+    generate_asm(path, 2000)
+    Assembler.main(path)
+    with open(path[:-len('.asm')] + '.hack', mode='rb') as f:
+        two_passes = f.read()
+    Assembler.main(path, stream=True)
+    with open(path[:-len('.asm')] + '.hack', mode='rb') as f:
+        assert f.read() == two_passes
+
+def test_generated_vm_translates(tmp_path):
+    generate_vm(str(tmp_path / 'Synthetic'), 50, n_files=5)
+    assert sorted(os.listdir(tmp_path / 'Synthetic')) == [f'Class{i}.vm' for i in range(5)]
+    VMtranslator.main([str(tmp_path / 'Synthetic')], optimize=True, compact=True)
+
+def test_compare(capsys):
+    baseline = {'results': [{'tool': 'Assembler', 'name': 'Max', 'phases': {'parse': 1.0, 'encode': 1.0}}]}
+    results = [{'tool': 'Assembler', 'name': 'Max', 'phases': {'parse': 1.1, 'encode': 1.5}},
+               {'tool': 'Assembler', 'name': 'new', 'phases': {'parse': 1.0}}]
+    assert compare(results, baseline, 1.25) == [('Assembler', 'Max', 'encode', 1.5)]
+    assert 'REGRESSION' in capsys.readouterr().out
@@ -0,0 +1,946 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+from glob import glob
+import logging
+import os
+import re
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+from Assembler import TRACE, load_rom, add_logging_args, set_log_level
+
+logger = logging.getLogger('HardwareSimulator')
+
+BUILTIN_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'tools', 'builtInChips'))
+# whitespace and comments first, then numbers, names and symbols
+HDL_TOKEN_PATTERN = re.compile(r'(\s+|//[^\n]*|/\*.*?\*/)|\d+|[A-Za-z_]\w*|\.\.|[{}()\[\],;:=]', re.DOTALL)
+# whitespace and comments first, then strings, separators and words
+SCRIPT_TOKEN_PATTERN = re.compile(r'(\s+|//[^\n]*|/\*.*?\*/)|"[^"]*"|[{},;]|[^\s{},;"]+', re.DOTALL)
+# `name`, `name[]`, `name[i]` or `name[i..j]`
+VARIABLE_PATTERN = re.compile(r'([A-Za-z_]\w*)(?:\[(\d*)(?:\.\.(\d+))?\])?$')
+# `name%Fpad.length.pad`
+COLUMN_PATTERN = re.compile(r'(.+)%([BDSX])(\d+)\.(\d+)\.(\d+)$')
+CONDITION_PATTERN = re.compile(r'(.+?)\s*(<>|<=|>=|=|<|>)\s*(.+)$')
+# a constant source in a net's pieces, with every bit set; `false` is no piece at all
+TRUE = 'true'
+# a `while` loop that runs this many times is taken to be stuck
+MAX_LOOP = 100000
+
+def mux(a, b, sel):
+    return a ^ ((a ^ b) & -sel)
+
+def mux4(a, b, c, d, sel):
+    low = sel & 1
+    return mux(mux(a, b, low), mux(c, d, low), sel >> 1)
+
+def mux8(a, b, c, d, e, f, g, h, sel):
+    return mux(mux4(a, b, c, d, sel & 3), mux4(e, f, g, h, sel & 3), sel >> 2)
+
+def demux(value, sel, n):
+    return tuple(value & (sel == k) for k in range(n))
+
+def half_adder(a, b):
+    return a ^ b, a & b
+
+def full_adder(a, b, c):
+    half = a ^ b
+    return half ^ c, (a & b) | (half & c)
+
+def alu(x, y, zx, nx, zy, ny, f, no):
+    x = (x & (zx - 1)) ^ (0xFFFF & -nx)
+    y = (y & (zy - 1)) ^ (0xFFFF & -ny)
+    out = mux(x & y, (x + y) & 0xFFFF, f) ^ (0xFFFF & -no)
+    return out, ((out - 1) >> 16) & 1, out >> 15
+
+def pc_next(out, in_, load, inc, reset):
+    return mux(mux(mux(out, (out + 1) & 0xFFFF, inc), in_, load), 0, reset)
+
+# The builtins below are written with bitwise operators only, so that the
+# same compiled code runs on ints or, one lane per test vector, on NumPy
+# arrays. Pins are named in the templates as in the builtInChips HDL, and
+# `mask` has every bit of the outputs set.
+
+# builtins computed from their inputs: their output pins, in order, and the template that computes them
+GATES = {
+    'Nand': (('out',), '1 ^ ({a} & {b})'),
+    'Not': (('out',), '{in} ^ {mask}'),
+    'Not16': (('out',), '{in} ^ {mask}'),
+    'And': (('out',), '{a} & {b}'),
+    'Or': (('out',), '{a} | {b}'),
+    'Xor': (('out',), '{a} ^ {b}'),
+    'Mux': (('out',), 'mux({a}, {b}, {sel})'),
+    'Mux4Way16': (('out',), 'mux4({a}, {b}, {c}, {d}, {sel})'),
+    'Mux8Way16': (('out',), 'mux8({a}, {b}, {c}, {d}, {e}, {f}, {g}, {h}, {sel})'),
+    'DMux': (('a', 'b'), 'demux({in}, {sel}, 2)'),
+    'DMux4Way': (('a', 'b', 'c', 'd'), 'demux({in}, {sel}, 4)'),
+    'DMux8Way': (('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'), 'demux({in}, {sel}, 8)'),
+    'Or8Way': (('out',), '({in} + 255) >> 8'),
+    'HalfAdder': (('sum', 'carry'), 'half_adder({a}, {b})'),
+    'FullAdder': (('sum', 'carry'), 'full_adder({a}, {b}, {c})'),
+    'Add16': (('out',), '({a} + {b}) & {mask}'),
+    'Inc16': (('out',), '({in} + 1) & {mask}'),
+    'ALU': (('out', 'zr', 'ng'), 'alu({x}, {y}, {zx}, {nx}, {zy}, {ny}, {f}, {no})'),
+}
+# builtins whose output is a word they hold: the template for the next word, where `out` is the current one
+REGISTERS = {
+    'DFF': '{in}',
+    'Bit': 'mux({out}, {in}, {load})',
+    'Register': 'mux({out}, {in}, {load})',
+    'ARegister': 'mux({out}, {in}, {load})',
+    'DRegister': 'mux({out}, {in}, {load})',
+    'PC': 'pc_next({out}, {in}, {load}, {inc}, {reset})',
+}
+# builtins that output a word of their memory, by the number of words they hold
+MEMORIES = {'RAM8': 8, 'RAM64': 64, 'RAM512': 512, 'RAM4K': 4096, 'RAM16K': 16384, 'Screen': 8192,
+            'ROM32K': 32768, 'Keyboard': 1}
+HELPERS = {'mux': mux, 'mux4': mux4, 'mux8': mux8, 'demux': demux, 'half_adder': half_adder,
+           'full_adder': full_adder, 'alu': alu, 'pc_next': pc_next}
+
+def tokenize(text, source, pattern):
+    """Split `text` into `(token, line)` pairs, leaving out whitespace and comments."""
+    tokens = []
+    line = 1
+    position = 0
+    while position < len(text):
+        match = pattern.match(text, position)
+        if match is None:
+            raise SyntaxError(f'{source}:{line}: unexpected character {text[position]!r}')
+        if match.group(1) is None:
+            tokens.append((match.group(), line))
+        line += match.group().count('\n')
+        position = match.end()
+    return tokens
+
+class Chip(object):
+    """The HDL of one chip: its pins, and either its parts or the builtin that implements it.
+
+    Pins map names to widths. Each part is `(chip name, connections, line)`
+    and each connection `(pin, pin bits, wire, wire bits)`, where bits are
+    `(low, high)`, or None for the whole bus.
+    """
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.inputs = {}
+        self.outputs = {}
+        self.parts = []
+        self.builtin = None
+        self.clocked = set()
+
+class HDLParser(object):
+    """Reads the text of one .hdl file into a Chip."""
+    def __init__(self, text, source):
+        self.source = source
+        self.tokens = tokenize(text, source, HDL_TOKEN_PATTERN)
+        self.position = 0
+
+    def error(self, message):
+        line = self.tokens[min(self.position, len(self.tokens) - 1)][1] if self.tokens else 1
+        return SyntaxError(f'{self.source}:{line}: {message}')
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def advance(self):
+        if self.position == len(self.tokens):
+            raise self.error('unexpected end of file')
+        self.position += 1
+        return self.tokens[self.position - 1][0]
+
+    def expect(self, value):
+        if self.peek() != value:
+            raise self.error(f'expected {value!r}, not {self.peek()!r}')
+        return self.advance()
+
+    def name(self):
+        value = self.peek()
+        if value is None or not (value[0].isalpha() or value[0] == '_'):
+            raise self.error(f'expected a name, not {value!r}')
+        return self.advance()
+
+    def number(self):
+        value = self.peek()
+        if value is None or not value.isdigit():
+            raise self.error(f'expected a number, not {value!r}')
+        return int(self.advance())
+
+    def chip(self):
+        self.expect('CHIP')
+        chip = Chip(self.name(), self.source)
+        self.expect('{')
+        for keyword, pins in (('IN', chip.inputs), ('OUT', chip.outputs)):
+            if self.peek() == keyword:
+                self.advance()
+                self.pins(chip, pins)
+        if self.peek() == 'BUILTIN':
+            self.advance()
+            chip.builtin = self.name()
+            self.expect(';')
+            if self.peek() == 'CLOCKED':
+                self.advance()
+                chip.clocked.update(self.names())
+        else:
+            self.expect('PARTS')
+            self.expect(':')
+            while self.peek() != '}':
+                chip.parts.append(self.part())
+        self.expect('}')
+        if self.peek() is not None:
+            raise self.error('expected the end of the file after the chip')
+        return chip
+
+    def names(self):
+        names = [self.name()]
+        while self.peek() == ',':
+            self.advance()
+            names.append(self.name())
+        self.expect(';')
+        return names
+
+    def pins(self, chip, pins):
+        while True:
+            name = self.name()
+            if name in chip.inputs or name in chip.outputs:
+                raise self.error(f'{name} is already a pin')
+            width = 1
+            if self.peek() == '[':
+                self.advance()
+                width = self.number()
+                self.expect(']')
+            pins[name] = width
+            if self.peek() != ',':
+                break
+            self.advance()
+        self.expect(';')
+
+    def part(self):
+        line = self.tokens[self.position][1]
+        name = self.name()
+        self.expect('(')
+        connections = [self.connection()]
+        while self.peek() == ',':
+            self.advance()
+            connections.append(self.connection())
+        self.expect(')')
+        self.expect(';')
+        return name, connections, line
+
+    def connection(self):
+        pin = self.name()
+        pin_bits = self.bits()
+        self.expect('=')
+        wire = self.name()
+        return pin, pin_bits, wire, self.bits()
+
+    def bits(self):
+        if self.peek() != '[':
+            return None
+        self.advance()
+        low = high = self.number()
+        if self.peek() == '..':
+            self.advance()
+            high = self.number()
+        self.expect(']')
+        if high < low:
+            raise self.error(f'bits {low}..{high} run backwards')
+        return low, high
+
+def read_chip(path):
+    # some of the project HDL has Windows-1252 punctuation in its comments
+    with open(path, errors='replace') as f:
+        return HDLParser(f.read(), path).chip()
+
+class Net(object):
+    """A bus of the flattened chip, driven by pieces of other nets, of slots and of `TRUE`.
+
+    Each piece `(source, source bit, width, bit)` drives `width` bits of the
+    net from `bit` with the bits of `source` from `source bit`. Bits that no
+    piece drives are 0.
+    """
+    def __init__(self, width=None, pieces=None):
+        self.width = width
+        self.pieces = pieces or []
+
+def resolve(net, low=0, width=None, offset=0, pieces=None):
+    """Return the pieces, of slots and `TRUE` only, that drive `width` bits of `net` from `low`.
+
+    The bits are put at `offset` on; touching pieces from the same slot are merged.
+    """
+    if width is None:
+        width = net.width
+    top = pieces is None
+    if top:
+        pieces = []
+    for source, source_bit, piece_width, bit in net.pieces:
+        first = max(low, bit)
+        last = min(low + width, bit + piece_width)
+        if first >= last:
+            continue
+        at = source_bit + first - bit
+        to = offset + first - low
+        if isinstance(source, Net):
+            resolve(source, at, last - first, to, pieces)
+        else:
+            pieces.append((source, at, last - first, to))
+    if not top:
+        return pieces
+    merged = []
+    for piece in sorted(pieces, key=lambda piece: piece[3]):
+        if merged:
+            source, at, piece_width, to = merged[-1]
+            if source == piece[0] and at + piece_width == piece[1] and to + piece_width == piece[3]:
+                merged[-1] = (source, at, piece_width + piece[2], to)
+                continue
+        merged.append(piece)
+    return merged
+
+class Part(object):
+    """One builtin part of a flattened chip.
+
+    `inputs` maps its IN pins to their nets and, once the chip is
+    flattened, to the pieces that drive them; `outputs` maps its OUT pins
+    to their slots.
+    """
+    def __init__(self, chip, path, inputs, outputs):
+        self.chip = chip
+        self.path = path
+        self.inputs = inputs
+        self.outputs = outputs
+
+class Variable(object):
+    """Something a test script can set or output: a pin or some of its bits, a builtin register or a memory word."""
+    def __init__(self, width, get, set=None, is_input=False):
+        self.width = width
+        self.get = get
+        self.set = set
+        self.is_input = is_input
+
+class Circuit(object):
+    """A chip flattened into its builtin parts and compiled to Python.
+
+    Chips are read from the .hdl files in the chip's own directory and
+    otherwise from `builtin_dir`, as the Java hardware simulator does.
+    Every output of a builtin part gets a slot in `values`, the one list of
+    values the compiled code works on, and so does every IN pin of the chip
+    itself. The combinational parts are sorted so that one pass of
+    `evaluate`, one line per part, computes them all; a register's slot
+    holds the word it keeps, and only `tick` and `tock` change it. As the
+    compiled code uses bitwise operators only, `evaluate_batch` runs it once
+    over NumPy arrays that hold any number of test vectors.
+    """
+    def __init__(self, path, builtin_dir=BUILTIN_DIR):
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.builtin_dir = builtin_dir
+        self.chips = {}
+        self.widths = []
+        self.parts = []
+        self.chip = self.load(os.path.splitext(os.path.basename(path))[0])
+        self.inputs = {}
+        nets = {}
+        for pin, width in self.chip.inputs.items():
+            self.inputs[pin] = self.new_slot(width)
+            nets[pin] = Net(width, [(self.inputs[pin], 0, width, 0)])
+        outputs = self.flatten(self.chip, nets, self.chip.name, ())
+        self.outputs = {pin: resolve(net) for pin, net in outputs.items()}
+        for part in self.parts:
+            part.inputs = {pin: resolve(net) for pin, net in part.inputs.items()}
+        self.compile()
+        self.values = [0] * len(self.widths)
+        self.memories = [array('H', bytes(2 * MEMORIES[part.chip.builtin])) if part.chip.builtin in MEMORIES
+                         else None for part in self.parts]
+        self.pending = [0 if part.chip.builtin in REGISTERS else None for part in self.parts]
+        self.variables = {}
+
+    def load(self, name):
+        chip = self.chips.get(name)
+        if chip is None:
+            path = os.path.join(self.directory, name + '.hdl')
+            if not os.path.exists(path):
+                path = os.path.join(self.builtin_dir, name + '.hdl')
+            chip = self.chips[name] = read_chip(path)
+            if chip.name != name:
+                raise SyntaxError(f'{path}: defines {chip.name}, not {name}')
+        return chip
+
+    def new_slot(self, width):
+        self.widths.append(width)
+        return len(self.widths) - 1
+
+    def flatten(self, chip, inputs, path, within):
+        """Add the builtin parts that make up `chip` to `parts`.
+
+        `inputs` maps the chip's IN pins to their nets. Returns a map from
+        its OUT pins to theirs.
+        """
+        if chip.builtin is not None:
+            if chip.builtin not in GATES and chip.builtin not in REGISTERS and chip.builtin not in MEMORIES:
+                raise SyntaxError(f'{chip.source}: no builtin {chip.builtin}')
+            outputs = {pin: self.new_slot(width) for pin, width in chip.outputs.items()}
+            self.parts.append(Part(chip, path, inputs, outputs))
+            return {pin: Net(chip.outputs[pin], [(slot, 0, chip.outputs[pin], 0)]) for pin, slot in outputs.items()}
+        if chip.name in within:
+            raise SyntaxError(f'{chip.source}: {chip.name} is made of itself')
+        nets = dict(inputs)
+        nets.update((pin, Net(width)) for pin, width in chip.outputs.items())
+        # reads of internal pins, checked once all the parts have driven theirs
+        reads = []
+        for name, connections, line in chip.parts:
+            where = f'{chip.source}:{line}'
+            try:
+                part = self.load(name)
+            except FileNotFoundError:
+                raise SyntaxError(f'{where}: no {name}.hdl next to the chip or in {self.builtin_dir}') from None
+            part_inputs = {pin: Net(width) for pin, width in part.inputs.items()}
+            part_outputs = self.flatten(part, part_inputs, f'{path}.{name}', within + (chip.name,))
+            for pin, pin_bits, wire, wire_bits in connections:
+                if pin in part.inputs:
+                    low, width = bits_of(pin_bits, part.inputs[pin], f'{where}: {name}.{pin}')
+                    if wire in ('true', 'false'):
+                        if wire_bits is not None:
+                            raise SyntaxError(f'{where}: {wire} has no bits to pick')
+                        if wire == 'true':
+                            part_inputs[pin].pieces.append((TRUE, 0, width, low))
+                        continue
+                    if wire in chip.outputs:
+                        raise SyntaxError(f'{where}: the output pin {wire} can\'t be read')
+                    net = nets.get(wire)
+                    if net is None:
+                        net = nets[wire] = Net()
+                    reads.append((net, wire, wire_bits, width, line))
+                    part_inputs[pin].pieces.append((net, wire_bits[0] if wire_bits else 0, width, low))
+                elif pin in part.outputs:
+                    low, width = bits_of(pin_bits, part.outputs[pin], f'{where}: {name}.{pin}')
+                    if wire in ('true', 'false') or wire in chip.inputs:
+                        raise SyntaxError(f'{where}: {wire} can\'t be driven by {name}')
+                    if wire in chip.outputs:
+                        net = nets[wire]
+                        bit, wire_width = bits_of(wire_bits, net.width, f'{where}: {wire}')
+                        if wire_width != width:
+                            raise SyntaxError(f'{where}: {wire} takes {wire_width} bits, not {width}')
+                    else:
+                        if wire_bits is not None:
+                            raise SyntaxError(f'{where}: the internal pin {wire} can\'t have bits picked')
+                        net = nets.get(wire)
+                        if net is None:
+                            net = nets[wire] = Net()
+                        elif net.width is not None:
+                            raise SyntaxError(f'{where}: {wire} is driven twice')
+                        net.width = width
+                        bit = 0
+                    net.pieces.append((part_outputs[pin], low, width, bit))
+                else:
+                    raise SyntaxError(f'{where}: {name} has no pin {pin}')
+        for net, wire, wire_bits, width, line in reads:
+            where = f'{chip.source}:{line}'
+            if net.width is None:
+                raise SyntaxError(f'{where}: nothing drives {wire}')
+            if wire_bits is None and net.width != width:
+                raise SyntaxError(f'{where}: {wire} has {net.width} bits, not {width}')
+            bits_of(wire_bits, net.width, f'{where}: {wire}')
+        return {pin: nets[pin] for pin in chip.outputs}
+
+    def expression(self, pieces):
+        """Python code for the value the `pieces` of slots drive."""
+        terms = []
+        for source, bit, width, to in pieces:
+            if source == TRUE:
+                terms.append(str(((1 << width) - 1) << to))
+                continue
+            term = f'w[{source}]'
+            if bit:
+                term = f'({term} >> {bit})'
+            if bit + width < self.widths[source]:
+                term = f'({term} & {(1 << width) - 1})'
+            if to:
+                term = f'({term} << {to})'
+            terms.append(term)
+        if not terms:
+            return '0'
+        return terms[0] if len(terms) == 1 else '(' + ' | '.join(terms) + ')'
+
+    def sort(self):
+        """Order the parts other than registers so each comes after the parts it reads.
+
+        Only inputs the builtin HDL doesn't declare CLOCKED count as reads.
+        """
+        producers = {}
+        for index, part in enumerate(self.parts):
+            if part.chip.builtin not in REGISTERS:
+                for slot in part.outputs.values():
+                    producers[slot] = index
+        readers = {index: [] for index in producers.values()}
+        waiting = {}
+        for index, part in enumerate(self.parts):
+            if part.chip.builtin in REGISTERS:
+                continue
+            reads = {producers[piece[0]] for pin, pieces in part.inputs.items() if pin not in part.chip.clocked
+                     for piece in pieces if piece[0] in producers}
+            waiting[index] = len(reads)
+            for read in reads:
+                readers[read].append(index)
+        order = [index for index, count in waiting.items() if not count]
+        for index in order:
+            for reader in readers.get(index, ()):
+                waiting[reader] -= 1
+                if not waiting[reader]:
+                    order.append(reader)
+        if len(order) < len(waiting):
+            looped = [self.parts[index].path for index, count in waiting.items() if count]
+            raise SyntaxError(f'{self.chip.source}: the parts are connected in a loop, through '
+                              + ', '.join(looped[:4]) + (', ...' if len(looped) > 4 else ''))
+        return order
+
+    def compile(self):
+        """Compile `evaluate`, `tick` and `tock` for the flattened parts."""
+        evaluate = ['def evaluate(w, m):']
+        tick = ['def tick(w, m, p):']
+        tock = ['def tock(w, m, p):']
+        for index in self.sort():
+            part = self.parts[index]
+            builtin = part.chip.builtin
+            args = {pin: self.expression(pieces) for pin, pieces in part.inputs.items()}
+            if builtin in GATES:
+                pins, template = GATES[builtin]
+                args['mask'] = (1 << part.chip.outputs[pins[0]]) - 1
+                targets = ', '.join(f'w[{part.outputs[pin]}]' for pin in pins)
+                evaluate.append(f'    {targets} = {template.format(**args)}')
+            else:
+                address = args.get('address', '0')
+                evaluate.append(f'    w[{part.outputs["out"]}] = m[{index}][{address}]')
+        for index, part in enumerate(self.parts):
+            builtin = part.chip.builtin
+            args = {pin: self.expression(pieces) for pin, pieces in part.inputs.items()}
+            if builtin in REGISTERS:
+                args['out'] = f'w[{part.outputs["out"]}]'
+                tick.append(f'    p[{index}] = {REGISTERS[builtin].format(**args)}')
+                tock.append(f'    w[{part.outputs["out"]}] = p[{index}]')
+            elif builtin in MEMORIES and 'load' in part.inputs:
+                tick.append(f'    p[{index}] = ({args["address"]}, {args["in"]}) if {args["load"]} else None')
+                tock.append(f'    if p[{index}] is not None:')
+                tock.append(f'        m[{index}][p[{index}][0]] = p[{index}][1]')
+        self.combinational = len(tick) == 1 and not any(part.chip.builtin in MEMORIES for part in self.parts)
+        namespace = dict(HELPERS)
+        for lines in (evaluate, tick, tock):
+            if len(lines) == 1:
+                lines.append('    pass')
+            source = '\n'.join(lines) + '\n'
+            logger.log(TRACE, '%s', source)
+            exec(source, namespace)
+        self._evaluate, self._tick, self._tock = namespace['evaluate'], namespace['tick'], namespace['tock']
+        logger.debug('%s: %d builtin parts, %d slots', self.chip.name, len(self.parts), len(self.widths))
+
+    def eval(self):
+        self._evaluate(self.values, self.memories)
+
+    def tick(self):
+        """The first half of a clock cycle: the clocked parts take in their inputs."""
+        self._evaluate(self.values, self.memories)
+        self._tick(self.values, self.memories, self.pending)
+
+    def tock(self):
+        """The second half of a clock cycle: the clocked parts change their outputs."""
+        self._tock(self.values, self.memories, self.pending)
+        self._evaluate(self.values, self.memories)
+
+    def evaluate_batch(self, vectors):
+        """Evaluate a combinational chip on each of `vectors`, values for its IN pins in order, at once.
+
+        Returns a list like `values` with an array of one value per vector in each slot.
+        """
+        values = [0] * len(self.widths)
+        for slot, column in zip(self.inputs.values(), zip(*vectors)):
+            values[slot] = np.array(column, dtype=np.int64)
+        self._evaluate(values, self.memories)
+        return values
+
+    def find_part(self, name):
+        for index, part in enumerate(self.parts):
+            if part.chip.name == name:
+                return index, part
+        raise KeyError(name)
+
+    def variable(self, name):
+        """Look up `name` as a test script names a Variable."""
+        variable = self.variables.get(name)
+        if variable is not None:
+            return variable
+        match = VARIABLE_PATTERN.match(name)
+        if match is None:
+            raise ValueError(f'no variable {name}')
+        pin, first, last = match.groups()
+        if pin in self.inputs or pin in self.outputs:
+            width = self.chip.inputs.get(pin) or self.chip.outputs[pin]
+            low, width = bits_of(None if first in (None, '') else (int(first), int(last or first)), width, name)
+            mask = (1 << width) - 1
+            if pin in self.inputs:
+                slot = self.inputs[pin]
+
+                def set(w, value):
+                    w[slot] = (w[slot] & ~(mask << low)) | ((value & mask) << low)
+                variable = Variable(width, lambda w: (w[slot] >> low) & mask, set, is_input=True)
+            else:
+                get = eval(f'lambda w: ({self.expression(self.outputs[pin])} >> {low}) & {mask}')
+                variable = Variable(width, get)
+        else:
+            try:
+                index, part = self.find_part(pin)
+            except KeyError:
+                raise ValueError(f'{self.chip.name} has no pin or builtin part {pin}') from None
+            if part.chip.builtin in REGISTERS and first in ('', '0') and last is None:
+                # the word the register holds, which it takes in on a tick and outputs from the tock
+                slot = part.outputs['out']
+                width = self.widths[slot]
+                pending = self.pending
+
+                def set(w, value):
+                    w[slot] = pending[index] = value & ((1 << width) - 1)
+                variable = Variable(width, lambda w: pending[index], set)
+            elif part.chip.builtin in MEMORIES and last is None:
+                memory = self.memories[index]
+                address = int(first or 0)
+                if address >= len(memory):
+                    raise ValueError(f'{pin} has no word {address}')
+
+                def set(w, value):
+                    memory[address] = value & 0xFFFF
+                variable = Variable(16, lambda w: memory[address], set)
+            else:
+                raise ValueError(f'no variable {name}')
+        self.variables[name] = variable
+        return variable
+
+    def load_rom(self, path):
+        index, _ = self.find_part('ROM32K')
+        words = load_rom(path)
+        memory = self.memories[index]
+        memory[:] = array('H', bytes(2 * len(memory)))
+        memory[:len(words)] = words
+
+def bits_of(bits, width, name):
+    """Return the low bit and width of `bits`, `(low, high)` or None for all, of a `width` bit bus."""
+    if bits is None:
+        return 0, width
+    low, high = bits
+    if high >= width:
+        raise SyntaxError(f'{name} has no bit {high}')
+    return low, high - low + 1
+
+def parse_script(tokens, source):
+    """Group the tokens of a test script into commands, `(words, line, body)`.
+
+    `repeat` and `while` have the commands in their braces as `body`; the
+    other commands have None.
+    """
+    blocks = [[]]
+    words = []
+    line = 1
+    for token, token_line in tokens:
+        if token in (',', ';', '{', '}'):
+            if token == '{':
+                if not words or words[0] not in ('repeat', 'while'):
+                    raise SyntaxError(f'{source}:{token_line}: a block must follow repeat or while')
+                blocks[-1].append((words, line, []))
+                blocks.append(blocks[-1][-1][2])
+            elif words:
+                blocks[-1].append((words, line, None))
+            if token == '}':
+                if len(blocks) == 1:
+                    raise SyntaxError(f'{source}:{token_line}: unmatched }}')
+                blocks.pop()
+            words = []
+            continue
+        if not words:
+            line = token_line
+        words.append(token)
+    if words:
+        blocks[-1].append((words, line, None))
+    if len(blocks) > 1:
+        raise SyntaxError(f'{source}: a block is missing its }}')
+    return blocks[0]
+
+def parse_value(text):
+    """Read a script value: decimal, or %B binary, %X hex or %D decimal."""
+    if text.startswith('%'):
+        return int(text[2:], {'B': 2, 'X': 16, 'D': 10}[text[1]])
+    return int(text)
+
+def format_cell(text, pad_left, length, pad_right):
+    return ' ' * pad_left + text + ' ' * pad_right
+
+def format_value(value, kind, width, length):
+    if kind == 'S':
+        return str(value).ljust(length)
+    if kind == 'B':
+        return format(value & ((1 << length) - 1), f'0{length}b')
+    if kind == 'X':
+        return format(value & ((1 << 4 * length) - 1), f'0{length}X')
+    if width == 16 and value & 0x8000:
+        value -= 0x10000
+    return str(value).rjust(length)
+
+def matches(line, expected):
+    """Whether an output line matches a line of a .cmp file, where `*` matches any character."""
+    return len(line) == len(expected) and all(e == '*' or e == c for c, e in zip(line, expected))
+
+class TestScript(object):
+    """Runs a .tst script on the chip it loads and compares the output with its .cmp file.
+
+    Scripts for combinational chips are run batched: every `eval` adds a
+    test vector, and once the script has run they are all evaluated in one
+    pass over NumPy arrays and the output lines filled in. Scripts for
+    chips with clocked parts, or with `while` loops, are run a step at a
+    time. `keys` are the key codes someone following the script's prompts
+    would press, one held from the start of each `while` loop.
+    """
+    def __init__(self, path, keys=(), batch=True):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        with open(path, errors='replace') as f:
+            self.commands = parse_script(tokenize(f.read(), path, SCRIPT_TOKEN_PATTERN), path)
+        self.keys = list(keys)
+        self.batch = batch and np is not None and not uses_while(self.commands)
+        self.circuit = None
+        self.output_file = None
+        self.compare_file = None
+        self.columns = []
+        self.lines = []
+        self.time = 0
+        self.ticked = False
+        self.vectors = []
+        self.cycles = 0
+
+    def run(self):
+        """Run the script and write its output file. Returns `(line number, expected, actual)` per mismatch."""
+        self.execute(self.commands)
+        if self.batch and self.circuit is not None:
+            self.fill_in()
+        if self.output_file is not None:
+            with open(self.output_file, mode='w') as f:
+                f.writelines(line + '\n' for line in self.lines)
+        if self.compare_file is None:
+            return []
+        with open(self.compare_file) as f:
+            expected = [line.rstrip('\r\n') for line in f]
+        mismatches = []
+        for number in range(max(len(self.lines), len(expected))):
+            line = self.lines[number] if number < len(self.lines) else ''
+            want = expected[number] if number < len(expected) else ''
+            if not matches(line, want):
+                mismatches.append((number + 1, want, line))
+        return mismatches
+
+    def execute(self, commands):
+        for words, line, body in commands:
+            try:
+                self.command(words, body)
+            except (ValueError, KeyError, IndexError) as e:
+                raise SyntaxError(f'{self.path}:{line}: {e}') from None
+
+    def command(self, words, body):
+        op = words[0]
+        if op == 'load':
+            self.load(words[1])
+        elif op in ('echo', 'clear-echo', 'breakpoint', 'clear-breakpoints'):
+            logger.debug('%s', ' '.join(words))
+        elif op == 'output-file':
+            self.output_file = os.path.join(self.directory, words[1])
+        elif op == 'compare-to':
+            self.compare_file = os.path.join(self.directory, words[1])
+        elif op == 'output-list':
+            self.columns = [self.column(word) for word in words[1:]]
+            self.lines.append('|' + '|'.join(self.header(column) for column in self.columns) + '|')
+        elif self.circuit is None:
+            raise ValueError(f'{op} before any chip is loaded')
+        elif op == 'set':
+            self.circuit.variable(words[1]).set(self.circuit.values, parse_value(words[2]))
+        elif op == 'eval':
+            self.eval()
+        elif op == 'output':
+            self.output()
+        elif op in ('tick', 'tock', 'ticktock'):
+            if op != 'tock':
+                self.tick()
+            if op != 'tick':
+                self.tock()
+        elif op == 'repeat':
+            if len(words) != 2:
+                raise ValueError('repeat needs a count')
+            for _ in range(int(words[1])):
+                self.execute(body)
+        elif op == 'while':
+            self.loop(' '.join(words[1:]), body)
+        elif len(words) == 3 and words[1] == 'load':
+            if words[0] != 'ROM32K':
+                raise ValueError(f'{words[0]} can\'t load a file')
+            self.circuit.load_rom(os.path.join(self.directory, words[2]))
+        else:
+            raise ValueError(f'unknown command {op}')
+
+    def load(self, name):
+        if not name.endswith('.hdl'):
+            raise ValueError(f'{name} is not a chip; only .hdl files can be loaded')
+        self.circuit = Circuit(os.path.join(self.directory, name))
+        self.batch = self.batch and self.circuit.combinational
+
+    def column(self, word):
+        match = COLUMN_PATTERN.match(word)
+        if match is None:
+            raise ValueError(f'{word} is not of the form name%Fpad.length.pad')
+        name, kind, pad_left, length, pad_right = match.groups()
+        variable = None if name == 'time' else self.circuit.variable(name)
+        return name, variable, kind, int(pad_left), int(length), int(pad_right)
+
+    def header(self, column):
+        name, _, _, pad_left, length, pad_right = column
+        width = pad_left + length + pad_right
+        name = name[:width]
+        left = (width - len(name)) // 2
+        return ' ' * left + name + ' ' * (width - len(name) - left)
+
+    def time_text(self):
+        return f'{self.time}+' if self.ticked else str(self.time)
+
+    def eval(self):
+        if self.batch:
+            self.vectors.append(tuple(self.circuit.values[slot] for slot in self.circuit.inputs.values()))
+        else:
+            self.circuit.eval()
+
+    def tick(self):
+        if self.batch:
+            self.eval()
+        else:
+            self.circuit.tick()
+        self.ticked = True
+
+    def tock(self):
+        if self.batch:
+            self.eval()
+        else:
+            self.circuit.tock()
+        self.ticked = False
+        self.time += 1
+        self.cycles += 1
+
+    def output(self):
+        if self.batch:
+            # filled in by fill_in once every vector is known
+            inputs = {slot: self.circuit.values[slot] for slot in self.circuit.inputs.values()}
+            self.lines.append((self.time_text(), inputs, len(self.vectors) - 1))
+            return
+        self.lines.append(self.format_line(self.time_text(), lambda variable: variable.get(self.circuit.values)))
+
+    def format_line(self, time_text, get):
+        cells = []
+        for name, variable, kind, pad_left, length, pad_right in self.columns:
+            if variable is None:
+                text = format_value(time_text, kind, 0, length)
+            else:
+                text = format_value(get(variable), kind, variable.width, length)
+            cells.append(format_cell(text, pad_left, length, pad_right))
+        return '|' + '|'.join(cells) + '|'
+
+    def fill_in(self):
+        """Evaluate the test vectors of a batched run and format the output lines that show them."""
+        start = time.perf_counter()
+        values = self.circuit.evaluate_batch(self.vectors) if self.vectors else None
+        lanes = {}
+        for _, variable, _, _, _, _ in self.columns:
+            if variable is not None and not variable.is_input and values is not None:
+                lanes[variable] = np.broadcast_to(variable.get(values), (len(self.vectors),)).tolist()
+        for number, line in enumerate(self.lines):
+            if isinstance(line, str):
+                continue
+            time_text, inputs, lane = line
+
+            def get(variable):
+                if variable.is_input:
+                    return variable.get(inputs)
+                return lanes[variable][lane] if lane >= 0 else 0
+            self.lines[number] = self.format_line(time_text, get)
+        logger.debug('evaluated %d test vectors in %.3fs', len(self.vectors), time.perf_counter() - start)
+
+    def loop(self, condition, body):
+        match = CONDITION_PATTERN.match(condition)
+        if match is None:
+            raise ValueError(f'{condition} is not a condition')
+        name, op, value = match.groups()
+        variable = self.circuit.variable(name)
+        value = parse_value(value)
+        if self.keys:
+            try:
+                self.circuit.variable('Keyboard[]').set(self.circuit.values, self.keys.pop(0))
+            except ValueError:
+                pass
+        for _ in range(MAX_LOOP):
+            actual = variable.get(self.circuit.values)
+            if variable.width == 16 and actual & 0x8000:
+                actual -= 0x10000
+            if not {'=': actual == value, '<>': actual != value, '<': actual < value, '>': actual > value,
+                    '<=': actual <= value, '>=': actual >= value}[op]:
+                return
+            self.execute(body)
+        raise ValueError(f'while {condition} is still going after {MAX_LOOP} times; '
+                         'if it waits for a key, give it with --keys')
+
+def uses_while(commands):
+    return any(words[0] == 'while' or (body and uses_while(body)) for words, _, body in commands)
+
+def script_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob(os.path.join(path, '*.tst')))
+        else:
+            yield path
+
+def main(paths, keys=(), batch=True):
+    """Run the test scripts in `paths`, .tst files or directories of them. Returns the number that failed."""
+    failures = 0
+    for path in script_paths(paths):
+        start = time.perf_counter()
+        try:
+            script = TestScript(path, keys, batch)
+            mismatches = script.run()
+        except (SyntaxError, OSError) as e:
+            logger.error('%s: %s', path, e)
+            failures += 1
+            continue
+        elapsed = time.perf_counter() - start
+        if script.batch:
+            how = f'{len(script.vectors)} test vectors batched'
+        else:
+            how = f'{script.cycles} clock cycles'
+        for number, expected, actual in mismatches[:10]:
+            logger.warning('%s:%d: expected %s', script.compare_file, number, expected)
+            logger.warning('%s:%d:      got %s', script.compare_file, number, actual)
+        if script.compare_file is None:
+            logger.info('%s: ran, %d lines with nothing to compare them to (%s, %.3fs)', path, len(script.lines), how,
+                        elapsed)
+        elif mismatches:
+            failures += 1
+            logger.warning('%s: %d of %d lines differ (%s, %.3fs)', path, len(mismatches), len(script.lines), how,
+                           elapsed)
+        else:
+            logger.info('%s: passed, %d lines (%s, %.3fs)', path, len(script.lines), how, elapsed)
+    return failures
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Run hardware simulator test scripts on chips flattened from their HDL and compiled to Python.')
+    arg_parser.add_argument('scripts', nargs='+', help='.tst script(s), or directories of them, to run.')
+    arg_parser.add_argument('--keys', type=int, nargs='+', default=[], metavar='CODE',
+                            help='Key codes to hold down on the Keyboard, the next one each time a while loop starts.')
+    arg_parser.add_argument('--no-batch', action='store_true',
+                            help='Evaluate combinational chips one test vector at a time rather than batched.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    failures = main(args.scripts, keys=args.keys, batch=not args.no_batch)
+    sys.exit(1 if failures else 0)
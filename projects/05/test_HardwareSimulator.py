@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import HardwareSimulator
+from HardwareSimulator import main
+
+@pytest.mark.parametrize('batch', [True, False])
+@pytest.mark.parametrize('name', ['01', '02', '03/a', '03/b'])
+def test_chips_pass(project, name, batch):
+    assert main([project(name)], batch=batch) == 0
+
+def test_computer_passes(project):
+    directory = project('05')
+    scripts = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+               if name.endswith('.tst') and name != 'Memory.tst']
+    assert main(scripts) == 0
+    # Memory.tst waits for K and then Y to be held down
+    assert main([os.path.join(directory, 'Memory.tst')], keys=[75, 89]) == 0
+
+def test_batched_output_matches_stepped(project):
+    directory = project('02')
+    outputs = []
+    for batch in (True, False):
+        script = HardwareSimulator.TestScript(os.path.join(directory, 'ALU.tst'), batch=batch)
+        assert script.batch == batch
+        assert script.run() == []
+        with open(os.path.join(directory, 'ALU.out')) as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+
+@pytest.mark.parametrize('name, chip, part, mutation, mismatch', [
+    # 1 + 1 sums to 0, which Or gets wrong
+    ('02', 'HalfAdder', 'Xor(a=a, b=b, out=sum);', 'Or(a=a, b=b, out=sum);',
+     (5, '|   1   |   1   |   0   |   1   |', '|   1   |   1   |   1   |   1   |')),
+    # with the Mux inputs swapped, the bit loads when `load` is 0
+    ('03/a', 'Bit', 'Mux(a=loop1, b=in, sel=load, out=muxout);', 'Mux(a=in, b=loop1, sel=load, out=muxout);',
+     (7, '| 3    |  1  |  0  |  0  |', '| 3    |  1  |  0  |  1  |')),
+])
+@pytest.mark.parametrize('batch', [True, False])
+def test_mutated_chips_fail(project, caplog, name, chip, part, mutation, mismatch, batch):
+    directory = project(name)
+    path = os.path.join(directory, chip + '.hdl')
+    with open(path) as f:
+        hdl = f.read()
+    assert part in hdl
+    with open(path, mode='w') as f:
+        f.write(hdl.replace(part, mutation))
+    script = os.path.join(directory, chip + '.tst')
+    assert HardwareSimulator.TestScript(script, batch=batch).run()[0] == mismatch
+    assert main([script], batch=batch) == 1
+    assert 'lines differ' in caplog.messages[-1]
+
+def test_script_errors_are_reported(project, caplog):
+    directory = project('02')
+    with open(os.path.join(directory, 'Broken.tst'), mode='w') as f:
+        f.write('load HalfAdder.hdl,\nset c 1;\n')
+    assert main([os.path.join(directory, 'Broken.tst')]) == 1
+    assert caplog.messages[-1].endswith('Broken.tst:2: HalfAdder has no pin or builtin part c')
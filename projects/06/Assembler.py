@@ -1,5 +1,22 @@
 #!/usr/bin/env python3
+from array import array
 import argparse
+import io
+from itertools import permutations
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from BuildCache import add_cache_args, cache_from_args, source_digest
+from Profiler import add_profile_args, phase, profiler_from_args, report_profile
+from SourceMap import SourceMap, get_source_map_name
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+logger = logging.getLogger('Assembler')
 
 class Parser(object):
     def __init__(self, infile):
@@ -7,16 +24,11 @@ class Parser(object):
             self.lines = f.readlines()
         self._process_commands()
         self.reset()
-        self.valid_dests = ['M', 'D', 'MD', 'A', 'AM', 'AD', 'ADM']
-        self.valid_comps = ['0', '1', '-1', 'D', 'A', '!D', '!A', '-D', '-A', 'D+1', 'A+1', 'D-1',
-                            'A-1', 'D+A', 'D-A', 'A-D', 'D&A', 'D|A', 'M', '!M', '-M', 'M+1',
-                            'M-1', 'D+M', 'D-M', 'M-D', 'D&M', 'D|M']
-        self.valid_jump_comps = ['0', 'D']
 
     def advance(self):
         self.current_command = self.commands[self.command_counter]
         self.command_counter += 1
-        if self.command_type() is not 'L_COMMAND':
+        if self.command_type() != 'L_COMMAND':
             self.line_number += 1
 
     def command_type(self):
@@ -28,35 +40,22 @@ class Parser(object):
             return 'C_COMMAND'
 
     def comp(self):
-        assert self.command_type() is 'C_COMMAND', 'comp() only valid with C_COMMAND'
-        cmd = self.current_command
-        if '=' not in cmd:
-            comp = cmd.split(';')[0]
-            assert comp in self.valid_jump_comps, 'For jmp commands, comparison must be D or 0'
-            return comp
-        else:
-            comp = cmd.split('=')[1]
-            assert comp in self.valid_comps, f'Invalid computation {comp}. Must be in {self.valid_comps}.'
-            return comp
+        assert self.command_type() == 'C_COMMAND', 'comp() only valid with C_COMMAND'
+        comp = split_c_command(self.current_command)[1]
+        assert comp in COMP_CODES, f'Invalid computation {comp}. Must be in {list(COMP_CODES)}.'
+        return comp
 
     def dest(self):
-        assert self.command_type() is 'C_COMMAND', 'dest() only valid with C_COMMAND'
-        cmd = self.current_command
-        if '=' not in cmd:
-            return None
-        else:
-            dest = cmd.split('=')[0]
-            assert dest in self.valid_dests, f'Invalid destination {dest}. Must be in {self.valid_dests}.'
-            return dest
+        assert self.command_type() == 'C_COMMAND', 'dest() only valid with C_COMMAND'
+        dest = split_c_command(self.current_command)[0]
+        assert dest in DEST_CODES, f'Invalid destination {dest}. Must be in {list(DEST_CODES)[1:]}.'
+        return dest
 
     def jump(self):
-        assert self.command_type() is 'C_COMMAND', 'jump() only valid with C_COMMAND'
-        cmd = self.current_command
-        if '='in cmd:
-            return None
-        else:
-            jmp = cmd.split(';')[1]
-            return jmp
+        assert self.command_type() == 'C_COMMAND', 'jump() only valid with C_COMMAND'
+        jmp = split_c_command(self.current_command)[2]
+        assert jmp in JUMP_CODES, f'Invalid jump {jmp}. Must be in {list(JUMP_CODES)[1:]}.'
+        return jmp
 
     def has_more_commands(self):
         if self.command_counter >= self.n_commands:
@@ -65,15 +64,8 @@ class Parser(object):
             return True
 
     def _process_commands(self):
-        commands = []
-        for line in self.lines:
-            line = line.strip()
-            if ' ' in line:
-                index = line.find(' ')
-                line = line[:index]
-            if not (line.startswith('//') or line == ''):
-                commands.append(line)
-        self.commands = commands
+        # most commands repeat, so share one string for each distinct command
+        self.commands = [sys.intern(cmd) for cmd in clean_lines(self.lines)]
         self.n_commands = len(self.commands)
 
     def reset(self):
@@ -82,150 +74,730 @@ class Parser(object):
         self.line_number = 0
 
     def symbol(self):
-        assert self.command_type() is not 'C_COMMAND', f'Command {self.current_command} is a C_COMMAND. Cannot call `symbol()`'
+        assert self.command_type() != 'C_COMMAND', f'Command {self.current_command} is a C_COMMAND. Cannot call `symbol()`'
         return self.current_command.strip('@()')
 
+def clean_lines(lines):
+    """Yield the commands in `lines` with whitespace and comments stripped."""
+    for line in lines:
+        line = line.strip()
+        if ' ' in line:
+            index = line.find(' ')
+            line = line[:index]
+        if not (line.startswith('//') or line == ''):
+            yield line
+
+# symbol table
+PREDEFINED_SYMBOLS = {
+        'SP': 0,
+        'LCL': 1,
+        'ARG': 2,
+        'THIS': 3,
+        'THAT': 4,
+        'SCREEN': 16384,
+        'KBD': 24567
+        }
+PREDEFINED_SYMBOLS.update((f'R{i}', i) for i in range(16))
+VARIABLE_BASE = 16
+SCREEN = 16384
+# symbol kinds
+PREDEFINED, LABEL, VARIABLE = range(3)
+UNRESOLVED = -1
+
 class SymbolTable(object):
+    """Symbols interned as integer IDs, with their addresses and kinds kept in arrays.
+
+    `intern()` gives each distinct symbol an ID the first time it is seen,
+    whether or not it is defined yet, and the `*_id` methods look it up
+    without hashing the name again. `next_address` is the RAM address of
+    the next variable; allocating one into the screen memory map is warned
+    about.
+    """
     def __init__(self):
-        self.table = {
-                'SP': 0,
-                'LCL': 1,
-                'ARG': 2,
-                'THIS': 3,
-                'THAT': 4,
-                'SCREEN': 16384,
-                'KBD': 24567
-                }
-        for i in range(16):
-            I = str(i)
-            self.table['R' + I] = i
-        self.next_address = 16
+        # IDs are handed out in order, so `ids` also lists the names by ID
+        self.ids = {}
+        self.addresses = array('i')
+        self.kinds = array('B')
+        for symbol, address in PREDEFINED_SYMBOLS.items():
+            self._define(self.intern(symbol), address, PREDEFINED)
+        self.next_address = VARIABLE_BASE
+
+    def intern(self, symbol):
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[sys.intern(symbol)] = len(self.addresses)
+            self.addresses.append(UNRESOLVED)
+            self.kinds.append(LABEL)
+        return symbol_id
+
+    def names(self):
+        return list(self.ids)
+
+    def _define(self, symbol_id, address, kind):
+        self.addresses[symbol_id] = address
+        self.kinds[symbol_id] = kind
 
     def add_entry(self, symbol, address):
-        self.table[symbol] = address
+        self.add_entry_id(self.intern(symbol), address)
+
+    def add_entry_id(self, symbol_id, address):
+        self._define(symbol_id, address, LABEL)
 
     def contains(self, symbol):
-        if symbol in self.table.keys():
-            return True
-        else:
-            return False
+        symbol_id = self.ids.get(symbol)
+        return symbol_id is not None and self.addresses[symbol_id] != UNRESOLVED
 
     def get_address(self, symbol):
-        if self.contains(symbol):
-            return self.table[symbol]
-        else:
-            symbol_address = self.next_address
-            self.table[symbol] = symbol_address
+        return self.get_address_id(self.intern(symbol))
+
+    def get_address_id(self, symbol_id):
+        """Return the address of `symbol_id`, allocating it as a variable if it isn't defined."""
+        address = self.addresses[symbol_id]
+        if address == UNRESOLVED:
+            address = self.next_address
+            if address == SCREEN:
+                logger.warning('variable %s is allocated at %d, in the screen memory map',
+                               self.names()[symbol_id], address)
+            self._define(symbol_id, address, VARIABLE)
             self.next_address += 1
-            return symbol_address
+        return address
+
+    def items(self):
+        """Yield `(symbol, address)` for each defined symbol, in order of ID."""
+        addresses = self.addresses
+        for symbol, symbol_id in self.ids.items():
+            if addresses[symbol_id] != UNRESOLVED:
+                yield symbol, addresses[symbol_id]
+
+    @property
+    def table(self):
+        return dict(self.items())
+
+    def n_variables(self):
+        return self.next_address - VARIABLE_BASE
+
+    def symbol_map(self):
+        """Return `(section, address, symbol)` for every label and variable, sorted by address.
+
+        Labels are in ROM and variables in RAM.
+        """
+        entries = []
+        for symbol, symbol_id in self.ids.items():
+            kind = self.kinds[symbol_id]
+            address = self.addresses[symbol_id]
+            if kind != PREDEFINED and address != UNRESOLVED:
+                entries.append(('ROM' if kind == LABEL else 'RAM', address, symbol))
+        entries.sort()
+        return entries
+
+    def write_map(self, path):
+        """Write `symbol_map()` to `path` as tab separated lines."""
+        with open(path, mode='w') as f:
+            f.writelines(f'{section}\t{address}\t{symbol}\n' for section, address, symbol in self.symbol_map())
+
+# code module
+COMP_CODES = {
+        '0': 0b0101010,
+        '1': 0b0111111,
+        '-1': 0b0111010,
+        'D': 0b0001100,
+        'A': 0b0110000,
+        'M': 0b1110000,
+        '!D': 0b0001101,
+        '!A': 0b0110001,
+        '!M': 0b1110001,
+        '-D': 0b0001111,
+        '-A': 0b0110011,
+        '-M': 0b1110011,
+        'D+1': 0b0011111,
+        'A+1': 0b0110111,
+        'M+1': 0b1110111,
+        'D-1': 0b0001110,
+        'A-1': 0b0110010,
+        'M-1': 0b1110010,
+        'D+A': 0b0000010,
+        'D+M': 0b1000010,
+        'D-A': 0b0010011,
+        'D-M': 0b1010011,
+        'A-D': 0b0000111,
+        'M-D': 0b1000111,
+        'D&A': 0b0000000,
+        'D&M': 0b1000000,
+        'D|A': 0b0010101,
+        'D|M': 0b1010101
+        }
+
+def _build_dest_codes():
+    # any ordering of the destination registers is accepted, e.g. MD and DM
+    codes = {None: 0b000}
+    for bits in range(1, 8):
+        registers = [r for r, mask in (('A', 0b100), ('D', 0b010), ('M', 0b001)) if bits & mask]
+        for order in permutations(registers):
+            codes[''.join(order)] = bits
+    return codes
+
+DEST_CODES = _build_dest_codes()
+
+JUMP_CODES = {
+        None: 0b000,
+        'JGT': 0b001,
+        'JEQ': 0b010,
+        'JGE': 0b011,
+        'JLT': 0b100,
+        'JNE': 0b101,
+        'JLE': 0b110,
+        'JMP': 0b111
+        }
+
+def _build_c_instructions():
+    table = {}
+    for c_text, c_bits in COMP_CODES.items():
+        for d_text, d_bits in DEST_CODES.items():
+            for j_text, j_bits in JUMP_CODES.items():
+                text = c_text if d_text is None else f'{d_text}={c_text}'
+                if j_text is not None:
+                    text = f'{text};{j_text}'
+                table[text] = 0b111 << 13 | c_bits << 6 | d_bits << 3 | j_bits
+    return table
+
+# every valid `dest=comp;jump` spelling mapped to its 16-bit instruction
+C_INSTRUCTIONS = _build_c_instructions()
+
+def split_c_command(cmd):
+    """Split `dest=comp;jump` into its fields, with absent fields as None."""
+    d, eq, rest = cmd.rpartition('=')
+    c, semi, j = rest.partition(';')
+    return (d if eq else None), c, (j if semi else None)
 
-# comp module
 def comp(mnemonic):
-    comp_dict = {
-            '0': '0101010',
-            '1': '0111111',
-            '-1': '0111010',
-            'D': '0001100',
-            'A': '0110000',
-            'M': '1110000',
-            '!D': '0001101',
-            '!A': '0110001',
-            '!M': '1110001',
-            '-D': '0001111',
-            '-A': '0110011',
-            '-M': '1110011',
-            'D+1': '0011111',
-            'A+1': '0110111',
-            'M+1': '1110111',
-            'D-1': '0001110',
-            'A-1': '0110010',
-            'M-1': '1110010',
-            'D+A': '0000010',
-            'D+M': '1000010',
-            'D-A': '0010011',
-            'D-M': '1010011',
-            'A-D': '0000111',
-            'M-D': '1000111',
-            'D&A': '0000000',
-            'D&M': '1000000',
-            'D|A': '0010101',
-            'D|M': '1010101'
-            }
-    return comp_dict[mnemonic]
+    return format(COMP_CODES[mnemonic], '07b')
 
 def dest(mnemonic):
-    bits = ['0', '0', '0']
-    if mnemonic is None:
-        return ''.join(bits)
-    if 'A' in mnemonic:
-        bits[0] = '1'
-    if 'D' in mnemonic:
-        bits[1] = '1'
-    if 'M' in mnemonic:
-        bits[2] = '1'
-    return ''.join(bits)
+    return format(DEST_CODES[mnemonic], '03b')
 
 def jump(mnemonic):
-    jump_dict = {
-            None: '000',
-            'JGT': '001',
-            'JEQ': '010',
-            'JGE': '011',
-            'JLT': '100',
-            'JNE': '101',
-            'JLE': '110',
-            'JMP': '111'
-            }
-    return jump_dict[mnemonic]
+    return format(JUMP_CODES[mnemonic], '03b')
+
+def c_instruction(cmd):
+    """Return the 16-bit integer encoding of the C_COMMAND `cmd`."""
+    try:
+        return C_INSTRUCTIONS[cmd]
+    except KeyError:
+        raise SyntaxError(f'Invalid command: {cmd}') from None
 
 # misc funcs
 def address_to_instruction(address):
-    return bin(int(address))[2:].rjust(16, '0')
+    return format(int(address), '016b')
+
+# binary ROM images
+BINARY_MAGIC = b'HACK'
+BINARY_VERSION = 1
+# magic, version, reserved, word count, byte offset of the symbol table
+BINARY_HEADER = struct.Struct('<4sHHII')
+
+def pack_words(words):
+    """Pack 16-bit words as little-endian uint16s."""
+    words = array('H', words)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words.tobytes()
+
+def pack_symbols(sym_table):
+    return ''.join(f'{sym}\t{address}\n' for sym, address in sym_table.items()).encode('utf-8')
+
+def write_binary(outfile, words, sym_table):
+    """Write `words` and `sym_table` to `outfile` as a binary ROM image."""
+    body = pack_words(words)
+    symbols_offset = BINARY_HEADER.size + len(body)
+    with open(outfile, mode='wb') as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(body) // 2, symbols_offset))
+        f.write(body)
+        f.write(pack_symbols(sym_table))
+
+class RomImage(object):
+    """Read-only view of a binary ROM image written by `write_binary`.
+
+    `words` is a memoryview of the instructions over an mmap of the file, so
+    nothing is copied or parsed until it is indexed. On big-endian hosts the
+    words are byteswapped into a private copy instead.
+    """
+    def __init__(self, path):
+        with open(path, mode='rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.n_words, self._symbols_offset = BINARY_HEADER.unpack_from(self._mmap)
+        assert magic == BINARY_MAGIC, f'{path} is not a binary ROM image.'
+        assert version == BINARY_VERSION, f'Unsupported ROM image version {version}.'
+        start = BINARY_HEADER.size
+        view = memoryview(self._mmap)[start:start + 2 * self.n_words]
+        if sys.byteorder == 'little':
+            self.words = view.cast('H')
+        else:
+            words = array('H', view.tobytes())
+            words.byteswap()
+            view.release()
+            self.words = memoryview(words)
+
+    def __len__(self):
+        return self.n_words
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.words.release()
+        self._mmap.close()
+
+    def symbols(self):
+        table = {}
+        text = self._mmap[self._symbols_offset:].decode('utf-8')
+        for line in text.splitlines():
+            sym, address = line.split('\t')
+            table[sym] = int(address)
+        return table
+
+def load_rom(path):
+    """Return the instructions in a text or binary .hack file as an array('H')."""
+    with open(path, mode='rb') as f:
+        magic = f.read(len(BINARY_MAGIC))
+    if magic == BINARY_MAGIC:
+        with RomImage(path) as image:
+            return array('H', image.words)
+    with open(path) as f:
+        return array('H', (int(line, 2) for line in f if line.strip()))
+
+def write_text(outfile, words):
+    with open(outfile, mode='w') as f:
+        f.writelines(f'{word:016b}\n' for word in words)
+
+def get_outfile_name(infile, binary=False):
+    return infile.replace('.asm', '.hackb' if binary else '.hack')
 
-def main(infile):
+# relocatable objects
+ROM_SIZE = 32768
+OBJECT_MAGIC = b'HOBJ'
+OBJECT_VERSION = 1
+# magic, version, reserved, word count, relocation count, reference count
+OBJECT_HEADER = struct.Struct('<4sHHIII')
+
+def pack_array(values):
+    """Pack an array in little-endian order."""
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def unpack_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+class ObjectModule(object):
+    """A separately assembled module, for Linker.py to lay out and resolve.
+
+    `words` is the code as if the module started at ROM address 0.
+    `relocations` lists the words holding the address of one of the
+    module's own `labels`, which move with the module. `imports` lists the
+    symbols the module uses but doesn't define, in order of first use: the
+    labels of other modules, or variables such as its statics.
+    `references` holds a `(position, import index)` pair for each word
+    waiting on one of them.
+    """
+    def __init__(self, name, words, labels, relocations, imports, references):
+        self.name = name
+        self.words = words
+        self.labels = labels
+        self.relocations = relocations
+        self.imports = imports
+        self.references = references
+
+    def statics(self):
+        """The module's static variables, named `{name}.{index}` by the VM translator."""
+        prefix = self.name + '.'
+        return [sym for sym in self.imports if sym.startswith(prefix) and sym[len(prefix):].isdigit()]
+
+    def to_bytes(self):
+        header = OBJECT_HEADER.pack(OBJECT_MAGIC, OBJECT_VERSION, 0, len(self.words), len(self.relocations),
+                                    len(self.references) // 2)
+        text = [f'{self.name}\n']
+        text.extend(f'L\t{label}\t{offset}\n' for label, offset in self.labels.items())
+        text.extend(f'I\t{sym}\n' for sym in self.imports)
+        return b''.join([header, pack_array(self.words), pack_array(self.relocations),
+                         pack_array(self.references), ''.join(text).encode('utf-8')])
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, _, n_words, n_relocations, n_references = OBJECT_HEADER.unpack_from(data)
+        assert magic == OBJECT_MAGIC, 'Not a Hack object module.'
+        assert version == OBJECT_VERSION, f'Unsupported object module version {version}.'
+        start = OBJECT_HEADER.size
+        words = unpack_array('H', data[start:start + 2 * n_words])
+        start += 2 * n_words
+        relocations = unpack_array('I', data[start:start + 4 * n_relocations])
+        start += 4 * n_relocations
+        references = unpack_array('I', data[start:start + 8 * n_references])
+        start += 8 * n_references
+        lines = data[start:].decode('utf-8').splitlines()
+        labels = {}
+        imports = []
+        for line in lines[1:]:
+            fields = line.split('\t')
+            if fields[0] == 'L':
+                labels[fields[1]] = int(fields[2])
+            else:
+                imports.append(fields[1])
+        return cls(lines[0], words, labels, relocations, imports, references)
+
+def assemble_object(name, lines):
+    """Assemble assembly `lines` into an ObjectModule called `name`."""
+    commands = list(clean_lines(lines))
+    labels = {}
+    rom_address = 0
+    for cmd in commands:
+        if cmd.startswith('('):
+            labels[cmd.strip('()')] = rom_address
+        else:
+            rom_address += 1
+    assert rom_address <= 1 << 16, f'{name} is {rom_address} words, too many to address in 16 bits.'
+    words = array('H')
+    relocations = array('I')
+    references = array('I')
+    imports = {}
+    for cmd in commands:
+        if cmd.startswith('('):
+            continue
+        if cmd.startswith('@'):
+            sym = cmd[1:]
+            try:
+                word = int(sym)
+            except ValueError:
+                # as in the symbol table, a label hides a predefined symbol of the same name
+                if sym in labels:
+                    relocations.append(len(words))
+                    word = labels[sym]
+                elif sym in PREDEFINED_SYMBOLS:
+                    word = PREDEFINED_SYMBOLS[sym]
+                else:
+                    references.append(len(words))
+                    references.append(imports.setdefault(sym, len(imports)))
+                    word = 0
+        else:
+            word = c_instruction(cmd)
+        words.append(word)
+    return ObjectModule(name, words, labels, relocations, list(imports), references)
+
+def read_object(path):
+    with open(path, mode='rb') as f:
+        return ObjectModule.from_bytes(f.read())
+
+def write_object(path, module):
+    with open(path, mode='wb') as f:
+        f.write(module.to_bytes())
+
+def get_object_name(infile):
+    return infile.replace('.asm', '.hacko')
+
+# streaming assembler
+WORD_WIDTH = 17 # 16 bits plus newline
+WORD_FORMAT = '{:016b}\n'
+BINARY_WORD = struct.Struct('<H')
+
+class StreamingAssembler(object):
+    """Single pass assembler that writes each word as soon as it is encoded.
+
+    A-instructions that reference a symbol which is not yet known are written
+    as `@0` and recorded in `fixups`. When the symbol is later declared as a
+    label, or at `finish()` once it is known to be a variable, the recorded
+    words are patched in place. If `outfile` is not seekable, the output is
+    kept in a fixed-width buffer and written out at `finish()`.
+
+    A variable is only known to be one at `finish()`, so every reference to
+    a variable stays in `fixups` until then: memory grows with the number of
+    references to unresolved symbols, not with the number of labels.
+    """
+    def __init__(self, outfile, binary=False):
+        self.outfile = outfile
+        self.binary = binary
+        self.sym_table = SymbolTable()
+        self.fixups = {}
+        self.rom_address = 0
+        if binary:
+            self.word_width = BINARY_WORD.size
+            self.header_size = BINARY_HEADER.size
+        else:
+            self.word_width = WORD_WIDTH
+            self.header_size = 0
+        if outfile.seekable():
+            self.buffer = None
+            self.base = outfile.tell()
+            outfile.write(bytes(self.header_size))
+        else:
+            self.buffer = bytearray(self.header_size)
+
+    def feed(self, cmd):
+        if cmd.startswith('('):
+            label = self.sym_table.intern(cmd.strip('()'))
+            self.sym_table.add_entry_id(label, self.rom_address)
+            for rom_address in self.fixups.pop(label, ()):
+                self._patch(rom_address, self.rom_address)
+            return
+        if cmd.startswith('@'):
+            sym = cmd[1:]
+            try:
+                address = int(sym)
+            except ValueError:
+                sym_table = self.sym_table
+                symbol_id = sym_table.ids.get(sym)
+                if symbol_id is None:
+                    symbol_id = sym_table.intern(sym)
+                address = sym_table.addresses[symbol_id]
+                if address == UNRESOLVED:
+                    self.fixups.setdefault(symbol_id, array('I')).append(self.rom_address)
+                    address = 0
+            word = address
+        else:
+            word = c_instruction(cmd)
+        self._emit(word)
+
+    def finish(self):
+        # anything still unresolved is a variable, allocated in order of first use
+        for symbol_id, rom_addresses in self.fixups.items():
+            address = self.sym_table.get_address_id(symbol_id)
+            for rom_address in rom_addresses:
+                self._patch(rom_address, address)
+        self.fixups = {}
+        if self.binary:
+            symbols_offset = self.header_size + self.rom_address * self.word_width
+            header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, self.rom_address, symbols_offset)
+            self._write_at(0, header)
+            self._append(pack_symbols(self.sym_table))
+        if self.buffer is not None:
+            self.outfile.write(self.buffer)
+            self.buffer = bytearray()
+        self.outfile.flush()
+
+    def _encode(self, word):
+        if self.binary:
+            return BINARY_WORD.pack(word)
+        return WORD_FORMAT.format(word).encode('ascii')
+
+    def _emit(self, word):
+        self._append(self._encode(word))
+        self.rom_address += 1
+
+    def _append(self, data):
+        if self.buffer is None:
+            self.outfile.write(data)
+        else:
+            self.buffer += data
+
+    def _patch(self, rom_address, address):
+        # the trailing newline of a text word is left untouched
+        data = self._encode(address)[:16]
+        self._write_at(self.header_size + rom_address * self.word_width, data)
+
+    def _write_at(self, offset, data):
+        if self.buffer is None:
+            end = self.outfile.tell()
+            self.outfile.seek(self.base + offset)
+            self.outfile.write(data)
+            self.outfile.seek(end)
+        else:
+            self.buffer[offset:offset + len(data)] = data
+
+def assemble_stream(infile, outfile, binary=False):
+    """Assemble `infile` into `outfile` in a single pass over its lines."""
+    with open(infile) as f, open(outfile, mode='wb') as out:
+        assembler = StreamingAssembler(out, binary=binary)
+        for cmd in clean_lines(f):
+            assembler.feed(cmd)
+        assembler.finish()
+    return assembler
+
+def assemble(lines):
+    """Assemble assembly `lines` in memory, returning the words and the symbol table."""
+    out = io.BytesIO()
+    assembler = StreamingAssembler(out, binary=True)
+    for cmd in clean_lines(lines):
+        assembler.feed(cmd)
+    assembler.finish()
+    words = array('H')
+    words.frombytes(out.getbuffer()[BINARY_HEADER.size:BINARY_HEADER.size + 2 * assembler.rom_address])
+    return words, assembler.sym_table
+
+def get_map_name(infile):
+    return infile.replace('.asm', '.map')
+
+def rom_source_map(name, lines):
+    """Return a SourceMap from each ROM address to the line of `lines` it was assembled from.
+
+    `name` is the file that `lines` come from.
+    """
+    source_map = SourceMap(name, step=1)
+    rom_address = 0
+    next_line = None
+    for line_number, line in enumerate(lines, 1):
+        for cmd in clean_lines((line,)):
+            if cmd.startswith('('):
+                continue
+            if line_number != next_line:
+                source_map.add(rom_address, name, line_number)
+            next_line = line_number + 1
+            rom_address += 1
+    source_map.end = rom_address
+    return source_map
+
+def main(infile, stream=False, binary=False, cache=None, profiler=None, write_map=False, write_obj=False,
+         source_map=False):
     assert '.asm' in infile, 'Filetype not recognized. Should be `.asm` Hack assembly program.'
-    parser = Parser(infile)
+    if write_obj:
+        with phase(profiler, 'object'):
+            with open(infile) as f:
+                module = assemble_object(os.path.splitext(os.path.basename(infile))[0], f)
+            outfile = get_object_name(infile)
+            write_object(outfile, module)
+        logger.info('wrote to %s', outfile)
+        return
+    outfile = get_outfile_name(infile, binary)
+    if source_map:
+        # the ROM layout depends only on the source, so this holds however the program is assembled
+        with phase(profiler, 'source map'):
+            with open(infile) as f:
+                rom_map = rom_source_map(os.path.basename(infile), f)
+            map_file = get_source_map_name(outfile)
+            rom_map.write(map_file)
+        logger.info('wrote source map to %s', map_file)
+    # the symbol table isn't cached, so build it afresh when it is written or reported
+    if cache is not None and not write_map and not logger.isEnabledFor(logging.DEBUG):
+        with phase(profiler, 'cache'):
+            with open(infile, mode='rb') as f:
+                key = cache.key(source_digest(__file__), binary, f.read())
+            data = cache.get(key)
+            if data is not None:
+                with open(outfile, mode='wb') as f:
+                    f.write(data)
+        if data is not None:
+            logger.info('wrote to %s (cached)', outfile)
+            return
+        main(infile, stream=stream, binary=binary, profiler=profiler)
+        with phase(profiler, 'cache'):
+            with open(outfile, mode='rb') as f:
+                cache.put(key, f.read())
+        return
+    if stream:
+        with phase(profiler, 'stream'):
+            assembler = assemble_stream(infile, outfile, binary=binary)
+        report_symbols(assembler.sym_table, infile, write_map)
+        logger.info('wrote to %s', outfile)
+        return
+    tracing = logger.isEnabledFor(TRACE)
+    profiling = profiler is not None
+    with phase(profiler, 'parse'):
+        parser = Parser(infile)
     sym_table = SymbolTable()
     # first pass
-    while parser.has_more_commands():
-        parser.advance()
-        if parser.command_type() == 'L_COMMAND':
-            sym = parser.symbol()
-            sym_table.add_entry(sym, parser.line_number)
-    print(sym_table.table)
+    with phase(profiler, 'symbols'):
+        while parser.has_more_commands():
+            parser.advance()
+            if parser.command_type() == 'L_COMMAND':
+                sym = parser.symbol()
+                sym_table.add_entry(sym, parser.line_number)
 
     # second pass
     parser.reset()
-    outlines = []
-    while parser.has_more_commands():
-        parser.advance()
-        print(f'\ncommand: {parser.command_counter}\nline: {parser.line_number}')
-        print(parser.current_command, parser.command_type())
-        if parser.command_type() is not 'C_COMMAND':
-            print(f'\t{parser.symbol()}')
-            if parser.command_type() is 'A_COMMAND':
-                sym = parser.symbol()
-                try:
-                    address = int(sym)
-                except ValueError:
-                    address = sym_table.get_address(sym)
-                instruction = address_to_instruction(address)
-                outlines.append(instruction)
+    words = []
+    with phase(profiler, 'encode'):
+        while parser.has_more_commands():
+            if profiling:
+                start = time.perf_counter()
+            parser.advance()
+            if tracing:
+                logger.log(TRACE, '\ncommand: %s\nline: %s\n%s %s', parser.command_counter,
+                           parser.line_number, parser.current_command, parser.command_type())
+            if parser.command_type() != 'C_COMMAND':
+                if tracing:
+                    logger.log(TRACE, '\t%s', parser.symbol())
+                if parser.command_type() == 'A_COMMAND':
+                    sym = parser.symbol()
+                    try:
+                        address = int(sym)
+                    except ValueError:
+                        address = sym_table.get_address(sym)
+                    words.append(address)
+            else:
+                word = c_instruction(parser.current_command)
+                if tracing:
+                    logger.log(TRACE, '\tdest: %s\n\tcomp: %s\n\tjump: %s',
+                               parser.dest(), parser.comp(), parser.jump())
+                words.append(word)
+            if profiling:
+                profiler.command(parser.command_type(), time.perf_counter() - start)
+    report_symbols(sym_table, infile, write_map)
+    if tracing:
+        logger.log(TRACE, '\n'.join(format(word, '016b') for word in words))
+    with phase(profiler, 'write'):
+        if binary:
+            write_binary(outfile, words, sym_table)
         else:
-            print(f'\tdest: {parser.dest()}\n\tcomp: {parser.comp()}\n\tjump: {parser.jump()}')
-            c1 = comp(parser.comp())
-            c2 = dest(parser.dest())
-            c3 = jump(parser.jump())
-            instruction = '111' + c1 + c2 + c3
-            outlines.append(instruction)
-    outfile = infile.replace('.asm', '.hack')
-    print(*outlines, sep='\n')
-    with open(outfile, mode='w') as f:
-        f.writelines('\n'.join(outlines) + '\n')
-    print(f'wrote to {outfile}')
+            write_text(outfile, words)
+    logger.info('wrote to %s', outfile)
 
-if __name__ == '__main__':
+def report_symbols(sym_table, infile, write_map=False):
+    logger.debug('symbol table: %s', sym_table.table)
+    logger.debug('%d variables at RAM[%d..%d]', sym_table.n_variables(), VARIABLE_BASE, sym_table.next_address - 1)
+    if write_map:
+        map_file = get_map_name(infile)
+        sym_table.write_map(map_file)
+        logger.info('wrote symbol map to %s', map_file)
+
+def add_logging_args(arg_parser):
+    group = arg_parser.add_mutually_exclusive_group()
+    group.add_argument('-q', '--quiet', action='store_true', help='Only report warnings and errors.')
+    group.add_argument('-v', '--verbose', action='store_true', help='Also report debugging detail, such as symbol tables.')
+    group.add_argument('--trace', action='store_true', help='Report every command as it is processed.')
+
+def log_level(args):
+    if args.trace:
+        return TRACE
+    if args.verbose:
+        return logging.DEBUG
+    if args.quiet:
+        return logging.WARNING
+    return logging.INFO
+
+def set_log_level(args):
+    logging.basicConfig(stream=sys.stdout, format='%(message)s', level=log_level(args))
+
+def build_arg_parser():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('infile', help='File to translate from assembly.')
-    args = arg_parser.parse_args()
-    main(args.infile)
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='Assemble in a single pass, patching forward references at the end.')
+    arg_parser.add_argument('--binary', action='store_true',
+                            help='Write a packed little-endian .hackb ROM image instead of text.')
+    arg_parser.add_argument('--object', action='store_true',
+                            help='Write a relocatable .hacko object module for Linker.py instead.')
+    arg_parser.add_argument('--map', action='store_true',
+                            help='Also write the labels and variables sorted by address to a .map file.')
+    arg_parser.add_argument('--source-map', action='store_true',
+                            help='Also write a .srcmap mapping each ROM address to its line of assembly.')
+    add_cache_args(arg_parser)
+    add_profile_args(arg_parser)
+    add_logging_args(arg_parser)
+    return arg_parser
+
+def run(args):
+    """Do what the command line `args`, from `build_arg_parser`, ask for."""
+    profiler = profiler_from_args(args)
+    main(args.infile, stream=args.stream, binary=args.binary, cache=cache_from_args(args),
+         profiler=profiler, write_map=args.map, write_obj=args.object, source_map=args.source_map)
+    report_profile(profiler, args)
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    set_log_level(args)
+    run(args)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import os
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nand2tetris')
+
+def source_digest(path):
+    """Hash of a tool's own source, so cached outputs expire when the tool changes."""
+    with open(path, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class BuildCache(object):
+    """Content-addressed on-disk cache of build outputs.
+
+    Entries are files named by the hash of everything that went into them.
+    Reading an entry touches it, and once the cache grows past `max_bytes`
+    the least recently used entries are deleted.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            elif not isinstance(part, bytes):
+                part = repr(part).encode('utf-8')
+            # length-prefix each part so ('ab', 'c') and ('a', 'bc') differ
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, mode='rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, mode='wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self._entries())
+        else:
+            self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in `max_bytes`."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    def usage(self):
+        """Return the number of entries and bytes currently in the cache."""
+        entries = self._entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+        self.total_bytes = 0
+
+def add_cache_args(arg_parser):
+    arg_parser.add_argument('--no-cache', action='store_true', help='Rebuild everything and leave the cache alone.')
+    arg_parser.add_argument('--cache-dir', help=f'Build cache location (default {default_cache_dir()}).')
+    arg_parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES,
+                            help='Evict least recently used cache entries past this many bytes.')
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    return BuildCache(args.cache_dir, max_bytes=args.cache_size)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cache-dir', help=f'Build cache location (default {default_cache_dir()}).')
+    arg_parser.add_argument('--clear', action='store_true', help='Delete every cache entry.')
+    args = arg_parser.parse_args()
+    cache = BuildCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    n_entries, n_bytes = cache.usage()
+    print(f'{cache.directory}: {n_entries} entries, {n_bytes} bytes')
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+import logging
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from Assembler import load_rom, set_log_level, add_logging_args
+
+logger = logging.getLogger('CPUEmulator')
+
+RAM_SIZE = 32768
+ADDRESS_MASK = 0x7FFF
+SCREEN = 16384
+KBD = 24576
+
+def wrap(value):
+    """Wrap `value` into the signed 16-bit range."""
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+# ALU functions for the comp patterns the assembler emits, keyed by the six
+# zx/nx/zy/ny/f/no control bits. x is always D; y is A or M.
+ALU_FUNCS = {
+        0b101010: lambda x, y: 0,
+        0b111111: lambda x, y: 1,
+        0b111010: lambda x, y: -1,
+        0b001100: lambda x, y: x,
+        0b110000: lambda x, y: y,
+        0b001101: lambda x, y: ~x,
+        0b110001: lambda x, y: ~y,
+        0b001111: lambda x, y: wrap(-x),
+        0b110011: lambda x, y: wrap(-y),
+        0b011111: lambda x, y: wrap(x + 1),
+        0b110111: lambda x, y: wrap(y + 1),
+        0b001110: lambda x, y: wrap(x - 1),
+        0b110010: lambda x, y: wrap(y - 1),
+        0b000010: lambda x, y: wrap(x + y),
+        0b010011: lambda x, y: wrap(x - y),
+        0b000111: lambda x, y: wrap(y - x),
+        0b000000: lambda x, y: x & y,
+        0b010101: lambda x, y: x | y
+        }
+
+def alu_func(control):
+    """Return the ALU function for the six control bits in `control`."""
+    if control in ALU_FUNCS:
+        return ALU_FUNCS[control]
+    zx, nx, zy, ny, f, no = (bool(control & (1 << bit)) for bit in range(5, -1, -1))
+
+    def alu(x, y):
+        if zx:
+            x = 0
+        if nx:
+            x = ~x
+        if zy:
+            y = 0
+        if ny:
+            y = ~y
+        out = x + y if f else x & y
+        if no:
+            out = ~out
+        return wrap(out)
+    return alu
+
+def decode(word):
+    """Decode one instruction into `(alu, value, uses_m, dest, jump)`.
+
+    For A-instructions `alu` is None and `value` is the constant to load.
+    """
+    if not word & 0x8000:
+        return None, word, False, 0, 0
+    return alu_func((word >> 6) & 0b111111), 0, bool(word & 0x1000), (word >> 3) & 0b111, word & 0b111
+
+class Breakpoint(Exception):
+    """Raised by `BREAKPOINT_OP` when `CPU.run` fetches an address it is to stop at."""
+
+def breakpoint_alu(x, y):
+    raise Breakpoint()
+
+# stands in for the op at each breakpoint, so the loop stops there without checking the PC
+BREAKPOINT_OP = (breakpoint_alu, 0, False, 0, 0)
+
+class CPU(object):
+    """Headless Hack computer: ROM, 32K of RAM and the A, D and PC registers.
+
+    The ROM is decoded once into `ops`, one tuple per instruction, so the
+    fetch-execute loop in `run()` does no bit twiddling of its own.
+    """
+    def __init__(self, rom):
+        self.rom = array('H', rom)
+        self.ops = [decode(word) for word in self.rom]
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_rom(path))
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles=None, until=None, on_jump=None):
+        """Execute instructions until `max_cycles` have run or the PC reaches `until`.
+
+        `until` is one ROM address or a collection of them. Running past the
+        end of the program sets `halted`. Each taken jump calls
+        `on_jump(pc, target, n)`, if given, with the jump's address, where
+        it goes and the cycles run so far, the jump included; the run stops
+        at the target if it returns True. Returns the number of cycles
+        executed by this call.
+        """
+        ops = self.ops
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        budget = -1 if max_cycles is None else max_cycles
+        stop = -1
+        breakpoints = {}
+        if isinstance(until, int):
+            stop = until
+        elif until is not None:
+            for address in until:
+                if 0 <= address < len(ops):
+                    breakpoints[address] = ops[address]
+                    ops[address] = BREAKPOINT_OP
+        n = 0
+        try:
+            while n != budget and pc != stop:
+                alu, value, uses_m, dest, jump = ops[pc]
+                n += 1
+                if alu is None:
+                    a = value
+                    pc += 1
+                    continue
+                out = alu(d, ram[a & ADDRESS_MASK] if uses_m else a)
+                target = a
+                if dest:
+                    if dest & 1:
+                        ram[a & ADDRESS_MASK] = out
+                    if dest & 2:
+                        d = out
+                    if dest & 4:
+                        a = out
+                if jump and ((jump & 4 and out < 0) or (jump & 2 and out == 0) or (jump & 1 and out > 0)):
+                    if on_jump is not None and on_jump(pc, target & ADDRESS_MASK, n):
+                        pc = target & ADDRESS_MASK
+                        break
+                    pc = target & ADDRESS_MASK
+                else:
+                    pc += 1
+        except IndexError:
+            # fetched past the end of the ROM
+            self.halted = True
+        except Breakpoint:
+            # the breakpoint's fetch doesn't count as a cycle
+            n -= 1
+        finally:
+            for address, op in breakpoints.items():
+                ops[address] = op
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += n
+        return n
+
+    def run_until(self, pc, max_cycles=None):
+        """Run until the PC reaches `pc`. Returns False if the budget ran out first."""
+        self.run(max_cycles=max_cycles, until=pc)
+        return self.pc == pc
+
+    def step(self):
+        return self.run(max_cycles=1)
+
+class BatchCPU(object):
+    """`n_lanes` independent Hack computers stepping in lockstep over one ROM.
+
+    RAM is a `(n_lanes, 32768)` int16 NumPy array and A, D and PC are one
+    entry per lane. Each step executes the instruction at the lowest PC among
+    the running lanes, for every lane sitting at that PC; lanes that jumped
+    elsewhere are masked out until the others catch up with them, so decode
+    and dispatch are paid once per step rather than once per lane. A lane
+    spinning in a loop below the others starves them, so programs that end in
+    a halt loop should be run with `until` set to it.
+    """
+    def __init__(self, rom, n_lanes):
+        if np is None:
+            raise ImportError('BatchCPU requires numpy.')
+        self.rom = array('H', rom)
+        self.ops = [decode(word) for word in self.rom]
+        self.n_lanes = n_lanes
+        self.ram = np.zeros((n_lanes, RAM_SIZE), dtype=np.int16)
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path, n_lanes):
+        return cls(load_rom(path), n_lanes)
+
+    def reset(self):
+        self.a = np.zeros(self.n_lanes, dtype=np.int32)
+        self.d = np.zeros(self.n_lanes, dtype=np.int32)
+        self.pc = np.zeros(self.n_lanes, dtype=np.int32)
+        self.cycles = np.zeros(self.n_lanes, dtype=np.int64)
+        self.halted = np.zeros(self.n_lanes, dtype=bool)
+
+    def run(self, max_cycles=None, until=None):
+        """Step until `max_cycles` steps have run or every lane has halted or reached `until`.
+
+        Per-lane cycle counts accumulate in `cycles`. Returns the number of
+        lockstep steps taken by this call.
+        """
+        ops = self.ops
+        n_ops = len(ops)
+        budget = -1 if max_cycles is None else max_cycles
+        steps = 0
+        while steps != budget:
+            running = ~self.halted
+            if until is not None:
+                running &= self.pc != until
+            if not running.any():
+                break
+            pc = int(self.pc[running].min())
+            if pc >= n_ops:
+                # every running lane has fetched past the end of the ROM
+                self.halted |= running
+                break
+            lanes = np.flatnonzero(running & (self.pc == pc))
+            self._execute(ops[pc], pc, lanes)
+            steps += 1
+        return steps
+
+    def run_until(self, pc, max_cycles=None):
+        """Run until every lane reaches `pc`. Returns False if any lane did not."""
+        self.run(max_cycles=max_cycles, until=pc)
+        return bool((self.pc == pc).all())
+
+    def _execute(self, op, pc, lanes):
+        alu, value, uses_m, dest, jump = op
+        self.cycles[lanes] += 1
+        if alu is None:
+            self.a[lanes] = value
+            self.pc[lanes] = pc + 1
+            return
+        a = self.a[lanes]
+        addresses = a & ADDRESS_MASK
+        y = self.ram[lanes, addresses].astype(np.int32) if uses_m else a
+        out = np.broadcast_to(alu(self.d[lanes], y), lanes.shape)
+        if dest & 1:
+            self.ram[lanes, addresses] = out
+        if dest & 2:
+            self.d[lanes] = out
+        if dest & 4:
+            self.a[lanes] = out
+        if jump:
+            taken = np.zeros(lanes.shape, dtype=bool)
+            if jump & 4:
+                taken |= out < 0
+            if jump & 2:
+                taken |= out == 0
+            if jump & 1:
+                taken |= out > 0
+            self.pc[lanes] = np.where(taken, addresses, pc + 1)
+        else:
+            self.pc[lanes] = pc + 1
+
+def run_batch(rom, inputs, max_cycles=None, until=None):
+    """Run `rom` once per lane and return the final RAM of every lane.
+
+    `inputs` maps a RAM address to a sequence with one starting value per
+    lane; all sequences must have the same length.
+    """
+    n_lanes = len(next(iter(inputs.values())))
+    cpu = BatchCPU(rom, n_lanes)
+    for address, values in inputs.items():
+        cpu.ram[:, address] = values
+    cpu.run(max_cycles=max_cycles, until=until)
+    return cpu.ram
+
+def main(infile, max_cycles, until=None, dump=None):
+    cpu = CPU.from_file(infile)
+    start = time.perf_counter()
+    cycles = cpu.run(max_cycles=max_cycles, until=until)
+    elapsed = time.perf_counter() - start
+    logger.info('ran %d cycles in %.3fs (%.0f instructions/s)', cycles, elapsed,
+                cycles / elapsed if elapsed else 0)
+    logger.debug('A=%d D=%d PC=%d halted=%s', cpu.a, cpu.d, cpu.pc, cpu.halted)
+    if dump is not None:
+        first, last = dump
+        for address in range(first, last + 1):
+            print(f'RAM[{address}] = {cpu.ram[address]}')
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('infile', help='Text or binary .hack program to run.')
+    arg_parser.add_argument('--cycles', type=int, default=1000000, help='Maximum number of cycles to run.')
+    arg_parser.add_argument('--until', type=int, help='Stop when the PC reaches this ROM address.')
+    arg_parser.add_argument('--dump', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                            help='Print RAM[FIRST..LAST] when the run stops.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    main(args.infile, args.cycles, until=args.until, dump=args.dump)
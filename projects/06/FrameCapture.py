@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from Assembler import add_logging_args, set_log_level
+from CPUEmulator import CPU, KBD, SCREEN
+
+logger = logging.getLogger('FrameCapture')
+
+SCREEN_ROWS = 256
+SCREEN_COLUMNS = 512
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def unpack_screen(screen):
+    """Unpack the screen memory map, as bytes in the machine's order, into a 256x512 array, 1 where a pixel is black.
+
+    Pixel (r, c) is bit c % 16 of word r * 32 + c // 16, so the words'
+    bytes in little-endian order unpack, least significant bit first,
+    straight into rows.
+    """
+    words = np.frombuffer(screen, dtype=np.int16).astype('<i2', copy=False)
+    return np.unpackbits(words.view(np.uint8), bitorder='little').reshape(SCREEN_ROWS, SCREEN_COLUMNS)
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def encode_png(pixels):
+    """Encode unpacked screen `pixels` as a 1-bit grayscale PNG."""
+    height, width = pixels.shape
+    # one filter byte of 0 per row, then the pixels packed most significant bit first, 1 for white
+    rows = np.zeros((height, 1 + (width + 7) // 8), dtype=np.uint8)
+    rows[:, 1:] = np.packbits(pixels ^ 1, axis=1)
+    return (PNG_SIGNATURE + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0))
+            + png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + png_chunk(b'IEND', b''))
+
+def get_cycles_name(raw_path):
+    return os.path.splitext(raw_path)[0] + '.cycles'
+
+class FrameWriter(object):
+    """Writes frames from a background thread: each as a PNG, and all of them to one raw video file.
+
+    PNGs go in `png_dir`, named for the cycle the frame was captured at.
+    The raw video holds 8-bit grayscale 512x256 frames, as `ffmpeg -f
+    rawvideo -pix_fmt gray -s 512x256` reads, and the capture cycle of each
+    is written a line apiece to the .cycles file beside it. At most
+    `max_pending` frames wait to be written; past that `put` blocks until
+    the writer catches up, so memory stays bounded and no frame is lost.
+    """
+    def __init__(self, png_dir=None, raw_path=None, max_pending=32):
+        self.png_dir = png_dir
+        if png_dir is not None:
+            os.makedirs(png_dir, exist_ok=True)
+        self.raw = open(raw_path, mode='wb') if raw_path is not None else None
+        self.cycles = open(get_cycles_name(raw_path), mode='w') if raw_path is not None else None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.written = 0
+        self.stalled = 0.0
+        self.busy = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='FrameWriter', daemon=True)
+        self.thread.start()
+
+    def put(self, cycle, screen):
+        """Queue the screen memory map, as bytes, captured at `cycle`."""
+        try:
+            self.queue.put_nowait((cycle, screen))
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put((cycle, screen))
+            self.stalled += time.perf_counter() - start
+
+    def close(self):
+        """Wait for the queued frames to be written, then close the files."""
+        self.queue.put(None)
+        self.thread.join()
+        for f in (self.raw, self.cycles):
+            if f is not None:
+                f.close()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # keep taking frames so the emulator doesn't block; close() raises the error
+                continue
+            start = time.perf_counter()
+            try:
+                self.write(*frame)
+            except Exception as e:
+                self.error = e
+            self.busy += time.perf_counter() - start
+
+    def write(self, cycle, screen):
+        pixels = unpack_screen(screen)
+        if self.png_dir is not None:
+            with open(os.path.join(self.png_dir, f'cycle_{cycle:012d}.png'), mode='wb') as f:
+                f.write(encode_png(pixels))
+        if self.raw is not None:
+            self.raw.write(((pixels ^ 1) * 255).tobytes())
+            self.cycles.write(f'{cycle}\n')
+        self.written += 1
+
+class FrameCapture(object):
+    """Snapshots the screen of a Hack CPU every `every` cycles and passes the changed ones to `writer`.
+
+    The CPU runs `every` cycles at a time, so its loop is untouched. A
+    snapshot hashes the screen memory map in place and copies it only when
+    the hash differs from the last frame's; unpacking and encoding are left
+    to the writer's thread.
+    """
+    def __init__(self, writer, every=50000):
+        self.writer = writer
+        self.every = every
+        self.last = None
+        self.frames = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def capture(self, cpu):
+        start = time.perf_counter()
+        screen = memoryview(cpu.ram)[SCREEN:KBD]
+        digest = hashlib.blake2b(screen, digest_size=16).digest()
+        if digest == self.last:
+            self.skipped += 1
+        else:
+            self.last = digest
+            self.frames += 1
+            self.writer.put(cpu.cycles, screen.tobytes())
+        self.seconds += time.perf_counter() - start
+
+    def run(self, cpu, max_cycles=None):
+        """Run `cpu` for up to `max_cycles`, capturing the screen first and after every `every` cycles.
+
+        Returns the number of cycles run.
+        """
+        self.capture(cpu)
+        ran = 0
+        while max_cycles is None or ran < max_cycles:
+            budget = self.every if max_cycles is None else min(self.every, max_cycles - ran)
+            n = cpu.run(max_cycles=budget)
+            ran += n
+            self.capture(cpu)
+            if n < budget:
+                # halted
+                break
+        return ran
+
+def main(infile, max_cycles, every=50000, png_dir=None, raw_path=None, max_pending=32):
+    if np is None:
+        raise ImportError('FrameCapture requires numpy.')
+    cpu = CPU.from_file(infile)
+    writer = FrameWriter(png_dir, raw_path, max_pending)
+    capture = FrameCapture(writer, every)
+    start = time.perf_counter()
+    try:
+        cycles = capture.run(cpu, max_cycles)
+    finally:
+        elapsed = time.perf_counter() - start
+        writer.close()
+    logger.info('ran %d cycles in %.3fs (%.0f instructions/s)%s', cycles, elapsed,
+                cycles / elapsed if elapsed else 0, ', until the program halted' if cpu.halted else '')
+    logger.info('captured %d frames and skipped %d unchanged ones, in %.3fs (%.2f%% of the run), '
+                'with %.3fs waiting on the writer', capture.frames, capture.skipped, capture.seconds,
+                100 * capture.seconds / elapsed if elapsed else 0, writer.stalled)
+    logger.debug('the writer spent %.3fs writing %d frames', writer.busy, writer.written)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Run a Hack program and capture what it draws on the screen, skipping unchanged frames.')
+    arg_parser.add_argument('infile', help='Text or binary .hack program to run.')
+    arg_parser.add_argument('--cycles', type=int, default=10000000, help='Maximum number of cycles to run.')
+    arg_parser.add_argument('--every', type=int, default=50000, help='Capture the screen every this many cycles.')
+    arg_parser.add_argument('--png', metavar='DIR', help='Write each frame to this directory as a PNG.')
+    arg_parser.add_argument('--raw', metavar='FILE',
+                            help='Write the frames to this file as raw 512x256 8-bit grayscale video, '
+                                 'with the cycle of each in a .cycles file beside it.')
+    arg_parser.add_argument('--max-pending', type=int, default=32,
+                            help='Frames that can wait for the writer before the run waits for it.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    if args.png is None and args.raw is None:
+        arg_parser.error('give --png, --raw or both')
+    main(args.infile, args.cycles, every=args.every, png_dir=args.png, raw_path=args.raw,
+         max_pending=args.max_pending)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+import logging
+import os
+import time
+
+from Assembler import add_logging_args, set_log_level
+from CPUEmulator import ADDRESS_MASK, CPU
+from SourceMap import get_source_map_name, read_source_map, trace_back
+
+logger = logging.getLogger('HackProfiler')
+
+SP, LCL = 0, 1
+# calling any of these stops the run, as in the VM emulator
+HALT_FUNCTIONS = {'Sys.halt'}
+# kinds of jump, for `profile`
+STATIC_TO_ENTRY, COMPUTED, HALT = 1, 2, 3
+# kinds of entry
+ENTRY, HALT_ENTRY = 1, 2
+
+class CallTree(object):
+    """The call stacks seen in a profiled run, with the cycles spent in each.
+
+    Node 0 is the root, running function `root`. Every other node is one
+    function called from its parent's. `cycles[node]` counts the cycles spent
+    in the node's function and not in its callees, and `calls[node]` the
+    times it was called from that stack. Functions are indices into the
+    names that `rom_functions` returns.
+    """
+    def __init__(self, root):
+        self.functions = [root]
+        self.parents = [-1]
+        self.cycles = [0]
+        self.calls = [1]
+        self.children = {}
+
+    def __len__(self):
+        return len(self.functions)
+
+    def call(self, node, function):
+        """Return the node for `function` called from `node`, counting the call."""
+        child = self.children.get((node, function))
+        if child is None:
+            child = self.children[node, function] = len(self.functions)
+            self.functions.append(function)
+            self.parents.append(node)
+            self.cycles.append(0)
+            self.calls.append(0)
+        self.calls[child] += 1
+        return child
+
+    def stack(self, node):
+        """The functions from the root down to `node`."""
+        functions = []
+        while node != -1:
+            functions.append(self.functions[node])
+            node = self.parents[node]
+        return functions[::-1]
+
+    def collapsed(self, names):
+        """Yield a `caller;callee cycles` line per stack, as flamegraph.pl and speedscope read."""
+        for node in range(len(self)):
+            if self.cycles[node]:
+                yield ';'.join(names[function] for function in self.stack(node)) + f' {self.cycles[node]}'
+
+    def function_totals(self):
+        """Return `{function: [calls, exclusive cycles, inclusive cycles]}`.
+
+        A recursive function's cycles count once toward its inclusive total,
+        however deep it is in its own stack.
+        """
+        totals = {}
+        for node in range(len(self)):
+            function = self.functions[node]
+            totals.setdefault(function, [0, 0, 0])
+            totals[function][0] += self.calls[node]
+            totals[function][1] += self.cycles[node]
+            for caller in set(self.stack(node)):
+                totals.setdefault(caller, [0, 0, 0])[2] += self.cycles[node]
+        return totals
+
+def function_name(chain):
+    """Name the function of the last place in a `trace_back` chain."""
+    if not chain:
+        return '?'
+    source, _, function = chain[-1]
+    if function is not None:
+        return function
+    # top-level code, named as the VM emulator names it
+    return f'{os.path.splitext(source)[0]}$top'
+
+def rom_functions(source_maps, n_words):
+    """Map each ROM address through `source_maps` to the VM function its code came from.
+
+    Returns the function names, the index into them for each address, and a
+    bytearray over all of ROM marking where each function starts, with
+    HALT_ENTRY for the HALT_FUNCTIONS and ENTRY for the rest. Code that
+    comes from no VM file, such as the bootstrap, is named for the routine,
+    like `$bootstrap` or `$$call`, and has no entry.
+    """
+    names = []
+    ids = {}
+    functions = array('I')
+    entries = bytearray(max(n_words, ADDRESS_MASK + 1))
+    for address in range(n_words):
+        name = function_name(trace_back(source_maps, address))
+        function = ids.get(name)
+        if function is None:
+            function = ids[name] = len(names)
+            names.append(name)
+        if (not functions or functions[-1] != function) and not name.startswith('$') and name != '?':
+            entries[address] = HALT_ENTRY if name in HALT_FUNCTIONS else ENTRY
+        functions.append(function)
+    return names, functions, entries
+
+def jump_kinds(ops, entries):
+    """Classify the jumps in `ops` for `profile`.
+
+    A jump straight after an A-instruction goes to a fixed address: a call
+    if that is a function entry, and a halt if it is the A-instruction
+    itself. Any other jump is computed, as a return or a compact mode call
+    is, from an address held in RAM.
+    """
+    kinds = bytearray(len(ops))
+    for address, (alu, _, _, _, jump) in enumerate(ops):
+        if alu is None or not jump:
+            continue
+        if address and ops[address - 1][0] is None:
+            target = ops[address - 1][1] & ADDRESS_MASK
+            if target == address - 1 and jump == 0b111:
+                kinds[address] = HALT
+            elif entries[target]:
+                kinds[address] = STATIC_TO_ENTRY
+        else:
+            kinds[address] = COMPUTED
+    return kinds
+
+def profile(cpu, functions, entries, max_cycles=None):
+    """Run `cpu` for up to `max_cycles`, counting the cycles spent in each call stack.
+
+    `functions` and `entries` are as from `rom_functions`. Only taken jumps
+    are looked at. A jump straight to an entry is a call when it leaves the
+    address after it as the return address of the new frame. A computed jump
+    to an entry is a compact mode call when it leaves an empty new frame,
+    with SP equal to LCL. A computed jump back to the innermost frame's
+    return address is a return; the return value left on the stack keeps
+    the two apart when the address after a call is also an entry. Cycles
+    spent in a call sequence count toward the caller, and cycles spent in a
+    return sequence toward the callee. The run stops on a call to one of the
+    HALT_FUNCTIONS, at a jump to itself, or on running off the end of ROM.
+    Returns the CallTree.
+
+    The jumps are looked at through the `on_jump` hook of `CPU.run`, which
+    runs the program.
+    """
+    ram = cpu.ram
+    kinds = jump_kinds(cpu.ops, entries)
+    tree = CallTree(functions[cpu.pc])
+    cycles = tree.cycles
+    parents = tree.parents
+    node = 0
+    # the cycle count at the last call or return
+    last = 0
+    # the return address of each frame on the stack of calls
+    returns = [-1]
+
+    def on_jump(pc, target, n):
+        nonlocal node, last
+        kind = kinds[pc]
+        if not kind:
+            return False
+        if kind == HALT:
+            cpu.halted = True
+            return True
+        lcl = ram[LCL]
+        return_address = ram[(lcl - 5) & ADDRESS_MASK]
+        if entries[target] and (return_address == pc + 1 if kind == STATIC_TO_ENTRY else ram[SP] == lcl):
+            cycles[node] += n - last
+            last = n
+            node = tree.call(node, functions[target])
+            returns.append(return_address)
+            if entries[target] == HALT_ENTRY:
+                cpu.halted = True
+                return True
+        elif kind == COMPUTED and target == returns[-1]:
+            cycles[node] += n - last
+            last = n
+            node = parents[node]
+            returns.pop()
+        return False
+
+    n = cpu.run(max_cycles, on_jump=on_jump)
+    cycles[node] += n - last
+    return tree
+
+def report(tree, names, top=20):
+    """Describe the `top` functions by exclusive cycles, with their calls and inclusive cycles."""
+    totals = tree.function_totals()
+    total = sum(tree.cycles) or 1
+    lines = [f'{"function":<32} {"calls":>10} {"exclusive":>12} {"%":>6} {"inclusive":>12} {"%":>6}']
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+    for function, (calls, exclusive, inclusive) in ranked[:top]:
+        lines.append(f'{names[function]:<32} {calls:>10} {exclusive:>12} {100 * exclusive / total:>6.2f} '
+                     f'{inclusive:>12} {100 * inclusive / total:>6.2f}')
+    return lines
+
+def default_source_maps(infile):
+    """The source map next to `infile`, and any next to the files it maps back to."""
+    paths = [get_source_map_name(infile)]
+    rom_map = read_source_map(paths[0])
+    source_maps = [rom_map]
+    for source in rom_map.names[1:]:
+        path = get_source_map_name(os.path.join(os.path.dirname(infile), source))
+        if os.path.exists(path):
+            source_maps.append(read_source_map(path))
+    return source_maps
+
+def main(infile, max_cycles, maps=None, outfile=None, top=20):
+    cpu = CPU.from_file(infile)
+    source_maps = [read_source_map(path) for path in maps] if maps else default_source_maps(infile)
+    names, functions, entries = rom_functions(source_maps, len(cpu.ops))
+    start = time.perf_counter()
+    tree = profile(cpu, functions, entries, max_cycles)
+    elapsed = time.perf_counter() - start
+    logger.info('ran %d cycles in %.3fs (%.0f instructions/s)%s', cpu.cycles, elapsed,
+                cpu.cycles / elapsed if elapsed else 0, '' if cpu.halted else ', stopped by the cycle budget')
+    for line in report(tree, names, top):
+        logger.info(line)
+    if outfile is not None:
+        with open(outfile, mode='w') as f:
+            for line in tree.collapsed(names):
+                f.write(line + '\n')
+        logger.info('wrote %d call stacks to %s', sum(1 for cycles in tree.cycles if cycles), outfile)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Run a Hack program and count the cycles spent in each VM function.')
+    arg_parser.add_argument('infile', help='Text or binary .hack program to run.')
+    arg_parser.add_argument('--maps', nargs='+',
+                            help='Source maps to trace ROM addresses through, starting with the ROM\'s own; '
+                                 'defaults to those written by --source-map next to the program and its .asm.')
+    arg_parser.add_argument('--cycles', type=int, default=10000000, help='Maximum number of cycles to run.')
+    arg_parser.add_argument('-o', '--output', help='Write the cycles per call stack here, as collapsed stacks.')
+    arg_parser.add_argument('--top', type=int, default=20, help='Number of functions to report.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    main(args.infile, args.cycles, maps=args.maps, outfile=args.output, top=args.top)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+import logging
+import os
+
+from Assembler import (ROM_SIZE, SymbolTable, add_logging_args, assemble_object, read_object, set_log_level,
+                       write_binary, write_text)
+
+logger = logging.getLogger('Linker')
+
+def link(modules):
+    """Lay out `modules` in ROM in order and resolve their imports, returning the words and symbol table.
+
+    An import is resolved to the label of that name in another module. If
+    no module defines it, it is a variable, allocated in order of first use
+    just as the assembler does for a single program. A label that more than
+    one module defines stays private to each of them, and can't be imported.
+    """
+    sym_table = SymbolTable()
+    bases = []
+    ambiguous = set()
+    rom_address = 0
+    for module in modules:
+        bases.append(rom_address)
+        for label, offset in module.labels.items():
+            if label in ambiguous:
+                continue
+            if sym_table.contains(label):
+                ambiguous.add(label)
+            else:
+                sym_table.add_entry(label, rom_address + offset)
+        rom_address += len(module.words)
+    assert rom_address <= 1 << 16, f'The program is {rom_address} words, too many to address in 16 bits.'
+    if rom_address > ROM_SIZE:
+        # as from the assembler, which writes whatever it is given
+        logger.warning('the program is %d words, more than the %d that fit in ROM', rom_address, ROM_SIZE)
+    words = array('H')
+    for module, base in zip(modules, bases):
+        code = array('H', module.words)
+        for position in module.relocations:
+            code[position] += base
+        addresses = []
+        for sym in module.imports:
+            if sym in ambiguous:
+                raise NameError(f'{module.name} uses {sym}, which more than one module defines.')
+            addresses.append(sym_table.get_address(sym))
+        references = module.references
+        for i in range(0, len(references), 2):
+            code[references[i]] = addresses[references[i + 1]]
+        words.extend(code)
+    logger.debug('linked %d modules into %d words, with %d variables', len(modules), len(words),
+                 sym_table.n_variables())
+    return words, sym_table
+
+def load_module(path):
+    """Read a .hacko object module, or assemble an .asm file into one."""
+    if path.endswith('.asm'):
+        with open(path) as f:
+            return assemble_object(os.path.splitext(os.path.basename(path))[0], f)
+    return read_object(path)
+
+def main(infiles, outfile, binary=False, write_map=False):
+    modules = [load_module(infile) for infile in infiles]
+    words, sym_table = link(modules)
+    if binary:
+        write_binary(outfile, words, sym_table)
+    else:
+        write_text(outfile, words)
+    logger.info('wrote to %s', outfile)
+    if write_map:
+        map_file = os.path.splitext(outfile)[0] + '.map'
+        sym_table.write_map(map_file)
+        logger.info('wrote symbol map to %s', map_file)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Link Hack object modules into one program.')
+    arg_parser.add_argument('infiles', nargs='+',
+                            help='.hacko object modules from `Assembler.py --object`, or .asm files, in ROM order.')
+    arg_parser.add_argument('-o', '--output', help='Program to write; defaults to the first module as .hack.')
+    arg_parser.add_argument('--binary', action='store_true',
+                            help='Write a packed little-endian .hackb ROM image instead of text.')
+    arg_parser.add_argument('--map', action='store_true',
+                            help='Also write the labels and variables sorted by address to a .map file.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    outfile = args.output or os.path.splitext(args.infiles[0])[0] + ('.hackb' if args.binary else '.hack')
+    main(args.infiles, outfile, binary=args.binary, write_map=args.map)
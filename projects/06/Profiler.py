@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import json
+import sys
+import time
+import tracemalloc
+
+class Profiler(object):
+    """Wall time and allocations per phase, and counts and times per command type.
+
+    Tools wrap each stage in `phase(name)` and report each translated command
+    with `command(kind, seconds)`. A phase entered more than once accumulates.
+    Every callable in `hooks` is called as `hook(name, stats)` when a phase
+    ends, with the stats of that run alone, so numbers can be forwarded
+    elsewhere as they come in; `as_dict()` has the totals.
+
+    `blocks` is the net change in the interpreter's allocated blocks over a
+    phase. With `trace_memory` set, tracemalloc also records each phase's peak
+    bytes, at a large cost to the wall times.
+    """
+    def __init__(self, hooks=(), trace_memory=False):
+        self.hooks = list(hooks)
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.phase_order = []
+        self.commands = defaultdict(lambda: [0, 0.0])
+
+    @contextmanager
+    def phase(self, name):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start_blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = {'seconds': time.perf_counter() - start,
+                     'blocks': sys.getallocatedblocks() - start_blocks}
+            if self.trace_memory:
+                stats['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes
+            self._add_phase(name, stats)
+            for hook in self.hooks:
+                hook(name, stats)
+
+    def _add_phase(self, name, stats):
+        if name not in self.phases:
+            self.phase_order.append(name)
+            self.phases[name] = dict(stats, calls=1)
+            return
+        total = self.phases[name]
+        total['calls'] += 1
+        total['seconds'] += stats['seconds']
+        total['blocks'] += stats['blocks']
+        if 'peak_bytes' in stats:
+            total['peak_bytes'] = max(total['peak_bytes'], stats['peak_bytes'])
+
+    def command(self, kind, seconds):
+        counts = self.commands[kind]
+        counts[0] += 1
+        counts[1] += seconds
+
+    def as_dict(self):
+        return {
+            'phases': {name: dict(self.phases[name]) for name in self.phase_order},
+            'commands': {kind: {'count': count, 'seconds': seconds}
+                         for kind, (count, seconds) in sorted(self.commands.items())}
+        }
+
+    def report(self):
+        """Return the totals as lines of text."""
+        lines = []
+        total = sum(stats['seconds'] for stats in self.phases.values())
+        for name in self.phase_order:
+            stats = self.phases[name]
+            line = f'{name:<12} {stats["seconds"] * 1000:10.3f} ms {stats["blocks"]:+10d} blocks'
+            if 'peak_bytes' in stats:
+                line += f' {stats["peak_bytes"]:12d} peak bytes'
+            lines.append(line)
+        lines.append(f'{"total":<12} {total * 1000:10.3f} ms')
+        for kind, (count, seconds) in sorted(self.commands.items()):
+            lines.append(f'{kind:<12} {count:10d} commands {seconds * 1000:10.3f} ms '
+                         f'{seconds / count * 1e6:8.2f} us each')
+        return lines
+
+    def dump(self, path):
+        """Write `as_dict()` to `path` as JSON."""
+        with open(path, mode='w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+def phase(profiler, name):
+    """`profiler.phase(name)`, or a no-op when `profiler` is None."""
+    return nullcontext() if profiler is None else profiler.phase(name)
+
+def add_profile_args(arg_parser):
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='Report time per phase and per command type.')
+    arg_parser.add_argument('--profile-json', metavar='FILE',
+                            help='Write the time per phase and per command type to FILE as JSON.')
+    arg_parser.add_argument('--profile-memory', action='store_true',
+                            help='Also trace peak memory per phase (slow).')
+
+def profiler_from_args(args):
+    if not args.profile and args.profile_json is None:
+        return None
+    return Profiler(trace_memory=args.profile_memory)
+
+def report_profile(profiler, args):
+    """Print the profile under --profile and write it under --profile-json."""
+    if profiler is None:
+        return
+    if args.profile:
+        print('\n'.join(profiler.report()))
+    if args.profile_json is not None:
+        profiler.dump(args.profile_json)
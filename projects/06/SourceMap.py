@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+from bisect import bisect_right
+import struct
+import sys
+
+SOURCE_MAP_MAGIC = b'HSRC'
+SOURCE_MAP_VERSION = 1
+# magic, version, step, run count, name count, end
+SOURCE_MAP_HEADER = struct.Struct('<4sHHIII')
+
+class SourceMap(object):
+    """Maps positions in a tool's output back to the source lines they came from.
+
+    The map is a sorted list of runs, kept in arrays. Run `i` covers the
+    positions of `output` from `starts[i]` up to the start of the next run,
+    and the last run up to `end`. Positions in a text file are its line
+    numbers.
+    It came from line `lines[i]` of the file `names[sources[i]]`, in the
+    function `names[functions[i]]`, or in no function if that is ''. With a
+    `step` of 1 each position of a run comes from the next line, as the
+    words of an assembled program do. With a `step` of 0 they all come from
+    the one line, as the assembly of a VM command does.
+    """
+    def __init__(self, output, step, end=0):
+        self.output = output
+        self.step = step
+        self.end = end
+        self.starts = array('I')
+        self.sources = array('I')
+        self.lines = array('I')
+        self.functions = array('I')
+        self.names = ['']
+        self.name_ids = {'': 0}
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add(self, start, source, line, function=None):
+        """Start a run at `start`, which must not be before the last run's.
+
+        A run with no positions of its own is replaced.
+        """
+        if self.starts and self.starts[-1] == start:
+            self.starts.pop()
+            self.sources.pop()
+            self.lines.pop()
+            self.functions.pop()
+        self.starts.append(start)
+        self.sources.append(self._name_id(source))
+        self.lines.append(line)
+        self.functions.append(self._name_id(function or ''))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def run(self, position):
+        """Return the index of the run covering `position`, or -1 if it is before them all."""
+        return bisect_right(self.starts, position) - 1
+
+    def lookup(self, position):
+        """Return `(source, line, function)` for `position`, or None if it isn't mapped."""
+        i = self.run(position)
+        if i < 0 or position >= self.end:
+            return None
+        line = self.lines[i] + (position - self.starts[i]) * self.step
+        return self.names[self.sources[i]], line, self.names[self.functions[i]] or None
+
+    def to_bytes(self):
+        header = SOURCE_MAP_HEADER.pack(SOURCE_MAP_MAGIC, SOURCE_MAP_VERSION, self.step, len(self.starts),
+                                        len(self.names), self.end)
+        arrays = [self.starts, self.sources, self.lines, self.functions]
+        if sys.byteorder != 'little':
+            arrays = [array('I', values) for values in arrays]
+            for values in arrays:
+                values.byteswap()
+        text = '\n'.join([self.output] + self.names[1:]) + '\n'
+        return b''.join([header] + [values.tobytes() for values in arrays] + [text.encode('utf-8')])
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, step, n_runs, n_names, end = SOURCE_MAP_HEADER.unpack_from(data)
+        assert magic == SOURCE_MAP_MAGIC, 'Not a source map.'
+        assert version == SOURCE_MAP_VERSION, f'Unsupported source map version {version}.'
+        start = SOURCE_MAP_HEADER.size
+        arrays = []
+        for _ in range(4):
+            values = array('I')
+            values.frombytes(data[start:start + 4 * n_runs])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            arrays.append(values)
+            start += 4 * n_runs
+        text = data[start:].decode('utf-8').split('\n')
+        source_map = cls(text[0], step, end)
+        source_map.starts, source_map.sources, source_map.lines, source_map.functions = arrays
+        source_map.names = [''] + text[1:n_names]
+        source_map.name_ids = {name: i for i, name in enumerate(source_map.names)}
+        return source_map
+
+    def write(self, path):
+        with open(path, mode='wb') as f:
+            f.write(self.to_bytes())
+
+def read_source_map(path):
+    with open(path, mode='rb') as f:
+        return SourceMap.from_bytes(f.read())
+
+def get_source_map_name(outfile):
+    return outfile + '.srcmap'
+
+def trace_back(source_maps, position):
+    """Follow `position` back through each of `source_maps` in turn, as far as they go.
+
+    Returns a list of `(source, line, function)`, starting with the
+    position's place in the first map's sources. A later map is followed
+    when its output is the source the last one led to.
+    """
+    by_output = {source_map.output: source_map for source_map in source_maps}
+    chain = []
+    location = source_maps[0].lookup(position)
+    while location is not None:
+        chain.append(location)
+        source, line, _ = location
+        source_map = by_output.pop(source, None)
+        if source_map is None:
+            break
+        location = source_map.lookup(line)
+    return chain
+
+def format_location(location):
+    source, line, function = location
+    if not source:
+        # generated code, such as the bootstrap
+        return function
+    return f'{source}:{line}' + (f' in {function}' if function else '')
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Trace ROM addresses back to their assembly and VM code.')
+    arg_parser.add_argument('maps', nargs='+',
+                            help='Source maps, starting with the .hack.srcmap from Assembler.py --source-map.')
+    arg_parser.add_argument('-a', '--address', type=int, action='append', default=[],
+                            help='ROM address to look up; may be repeated. Without one, list every run.')
+    args = arg_parser.parse_args()
+    source_maps = [read_source_map(path) for path in args.maps]
+    if args.address:
+        for address in args.address:
+            chain = trace_back(source_maps, address)
+            print(f'{address}: ' + (' <- '.join(map(format_location, chain)) or 'not mapped'))
+    else:
+        first = source_maps[0]
+        for i in range(len(first)):
+            location = first.lookup(first.starts[i])
+            print(f'{first.starts[i]}: {format_location(location)}')
@@ -0,0 +1,158 @@
+import io
+import logging
+import os
+
+import pytest
+
+from Assembler import (C_INSTRUCTIONS, SCREEN, TRACE, RomImage, StreamingAssembler, SymbolTable, build_arg_parser,
+                       c_instruction, comp, dest, jump, load_rom, log_level, main, split_c_command)
+from BuildCache import BuildCache
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# programs whose .hack output is checked in beside them
+BASELINE_PROGRAMS = [
+    '06/pong/Pong', '06/rect/Rect', '06/rect/RectL',
+    '07/MemoryAccess/BasicTest/BasicTest', '07/MemoryAccess/PointerTest/PointerTest',
+    '07/MemoryAccess/StaticTest/StaticTest', '07/StackArithmetic/SimpleAdd/SimpleAdd',
+    '07/StackArithmetic/StackTest/StackTest', '08/ProgramFlow/BasicLoop/BasicLoop',
+    '08/ProgramFlow/FibonacciSeries/FibonacciSeries',
+]
+PROGRAMS = ['06/add/Add', '06/max/Max', '06/max/MaxL', '06/pong/PongL'] + BASELINE_PROGRAMS
+
+def read_bytes(path):
+    with open(path, mode='rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('program', BASELINE_PROGRAMS)
+def test_matches_baseline(copy_into, program, stream):
+    infile, = copy_into(program + '.asm')
+    main(infile, stream=stream)
+    assert read_bytes(infile[:-len('.asm')] + '.hack') == read_bytes(os.path.join(PROJECTS_DIR, program + '.hack'))
+
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_stream_matches_two_passes(copy_into, program):
+    infile, = copy_into(program + '.asm')
+    outfile = infile[:-len('.asm')] + '.hack'
+    main(infile)
+    two_passes = read_bytes(outfile)
+    main(infile, stream=True)
+    assert read_bytes(outfile) == two_passes
+
+class Unseekable(io.BytesIO):
+    def seekable(self):
+        return False
+
+@pytest.mark.parametrize('out', [io.BytesIO, Unseekable])
+def test_stream_backpatches_forward_references(out):
+    out = out()
+    assembler = StreamingAssembler(out)
+    for cmd in ['@END', '0;JMP', '@x', 'M=1', '(END)', '@y', '@x']:
+        assembler.feed(cmd)
+    assembler.finish()
+    words = [int(line, 2) for line in out.getvalue().decode('ascii').split()]
+    assert words == [4, 0b1110101010000111, 16, 0b1110111111001000, 17, 16]
+
+def test_c_instruction_table_matches_fields():
+    assert len(C_INSTRUCTIONS) == 28 * 8 * 16
+    for cmd, word in C_INSTRUCTIONS.items():
+        d, c, j = split_c_command(cmd)
+        assert format(word, '016b') == '111' + comp(c) + dest(d) + jump(j)
+
+@pytest.mark.parametrize('cmd, word', [
+    ('0;JMP', 0b1110101010000111),
+    ('MD=M+1', 0b1111110111011000),
+    ('DM=M+1', 0b1111110111011000),
+    ('AMD=D|A;JNE', 0b1110010101111101),
+])
+def test_c_instruction(cmd, word):
+    assert c_instruction(cmd) == word
+
+@pytest.mark.parametrize('cmd', ['D=D+D', 'X=1', 'D;JXX', '0;'])
+def test_c_instruction_rejects_invalid_commands(cmd):
+    with pytest.raises(SyntaxError):
+        c_instruction(cmd)
+
+@pytest.mark.parametrize('argv, level', [
+    ([], logging.INFO),
+    (['-q'], logging.WARNING),
+    (['-v'], logging.DEBUG),
+    (['--trace'], TRACE),
+])
+def test_log_level(argv, level):
+    assert log_level(build_arg_parser().parse_args(argv + ['Add.asm'])) == level
+
+def test_logging(copy_into, caplog):
+    infile, = copy_into('06/add/Add.asm')
+    with caplog.at_level(logging.WARNING):
+        main(infile)
+    assert caplog.messages == []
+    with caplog.at_level(logging.INFO):
+        main(infile)
+    assert caplog.messages == [f'wrote to {infile[:-len(".asm")]}.hack']
+    caplog.clear()
+    with caplog.at_level(TRACE):
+        main(infile)
+    assert any('D=D+A' in message for message in caplog.messages)
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_binary_rom_image(copy_into, stream):
+    infile, = copy_into('06/max/Max.asm')
+    main(infile)
+    main(infile, stream=stream, binary=True)
+    name = infile[:-len('.asm')]
+    assert load_rom(name + '.hackb') == load_rom(name + '.hack')
+    with RomImage(name + '.hackb') as image:
+        assert len(image) == len(image.words) == 16
+        symbols = image.symbols()
+    assert symbols['OUTPUT_FIRST'] == 10
+    assert symbols['INFINITE_LOOP'] == 14
+    assert symbols['SCREEN'] == 16384
+
+def test_cache(copy_into, tmp_path, caplog):
+    infile, = copy_into('06/max/Max.asm')
+    outfile = infile[:-len('.asm')] + '.hack'
+    main(infile)
+    expected = read_bytes(outfile)
+    cache = BuildCache(str(tmp_path / 'cache'))
+    main(infile, cache=cache)
+    os.remove(outfile)
+    with caplog.at_level(logging.INFO):
+        main(infile, cache=cache)
+    assert cache.hits == 1
+    assert read_bytes(outfile) == expected
+    assert caplog.messages == [f'wrote to {outfile} (cached)']
+    caplog.clear()
+    # the symbol table isn't cached, so it is reported by assembling afresh
+    with caplog.at_level(logging.DEBUG):
+        main(infile, cache=cache)
+    assert cache.hits == 1
+    assert any(message.startswith('symbol table:') for message in caplog.messages)
+
+def test_symbol_table():
+    sym_table = SymbolTable()
+    loop = sym_table.intern('LOOP')
+    assert sym_table.intern('LOOP') == loop
+    assert not sym_table.contains('LOOP')
+    assert sym_table.get_address('SCREEN') == SCREEN
+    assert [sym_table.get_address(name) for name in ('i', 'sum', 'i')] == [16, 17, 16]
+    sym_table.add_entry_id(loop, 4)
+    assert sym_table.contains('LOOP')
+    assert sym_table.n_variables() == 2
+    assert sym_table.symbol_map() == [('RAM', 16, 'i'), ('RAM', 17, 'sum'), ('ROM', 4, 'LOOP')]
+
+def test_variables_in_the_screen_are_warned_about(caplog):
+    sym_table = SymbolTable()
+    sym_table.next_address = SCREEN - 1
+    sym_table.get_address('below')
+    assert caplog.messages == []
+    sym_table.get_address('inside')
+    assert caplog.messages == [f'variable inside is allocated at {SCREEN}, in the screen memory map']
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_write_map(copy_into, stream):
+    infile, = copy_into('06/max/Max.asm')
+    main(infile, stream=stream, write_map=True)
+    with open(infile[:-len('.asm')] + '.map') as f:
+        assert f.read() == 'ROM\t10\tOUTPUT_FIRST\nROM\t12\tOUTPUT_D\nROM\t14\tINFINITE_LOOP\n'
@@ -0,0 +1,28 @@
+import os
+
+from BuildCache import BuildCache
+
+def test_key():
+    assert BuildCache.key('ab', 'c') != BuildCache.key('a', 'bc')
+    assert BuildCache.key(b'x', 1, None) == BuildCache.key(b'x', 1, None)
+    assert BuildCache.key(b'x', 1, None) != BuildCache.key(b'x', 1, False)
+
+def test_get_and_put(tmp_path):
+    cache = BuildCache(str(tmp_path))
+    key = cache.key('program')
+    assert cache.get(key) is None
+    cache.put(key, b'words')
+    assert cache.get(key) == b'words'
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.usage() == (1, 5)
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BuildCache(str(tmp_path), max_bytes=12)
+    for age, name in enumerate(['old', 'used', 'new'], 1):
+        cache.put(name, b'1234')
+        os.utime(tmp_path / name, (age, age))
+    # reading an entry makes it the most recently used
+    assert cache.get('old') == b'1234'
+    cache.put('newest', b'1234')
+    assert sorted(os.listdir(tmp_path)) == ['new', 'newest', 'old']
+    assert cache.usage() == (3, 12)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from Assembler import assemble
+from CPUEmulator import CPU, BatchCPU, run_batch
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+def program(path):
+    with open(os.path.join(PROJECTS_DIR, path)) as f:
+        return assemble(f)[0]
+
+def test_runs_past_the_end():
+    cpu = CPU(program('06/add/Add.asm'))
+    assert cpu.run(max_cycles=100) == 6
+    assert cpu.halted
+    assert cpu.ram[0] == 5
+
+@pytest.mark.parametrize('r0, r1', [(3, 7), (7, 3), (-5, -9), (0, 0)])
+def test_max(r0, r1):
+    cpu = CPU(program('06/max/Max.asm'))
+    cpu.ram[0], cpu.ram[1] = r0, r1
+    # INFINITE_LOOP
+    assert cpu.run_until(14, max_cycles=100)
+    assert cpu.ram[2] == max(r0, r1)
+
+def test_simple_add():
+    # as SimpleAdd.tst runs it
+    cpu = CPU.from_file(os.path.join(PROJECTS_DIR, '07/StackArithmetic/SimpleAdd/SimpleAdd.hack'))
+    cpu.ram[0] = 256
+    cpu.run(max_cycles=60)
+    assert (cpu.ram[0], cpu.ram[256]) == (257, 15)
+
+def test_breakpoints():
+    rom = program('06/max/Max.asm')
+    cpu = CPU(rom)
+    cpu.ram[0], cpu.ram[1] = 3, 7
+    n = cpu.run(until=14)
+    breakpoint_cpu = CPU(rom)
+    breakpoint_cpu.ram[0], breakpoint_cpu.ram[1] = 3, 7
+    assert breakpoint_cpu.run(until=[14, 1000]) == n
+    assert breakpoint_cpu.pc == 14
+    assert breakpoint_cpu.cycles == n
+    # the ROM is left as it was
+    assert breakpoint_cpu.ops == CPU(rom).ops
+    assert breakpoint_cpu.run(max_cycles=5) == 5
+
+def test_jump_hook():
+    cpu = CPU(program('06/max/Max.asm'))
+    cpu.ram[0], cpu.ram[1] = 3, 7
+    jumps = []
+    def on_jump(pc, target, n):
+        jumps.append((pc, target, n))
+        return len(jumps) == 3
+    n = cpu.run(max_cycles=100, on_jump=on_jump)
+    # past OUTPUT_FIRST to OUTPUT_D, then round INFINITE_LOOP, stopping on its third jump
+    assert jumps == [(9, 12, 10), (15, 14, 14), (15, 14, 16)]
+    assert (n, cpu.pc, cpu.ram[2]) == (16, 14, 7)
+
+def test_errors_are_not_breakpoints():
+    cpu = CPU(program('06/add/Add.asm'))
+    cpu.ops[3] = (lambda x, y: x + None, 0, False, 2, 0)
+    with pytest.raises(TypeError):
+        cpu.run(max_cycles=100, until=[5])
+
+def test_batch_matches_cpu():
+    np = pytest.importorskip('numpy')
+    rom = program('06/max/Max.asm')
+    inputs = {0: [3, 7, -5, 0, 12], 1: [7, 3, -9, 0, 12]}
+    ram = run_batch(rom, inputs, until=14)
+    for lane, (r0, r1) in enumerate(zip(inputs[0], inputs[1])):
+        cpu = CPU(rom)
+        cpu.ram[0], cpu.ram[1] = r0, r1
+        cpu.run_until(14)
+        assert np.array_equal(ram[lane], np.array(cpu.ram, dtype=np.int16))
+
+def test_batch_halts():
+    pytest.importorskip('numpy')
+    cpu = BatchCPU(program('06/add/Add.asm'), 3)
+    assert cpu.run(max_cycles=100) == 6
+    assert cpu.halted.all()
+    assert list(cpu.cycles) == [6, 6, 6]
+    assert list(cpu.ram[:, 0]) == [5, 5, 5]
@@ -0,0 +1,85 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from CPUEmulator import CPU, SCREEN
+from FrameCapture import FrameCapture, FrameWriter, PNG_SIGNATURE, encode_png, main, unpack_screen
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+def known_screen():
+    """The screen memory map with pixels (0, 0) and (1, 31) black, as bytes."""
+    cpu = CPU([])
+    cpu.ram[SCREEN] = 1
+    cpu.ram[SCREEN + 33] = -32768
+    return memoryview(cpu.ram)[SCREEN:SCREEN + 8192].tobytes()
+
+def decode_png(data):
+    """Decode a 1-bit grayscale PNG as `encode_png` writes it, checking each chunk's CRC."""
+    assert data.startswith(PNG_SIGNATURE)
+    position = len(PNG_SIGNATURE)
+    chunks = {}
+    while position < len(data):
+        length, = struct.unpack_from('>I', data, position)
+        kind = data[position + 4:position + 8]
+        body = data[position + 8:position + 8 + length]
+        crc, = struct.unpack_from('>I', data, position + 8 + length)
+        assert crc == zlib.crc32(kind + body)
+        chunks[kind] = body
+        position += 12 + length
+    width, height, depth, color, _, _, _ = struct.unpack('>IIBBBBB', chunks[b'IHDR'])
+    assert (depth, color) == (1, 0)
+    rows = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(height, -1)
+    assert not rows[:, 0].any()
+    return np.unpackbits(rows[:, 1:], axis=1)[:, :width] ^ 1
+
+def test_unpack_screen():
+    pixels = unpack_screen(known_screen())
+    assert pixels.shape == (256, 512)
+    assert [tuple(pixel) for pixel in np.argwhere(pixels)] == [(0, 0), (1, 31)]
+
+def test_encode_png():
+    pixels = unpack_screen(known_screen())
+    assert (decode_png(encode_png(pixels)) == pixels).all()
+
+def test_frame_writer(tmp_path):
+    writer = FrameWriter(str(tmp_path / 'png'), str(tmp_path / 'frames.raw'), max_pending=1)
+    writer.put(0, bytes(16384))
+    writer.put(1000, known_screen())
+    writer.close()
+    assert writer.written == 2
+    assert sorted(os.listdir(tmp_path / 'png')) == ['cycle_000000000000.png', 'cycle_000000001000.png']
+    with open(tmp_path / 'png' / 'cycle_000000001000.png', mode='rb') as f:
+        assert (decode_png(f.read()) == unpack_screen(known_screen())).all()
+    frames = np.fromfile(tmp_path / 'frames.raw', dtype=np.uint8).reshape(2, 256, 512)
+    assert (frames[0] == 255).all()
+    assert [tuple(pixel) for pixel in np.argwhere(frames[1] == 0)] == [(0, 0), (1, 31)]
+    assert (tmp_path / 'frames.cycles').read_text() == '0\n1000\n'
+
+class Frames(object):
+    def __init__(self):
+        self.frames = []
+
+    def put(self, cycle, screen):
+        self.frames.append((cycle, unpack_screen(screen)))
+
+def test_frame_capture():
+    cpu = CPU.from_file(os.path.join(PROJECTS_DIR, '06/rect/Rect.hack'))
+    cpu.ram[0] = 4
+    writer = Frames()
+    capture = FrameCapture(writer, every=5)
+    assert capture.run(cpu, max_cycles=1000) == 1000
+    # the rectangle is drawn a row at a time, one every 13 cycles, and then the screen doesn't change
+    assert [cycle for cycle, _ in writer.frames] == [0, 15, 30, 40, 55]
+    assert capture.frames == 5
+    assert capture.skipped == 201 - 5
+    _, pixels = writer.frames[-1]
+    rectangle = [(row, column) for row in range(4) for column in range(16)]
+    assert [tuple(pixel) for pixel in np.argwhere(pixels)] == rectangle
+
+def test_main(tmp_path):
+    main(os.path.join(PROJECTS_DIR, '06/rect/Rect.hack'), 1000, every=100, png_dir=str(tmp_path))
+    # with RAM[0] 0 nothing is drawn, so only the first frame is written
+    assert os.listdir(tmp_path) == ['cycle_000000000000.png']
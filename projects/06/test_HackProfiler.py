@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '07'))
+import Assembler
+from CPUEmulator import CPU
+from HackProfiler import default_source_maps, main, profile, rom_functions
+from VMtranslator import main as translate
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+OPTIONS = [{}, {'optimize': True}, {'compact': True}, {'optimize': True, 'compact': True}]
+
+def build(copy_into, program, **options):
+    """Translate and assemble `program` with source maps, returning the .hack file."""
+    names = sorted(name for name in os.listdir(os.path.join(PROJECTS_DIR, program)) if name.endswith('.vm'))
+    infiles = copy_into(*[os.path.join(program, name) for name in names])
+    translate(infiles, source_map=True, **options)
+    name = infiles[0][:-len('.vm')]
+    Assembler.main(name + '.asm', source_map=True)
+    return name + '.hack'
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_fibonacci_calls(copy_into, options):
+    infile = build(copy_into, '08/FunctionCalls/FibonacciElement', **options)
+    cpu = CPU.from_file(infile)
+    names, functions, entries = rom_functions(default_source_maps(infile), len(cpu.ops))
+    tree = profile(cpu, functions, entries, max_cycles=100000)
+    assert cpu.halted
+    totals = {names[function]: calls for function, (calls, _, _) in tree.function_totals().items()}
+    # fibonacci(4) calls itself for 3, 2, 2, 1, 1, 1, 0 and 0
+    assert totals == {'$bootstrap': 1, 'Sys.init': 1, 'Main.fibonacci': 9}
+    assert sum(tree.cycles) == cpu.cycles
+
+def test_collapsed_stacks(copy_into, tmp_path):
+    infile = build(copy_into, '08/FunctionCalls/FibonacciElement')
+    main(infile, 100000, outfile=str(tmp_path / 'stacks.txt'))
+    stacks = [line.rsplit(' ', 1)[0] for line in (tmp_path / 'stacks.txt').read_text().splitlines()]
+    assert stacks == ['$bootstrap', '$bootstrap;Sys.init'] + [
+        ';'.join(['$bootstrap', 'Sys.init'] + ['Main.fibonacci'] * depth) for depth in range(1, 5)]
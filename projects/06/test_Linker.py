@@ -0,0 +1,36 @@
+import pytest
+
+from Assembler import assemble, assemble_object, main as assemble_main, read_object
+from Linker import link, main
+
+MAIN = ['@i', 'M=0', '(LOOP)', '@i', 'M=M+1', '@DOUBLE', '0;JMP', '(BACK)', '@LOOP', '0;JMP']
+DOUBLE = ['(DOUBLE)', '@i', 'D=M', 'M=D+M', '@total', 'M=D', '@BACK', '0;JMP']
+
+def test_link_matches_assembling_together():
+    words, sym_table = link([assemble_object('Main', MAIN), assemble_object('Double', DOUBLE)])
+    expected, expected_table = assemble(MAIN + DOUBLE)
+    assert words == expected
+    assert sym_table.symbol_map() == expected_table.symbol_map()
+
+def test_object_module_round_trips():
+    module = assemble_object('Main', MAIN)
+    assert module.imports == ['i', 'DOUBLE']
+    assert type(module).from_bytes(module.to_bytes()).to_bytes() == module.to_bytes()
+
+def test_labels_defined_twice_are_private():
+    first = assemble_object('A', ['(END)', '@END', '0;JMP'])
+    second = assemble_object('B', ['(END)', '@END', '0;JMP'])
+    words, _ = link([first, second])
+    assert list(words) == [0, 0b1110101010000111, 2, 0b1110101010000111]
+    with pytest.raises(NameError, match='C uses END'):
+        link([first, second, assemble_object('C', ['@END', '0;JMP'])])
+
+def test_main_links_objects(copy_into, tmp_path):
+    infile, = copy_into('06/max/Max.asm')
+    assemble_main(infile, write_obj=True)
+    assert read_object(infile[:-len('.asm')] + '.hacko').name == 'Max'
+    main([infile[:-len('.asm')] + '.hacko'], str(tmp_path / 'Linked.hack'), write_map=True)
+    assemble_main(infile)
+    with open(infile[:-len('.asm')] + '.hack') as expected, open(tmp_path / 'Linked.hack') as linked:
+        assert linked.read() == expected.read()
+    assert (tmp_path / 'Linked.map').read_text().splitlines()[0] == 'ROM\t10\tOUTPUT_FIRST'
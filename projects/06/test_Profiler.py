@@ -0,0 +1,50 @@
+import argparse
+import json
+
+from Profiler import Profiler, add_profile_args, phase, profiler_from_args, report_profile
+
+def test_phases_accumulate():
+    calls = []
+    profiler = Profiler(hooks=[lambda name, stats: calls.append(name)])
+    for name in ('parse', 'write', 'parse'):
+        with profiler.phase(name):
+            pass
+    assert calls == ['parse', 'write', 'parse']
+    assert profiler.phase_order == ['parse', 'write']
+    assert profiler.phases['parse']['calls'] == 2
+    with phase(None, 'nothing'):
+        pass
+
+def test_commands():
+    profiler = Profiler()
+    profiler.command('C_PUSH', 0.5)
+    profiler.command('C_PUSH', 1.5)
+    profiler.command('C_POP', 1.0)
+    assert profiler.as_dict()['commands'] == {'C_POP': {'count': 1, 'seconds': 1.0},
+                                              'C_PUSH': {'count': 2, 'seconds': 2.0}}
+    assert profiler.report()[-1].split()[:2] == ['C_PUSH', '2']
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('infiles', nargs='+')
+    add_profile_args(arg_parser)
+    return arg_parser.parse_args(argv)
+
+def test_profile_args():
+    assert profiler_from_args(parse_args(['Main.vm'])) is None
+    args = parse_args(['--profile', 'Main'])
+    assert args.infiles == ['Main']
+    assert profiler_from_args(args) is not None
+    args = parse_args(['--profile-json', 'profile.json', 'Main'])
+    assert (args.profile, args.profile_json, args.infiles) == (False, 'profile.json', ['Main'])
+
+def test_report_profile(tmp_path, capsys):
+    json_path = str(tmp_path / 'profile.json')
+    args = parse_args(['--profile', '--profile-json', json_path, 'Main.vm'])
+    profiler = profiler_from_args(args)
+    with profiler.phase('parse'):
+        pass
+    report_profile(profiler, args)
+    assert capsys.readouterr().out.startswith('parse ')
+    with open(json_path) as f:
+        assert list(json.load(f)['phases']) == ['parse']
@@ -0,0 +1,44 @@
+from Assembler import main
+from SourceMap import SourceMap, format_location, read_source_map, trace_back
+
+def test_lookup():
+    source_map = SourceMap('Prog.asm', step=0, end=10)
+    source_map.add(0, '', 0, '$bootstrap')
+    source_map.add(4, 'Main.vm', 3, 'Main.main')
+    source_map.add(4, 'Main.vm', 5, 'Main.main')
+    source_map.add(7, 'Sys.vm', 2)
+    assert len(source_map) == 3
+    assert source_map.lookup(3) == ('', 0, '$bootstrap')
+    assert source_map.lookup(6) == ('Main.vm', 5, 'Main.main')
+    assert source_map.lookup(9) == ('Sys.vm', 2, None)
+    assert source_map.lookup(10) is None
+    copy = SourceMap.from_bytes(source_map.to_bytes())
+    assert [copy.lookup(position) for position in range(11)] == [source_map.lookup(position) for position in range(11)]
+    assert copy.output == 'Prog.asm'
+
+def test_trace_back():
+    hack_map = SourceMap('Prog.hack', step=1, end=6)
+    hack_map.add(0, 'Prog.asm', 1)
+    hack_map.add(3, 'Prog.asm', 10)
+    asm_map = SourceMap('Prog.asm', step=0, end=13)
+    asm_map.add(0, '', 0, '$bootstrap')
+    asm_map.add(10, 'Main.vm', 4, 'Main.main')
+    chain = trace_back([hack_map, asm_map], 4)
+    assert chain == [('Prog.asm', 11, None), ('Main.vm', 4, 'Main.main')]
+    assert [format_location(location) for location in chain] == ['Prog.asm:11', 'Main.vm:4 in Main.main']
+    assert format_location(trace_back([hack_map, asm_map], 0)[-1]) == '$bootstrap'
+    assert trace_back([hack_map, asm_map], 6) == []
+
+def test_assembler_source_map(copy_into):
+    infile, = copy_into('06/max/Max.asm')
+    main(infile, source_map=True)
+    source_map = read_source_map(infile[:-len('.asm')] + '.hack.srcmap')
+    with open(infile) as f:
+        lines = f.read().splitlines()
+    assert source_map.end == 16
+    # every word comes from an instruction, labels and comments having none
+    for address in range(source_map.end):
+        source, line, function = source_map.lookup(address)
+        assert (source, function) == ('Max.asm', None)
+        assert lines[line - 1].strip()[0] in '@DAM0'
+    assert lines[source_map.lookup(10)[1] - 2].strip() == '(OUTPUT_FIRST)'
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import importlib
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# kept to the standard library, so a build pays for as little start-up as possible
+
+# the module run for each tool when no server is running
+TOOL_MODULES = {'assemble': 'Assembler', 'translate': 'VMtranslator'}
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f'hack-build-{os.getuid()}.sock')
+
+def server_is_running(socket_path):
+    """Whether a build server answers on `socket_path`."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+def run_in_process(tool, argv):
+    """Run `tool` with the command line `argv` in this process, as its own script would."""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+    module = importlib.import_module(TOOL_MODULES[tool])
+    args = module.build_arg_parser().parse_args(argv)
+    module.set_log_level(args)
+    module.run(args)
+
+class BuildClient(object):
+    """A connection to BuildDaemon.py, sending it jobs one at a time."""
+    def __init__(self, socket_path=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path or default_socket_path())
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, job):
+        """Send `job` and return the server's response."""
+        self.file.write(json.dumps(job).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('the build server closed the connection')
+        return json.loads(line)
+
+    def run(self, tool, argv, cwd=None):
+        """Run `tool` with the command line `argv`, as if in `cwd`."""
+        return self.request({'tool': tool, 'argv': list(argv), 'cwd': os.path.abspath(cwd or os.getcwd())})
+
+    def assemble(self, text):
+        """Return the .hack text for the assembly `text`."""
+        return self._result(self.request({'tool': 'assemble', 'text': text}), 'hack')
+
+    def translate(self, files, optimize=False, compact=False, with_os=False, intrinsics=()):
+        """Return the assembly for `files`, a map from .vm file names to their text."""
+        job = {'tool': 'translate', 'files': files, 'optimize': optimize, 'compact': compact, 'os': with_os,
+               'intrinsics': sorted(intrinsics)}
+        return self._result(self.request(job), 'asm')
+
+    def _result(self, response, key):
+        if not response['ok']:
+            raise RuntimeError(response.get('error') or response['log'])
+        return response[key]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def main(argv):
+    socket_path = None
+    if argv[:1] == ['--socket']:
+        socket_path, argv = argv[1], argv[2:]
+    if not argv or argv[0] not in ('assemble', 'translate', 'status', 'shutdown'):
+        sys.stderr.write('usage: BuildClient.py [--socket PATH] {assemble,translate} ARGS... | status | shutdown\n'
+                         'Runs Assembler.py or VMtranslator.py with ARGS in BuildDaemon.py, or in this\n'
+                         'process if no server is running.\n')
+        return 2
+    try:
+        client = BuildClient(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if argv[0] in ('status', 'shutdown'):
+            sys.stderr.write(f'no build server is running on {socket_path or default_socket_path()}\n')
+            return 1
+        run_in_process(argv[0], argv[1:])
+        return 0
+    try:
+        if argv[0] in ('status', 'shutdown'):
+            response = client.request({'tool': argv[0]})
+            print(json.dumps(response, indent=2))
+        else:
+            response = client.run(argv[0], argv[1:])
+            sys.stdout.write(response['log'])
+            if 'error' in response:
+                sys.stderr.write(response['error'] + '\n')
+    finally:
+        client.close()
+    return 0 if response['ok'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
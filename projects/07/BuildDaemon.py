@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from glob import glob
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+import Assembler
+import VMtranslator
+from VMtranslator import (OS_DIR, CodeWriter, Parser, ParsedFiles, check_intrinsics, translate_file,
+                          translate_parsed, add_logging_args, log_level, set_log_level)
+from BuildClient import default_socket_path, server_is_running
+
+logger = logging.getLogger('BuildDaemon')
+
+# longest job or response line, which carries whole programs as text
+LINE_LIMIT = 64 * 1024 * 1024
+
+# the tools a job can run, as their command line modules
+TOOLS = {'assemble': Assembler, 'translate': VMtranslator}
+
+def warm_worker():
+    """Parse the tools/OS VM files into the worker's cache, so builds that use the OS start warm."""
+    VMtranslator.parsed_files = ParsedFiles()
+    for path in sorted(glob(os.path.join(OS_DIR, '*.vm'))):
+        VMtranslator.parse_file(path)
+
+def assemble_text(text):
+    """Assemble Hack assembly `text`, returning the program as .hack text."""
+    words, _ = Assembler.assemble(text.splitlines())
+    return ''.join(f'{word:016b}\n' for word in words)
+
+def translate_text(files, optimize=False, compact=False, with_os=False, intrinsics=()):
+    """Translate the VM code in `files`, a map from file names to text, returning the assembly.
+
+    With `with_os`, the tools/OS classes that `files` don't define come after them.
+    """
+    names = sorted(files)
+    libraries = []
+    if with_os:
+        libraries = [path for path in sorted(glob(os.path.join(OS_DIR, '*.vm')))
+                     if os.path.basename(path) not in files]
+    code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact,
+                             intrinsics=check_intrinsics(libraries, intrinsics))
+    code_writer.write_init()
+    for name in names:
+        translate_parsed(code_writer, Parser.from_text(files[name]), name)
+    for library in libraries:
+        translate_file(code_writer, library)
+    code_writer.finish()
+    return code_writer.outfile.getvalue()
+
+def run_command_line(tool, argv, cwd):
+    """Run `tool` as if from the command line `argv` in the directory `cwd`."""
+    worker_cwd = os.getcwd()
+    os.chdir(cwd)
+    try:
+        arg_parser = TOOLS[tool].build_arg_parser()
+        arg_parser.prog = os.path.basename(TOOLS[tool].__file__)
+        args = arg_parser.parse_args(argv)
+        logging.getLogger().setLevel(log_level(args))
+        TOOLS[tool].run(args)
+    finally:
+        os.chdir(worker_cwd)
+    return {}
+
+def run_job(job):
+    """Run one job in a worker process, returning the response to send back.
+
+    A job names its `tool` and gives either the `argv` and `cwd` of a
+    command line, or the program as text: `text` to assemble, or `files`
+    to translate. Everything the tool logs or prints is returned as `log`.
+    """
+    start = time.perf_counter()
+    output = io.StringIO()
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    response = {'ok': True}
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            tool = job.get('tool')
+            if tool not in TOOLS:
+                raise ValueError(f'unknown tool {tool!r}')
+            if 'argv' in job:
+                response.update(run_command_line(tool, job['argv'], job.get('cwd', os.getcwd())))
+            elif tool == 'assemble':
+                response['hack'] = assemble_text(job['text'])
+            else:
+                response['asm'] = translate_text(job['files'], job.get('optimize', False), job.get('compact', False),
+                                                 job.get('os', False), job.get('intrinsics', ()))
+    except SystemExit as e:
+        # argparse exits on bad arguments and after --help
+        response['ok'] = e.code in (None, 0)
+    except Exception as e:
+        response['ok'] = False
+        response['error'] = f'{type(e).__name__}: {e}'
+    response['log'] = output.getvalue()
+    response['seconds'] = time.perf_counter() - start
+    return response
+
+class BuildServer(object):
+    """Serves build jobs over a Unix domain socket, one JSON object per line each way.
+
+    Jobs run in a pool of worker processes that keep the tools imported and
+    the files they have parsed, tools/OS first of all, between jobs. The
+    tables the tools build on import, such as the predefined symbols and
+    the encodings of `comp()`, stay warm too, but each program still gets a
+    SymbolTable of its own, as its symbols mean nothing to the next. Each
+    connection can send any number of jobs, and connections are served at
+    once, up to the number of workers. Besides the tools' jobs, a `status`
+    job reports what the server has done and `shutdown` stops it.
+    """
+    def __init__(self, socket_path, workers=None):
+        self.socket_path = socket_path
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker)
+        self.jobs = 0
+        self.failures = 0
+        self.started = time.time()
+        self.stopped = None
+        # the open connections, and the tasks serving them
+        self.writers = set()
+        self.handlers = set()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self.writers.add(writer)
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    response = {'ok': False, 'error': f'not a JSON job: {e}'}
+                else:
+                    response = await self.respond(job, loop)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    # the client hung up, or the server closed the connection to shut down
+                    break
+        finally:
+            self.writers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def respond(self, job, loop):
+        tool = job.get('tool') if isinstance(job, dict) else None
+        if tool == 'status':
+            return {'ok': True, 'jobs': self.jobs, 'failures': self.failures,
+                    'uptime': time.time() - self.started, 'pid': os.getpid()}
+        if tool == 'shutdown':
+            self.stopped.set()
+            return {'ok': True}
+        if tool is None:
+            return {'ok': False, 'error': 'a job must be an object naming its tool'}
+        response = await loop.run_in_executor(self.pool, run_job, job)
+        self.jobs += 1
+        self.failures += not response['ok']
+        logger.info('%s job %d %s in %.3fs', tool, self.jobs, 'done' if response['ok'] else 'failed',
+                    response['seconds'])
+        return response
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        if os.path.exists(self.socket_path):
+            if server_is_running(self.socket_path):
+                self.pool.shutdown()
+                raise RuntimeError(f'a build server is already serving on {self.socket_path}')
+            # left by a server that didn't shut down
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path, limit=LINE_LIMIT)
+        inode = os.stat(self.socket_path).st_ino
+        logger.info('serving on %s', self.socket_path)
+        try:
+            async with server:
+                await self.stopped.wait()
+                server.close()
+                # closing a connection ends its handler once any job it is running is done
+                for writer in list(self.writers):
+                    writer.close()
+                await asyncio.gather(*self.handlers)
+        finally:
+            # unless a server started since has taken the path over
+            if os.path.exists(self.socket_path) and os.stat(self.socket_path).st_ino == inode:
+                os.unlink(self.socket_path)
+            self.pool.shutdown()
+        logger.info('served %d jobs, %d failed', self.jobs, self.failures)
+
+def main(socket_path, workers=None):
+    server = BuildServer(socket_path, workers)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        logger.error('%s', e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Serve Assembler.py and VMtranslator.py jobs from warm worker processes; see BuildClient.py.')
+    arg_parser.add_argument('--socket', default=default_socket_path(), help='Unix domain socket to listen on.')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=0,
+                            help='Run this many jobs at once, each in its own process; 0 uses every core.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    sys.exit(main(args.socket, workers=args.jobs or None))
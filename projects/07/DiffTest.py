@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from itertools import chain
+import io
+import logging
+import os
+import random
+import sys
+import tempfile
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+from Assembler import assemble
+from CPUEmulator import CPU, KBD
+from VMEmulator import STACK_BASE, VMEmulator
+from VMtranslator import (INTRINSICS, OS_DIR, CodeWriter, Op, Parser, WRITERS, check_infiles, check_intrinsics,
+                          translate_file, add_logging_args, set_log_level)
+
+logger = logging.getLogger('DiffTest')
+
+HEAP_BASE = 2048
+# R13-R15 are scratch registers for the translated code
+REGISTERS_END = 13
+# compare the whole of RAM at every this many returns, and the stack and statics at every one
+FULL_EVERY = 256
+
+class Stop(Exception):
+    pass
+
+def frame_slots(ram):
+    """Addresses of the saved return addresses of the frames on the stack.
+
+    These hold ROM addresses in translated code and call numbers in the
+    VM emulator, so they are left out of comparisons.
+    """
+    slots = set()
+    sp, lcl = ram[0], ram[1]
+    while STACK_BASE + 5 <= lcl <= sp and len(slots) < sp:
+        slots.add(lcl - 5)
+        caller = ram[lcl - 4]
+        if caller >= lcl:
+            break
+        lcl = caller
+    return slots
+
+def snapshot(ram, statics, full, stack=True):
+    """Return `(addresses, values)` for the parts of `ram` compared at a checkpoint.
+
+    `statics` lists the RAM address of each static variable in the VM
+    emulator's order, so snapshots of both machines line up. `addresses` is
+    a list of ranges in the VM emulator's layout. The stack comes last, so
+    the rest still lines up when the stacks are different heights.
+    """
+    first = 0 if stack else 5
+    addresses = [range(first, REGISTERS_END), range(16, 16 + len(statics))]
+    values = array('h', ram[first:REGISTERS_END])
+    values.extend(ram[address] for address in statics)
+    if full:
+        addresses.append(range(HEAP_BASE, KBD + 1))
+        values.extend(ram[HEAP_BASE:KBD + 1])
+    if stack:
+        sp = max(STACK_BASE, min(ram[0], HEAP_BASE))
+        masked = frame_slots(ram)
+        addresses.append(range(STACK_BASE, sp))
+        values.extend(0 if address in masked else ram[address] for address in range(STACK_BASE, sp))
+    return addresses, values
+
+def digest(values):
+    return hashlib.blake2b(values.tobytes(), digest_size=16).hexdigest()
+
+def pack(state):
+    addresses, values = state
+    return addresses, zlib.compress(values.tobytes(), 1)
+
+def unpack(packed):
+    addresses, data = packed
+    values = array('h')
+    values.frombytes(zlib.decompress(data))
+    return addresses, values
+
+class Recorder(object):
+    """Collects the checkpoints of one run as `(kind, name, digest)` triples.
+
+    Every function return is a checkpoint. For returns numbered from
+    `window[0]` up to `window[1]` the full snapshots are kept, and with
+    `labels` set, every label reached in that window is a checkpoint too.
+    Elsewhere only a digest of each snapshot is kept.
+
+    With `trace_until` set, the run is traced from the checkpoint before
+    that one: `trace` gets a packed full snapshot before each command, and
+    one more when the run gets to checkpoint `trace_until`, which raises
+    Stop.
+    """
+    def __init__(self, statics, window=None, labels=False, trace_until=None):
+        self.statics = statics
+        self.window = window
+        self.labels = labels
+        self.trace_until = trace_until
+        self.returns = 0
+        self.checkpoints = []
+        self.snapshots = {}
+        self.trace = []
+
+    def in_window(self):
+        return self.window is not None and self.window[0] <= self.returns <= self.window[1]
+
+    def wants_labels(self):
+        return self.labels and self.in_window()
+
+    def tracing(self):
+        return len(self.checkpoints) == self.trace_until
+
+    def record(self, ram, kind, name):
+        if self.tracing():
+            self.trace.append((None, pack(snapshot(ram, self.statics, True))))
+            raise Stop()
+        if kind == 'return':
+            self.returns += 1
+        keep = self.in_window()
+        addresses, values = snapshot(ram, self.statics, keep or self.returns % FULL_EVERY == 0)
+        if keep:
+            self.snapshots[len(self.checkpoints)] = (addresses, values)
+        self.checkpoints.append((kind, name, digest(values)))
+
+    def record_command(self, ram, where):
+        self.trace.append((where, pack(snapshot(ram, self.statics, True))))
+
+class Run(object):
+    """The checkpoints of one run, and the statics, heap and screen at its end.
+
+    `final` is None if the run was cut short by its budget.
+    """
+    def __init__(self, recorder, ram, stopped):
+        self.checkpoints = recorder.checkpoints
+        self.snapshots = recorder.snapshots
+        self.trace = recorder.trace
+        self.stopped = stopped
+        self.final = None if stopped else snapshot(ram, recorder.statics, True, stack=False)
+
+def static_addresses(vm):
+    return [address for _, address in sorted(vm.statics.items(), key=lambda item: item[1])]
+
+def run_reference(infiles, inputs, max_steps, window=None, labels=False, trace_until=None, intrinsics=()):
+    """Run `infiles` on the VM emulator's interpreter.
+
+    The trace is of `(function, cmd)` pairs; label commands are left out,
+    as they don't run any code once translated. A call to one of the
+    `intrinsics` is a single step once translated, so only its own return
+    is a checkpoint, and nothing it calls is traced.
+    """
+    vm = VMEmulator(infiles, compile=False)
+    recorder = Recorder(static_addresses(vm), window, labels, trace_until)
+    ram = vm.ram
+    for address, value in inputs.items():
+        ram[address] = value
+    # commands run since the last checkpoint; consecutive labels are one checkpoint
+    since = [0]
+    # the intrinsic being run, if any
+    inside = [None]
+
+    def on_return(name):
+        if inside[0] is not None:
+            if name != inside[0]:
+                return
+            inside[0] = None
+        recorder.record(ram, 'return', name)
+        since[0] = 0
+
+    def on_command(function, index):
+        if inside[0] is not None:
+            return
+        cmd = function.commands[index]
+        if cmd.op is Op.CALL and cmd.name in intrinsics and cmd.value == INTRINSICS[cmd.name][0]:
+            inside[0] = cmd.name
+        if cmd.op is Op.LABEL:
+            if since[0] and recorder.wants_labels():
+                recorder.record(ram, 'label', f'{function.name}${cmd.name}')
+                since[0] = 0
+            return
+        since[0] += 1
+        if recorder.tracing():
+            recorder.record_command(ram, (function, cmd))
+
+    vm.on_return = on_return
+    vm.on_command = on_command
+    try:
+        steps = vm.run(max_steps=max_steps)
+    except Stop:
+        return Run(recorder, ram, True)
+    return Run(recorder, ram, steps == max_steps and not vm.halted)
+
+def translate(infiles, optimize=False, compact=False, intrinsics=()):
+    """Translate `infiles` in memory, returning the assembly lines and where each command starts.
+
+    The starts map each command's `(file name, line)` to its first ROM
+    address. Commands are fused and rewritten under `optimize`, so then
+    there are none.
+    """
+    buffer = io.StringIO()
+    code_writer = CodeWriter(buffer, optimize=optimize, compact=compact, intrinsics=intrinsics)
+    code_writer.write_init()
+    offsets = []
+    for infile in infiles:
+        if optimize:
+            translate_file(code_writer, infile)
+            continue
+        parser = Parser(infile)
+        code_writer.set_file_name(infile)
+        file_name = os.path.basename(infile)[:-len('.vm')]
+        while parser.has_more_commands():
+            parser.advance()
+            cmd = parser.current_command
+            if cmd.op is not Op.LABEL and cmd.op is not Op.FUNCTION:
+                offsets.append((buffer.tell(), (file_name, cmd.line)))
+            WRITERS[cmd.op](code_writer, cmd, f'{file_name}_{parser.command_counter}')
+    code_writer.finish()
+    text = buffer.getvalue()
+    starts = {}
+    rom_address = 0
+    position = 0
+    for offset, where in offsets:
+        for line in text[position:offset].splitlines():
+            line = line.split('//')[0].strip()
+            if line and not line.startswith('('):
+                rom_address += 1
+        position = offset
+        starts[where] = rom_address
+    return text.splitlines(), starts
+
+def run_hack(infiles, inputs, max_cycles, optimize=False, compact=False, window=None, labels=False,
+             trace_until=None, intrinsics=()):
+    """Translate, assemble and run `infiles` on the CPU emulator.
+
+    A return lands on a `return_address_*` label and a VM label on its
+    scoped assembly label, so those ROM addresses are the checkpoints. The
+    trace is of the `(file name, line)` of each command, found by stopping
+    at the start of each. A call replaced by an intrinsic returns to an
+    `intrinsic_return_*` label, and the labels in the functions the
+    `intrinsics` replace are left out, as they are only reached when a
+    routine falls back to its function.
+    """
+    lines, starts = translate(infiles, optimize, compact, intrinsics)
+    words, sym_table = assemble(lines)
+    symbols = sym_table.table
+    vm = VMEmulator(infiles, compile=False)
+    statics = [symbols[f'{file_name}.{index}']
+               for (file_name, index), _ in sorted(vm.statics.items(), key=lambda item: item[1])]
+    recorder = Recorder(statics, window, labels, trace_until)
+    # the bootstrap's call never returns, and its return address may share Sys.init's
+    returns = {symbols[name] for name in symbols
+               if name.startswith('return_address_') and name != 'return_address_0'}
+    returns.update(symbols[name] for name in symbols if name.startswith('intrinsic_return_'))
+    function_starts = sorted(symbols[name] for name in vm.functions if name in symbols)
+    for name in intrinsics:
+        start = symbols[name]
+        end = next((entry for entry in function_starts if entry > start), len(words))
+        returns = {address for address in returns if not start <= address < end}
+    labels_at = {}
+    halts = set()
+    for function in vm.functions.values():
+        for i, cmd in enumerate(function.commands):
+            if cmd.op is Op.LABEL and function.name not in intrinsics:
+                labels_at.setdefault(symbols[f'{function.name}${cmd.name}'], f'{function.name}${cmd.name}')
+            elif function.is_halt_loop(i):
+                halts.add(symbols[f'{function.name}${function.commands[i - 1].name}'])
+    if 'Sys.halt' in symbols:
+        halts.add(symbols['Sys.halt'])
+    cpu = CPU(words)
+    if 'Sys.init' not in vm.functions:
+        # top-level code starts after the bootstrap's call and ends at the first function
+        start = symbols['return_address_0']
+        cpu.pc = start
+        entries = [symbols[name] for name in vm.functions if symbols.get(name, -1) > start]
+        halts.add(min(entries, default=len(words)))
+    for address, value in inputs.items():
+        cpu.ram[address] = value
+    commands_at = {address: where for where, address in starts.items()}
+    checkpoint_stops = returns | halts | set(labels_at)
+    trace_stops = checkpoint_stops | set(commands_at)
+    stopped = False
+    try:
+        while True:
+            tracing = recorder.tracing()
+            cpu.run(max_cycles=max_cycles - cpu.cycles, until=trace_stops if tracing else checkpoint_stops)
+            pc = cpu.pc
+            if cpu.cycles >= max_cycles:
+                stopped = True
+                break
+            if pc in returns:
+                # a label straight after a call shares its return address, and isn't a checkpoint of its own
+                recorder.record(cpu.ram, 'return', f'return_address at {pc}')
+            elif pc in labels_at and recorder.wants_labels():
+                recorder.record(cpu.ram, 'label', labels_at[pc])
+            if cpu.halted or pc in halts:
+                break
+            if pc in commands_at and recorder.tracing():
+                recorder.record_command(cpu.ram, commands_at[pc])
+            cpu.step()
+    except Stop:
+        stopped = True
+    return Run(recorder, cpu.ram, stopped)
+
+def same_checkpoint(expected, actual):
+    kind, name, value = expected
+    return kind == actual[0] and value == actual[2] and (kind == 'return' or name == actual[1])
+
+def first_mismatch(reference, hack):
+    for i, (expected, actual) in enumerate(zip(reference, hack)):
+        if not same_checkpoint(expected, actual):
+            return i
+    return None
+
+def differences(expected, actual, limit=8):
+    addresses, values = expected
+    _, other = actual
+    diffs = [(address, x, y) for address, x, y in zip(chain(*addresses), values, other) if x != y]
+    if len(values) != len(other) and not diffs:
+        # the stacks are different heights
+        diffs.append((0, values[0], other[0]))
+    return diffs[:limit]
+
+def format_diffs(diffs):
+    return ', '.join(f'RAM[{address}] VM={x} Hack={y}' for address, x, y in diffs) or 'control flow differs'
+
+def format_command(function, cmd):
+    return f'{function.file_name}.vm:{cmd.line} `{cmd.text}` in {function.name}'
+
+class DiffJob(object):
+    """One program and set of inputs to run both ways."""
+    def __init__(self, name, infiles, inputs, max_steps, max_cycles, optimize, compact, intrinsics=()):
+        self.name = name
+        self.infiles = infiles
+        self.inputs = inputs
+        self.max_steps = max_steps
+        self.max_cycles = max_cycles
+        self.optimize = optimize
+        self.compact = compact
+        self.intrinsics = check_intrinsics(infiles, intrinsics)
+
+    def reference(self, **kwargs):
+        return run_reference(self.infiles, self.inputs, self.max_steps, intrinsics=self.intrinsics, **kwargs)
+
+    def hack(self, **kwargs):
+        return run_hack(self.infiles, self.inputs, self.max_cycles, self.optimize, self.compact,
+                        intrinsics=self.intrinsics, **kwargs)
+
+def run_reference_job(job):
+    return job.reference()
+
+def run_hack_job(job):
+    return job.hack()
+
+def compare(job, reference, hack):
+    """Compare both runs of `job`, returning None or a description of the first divergence."""
+    index = first_mismatch(reference.checkpoints, hack.checkpoints)
+    if index is not None:
+        return locate(job, index, f'return {index} from {reference.checkpoints[index][1]} differs')
+    common = min(len(reference.checkpoints), len(hack.checkpoints))
+    shorter = reference if len(reference.checkpoints) == common else hack
+    if len(reference.checkpoints) != len(hack.checkpoints) and not shorter.stopped:
+        return locate(job, common, f'{len(reference.checkpoints)} returns on the VM '
+                                   f'but {len(hack.checkpoints)} on the CPU')
+    if reference.final is not None and hack.final is not None and reference.final[1] != hack.final[1]:
+        return f'memory differs at the end: {format_diffs(differences(reference.final, hack.final))}'
+    return None
+
+def locate(job, index, reason):
+    """Re-run `job` around its `index`th checkpoint to find the first divergent command.
+
+    Labels narrow the divergence down to a block, then both machines are
+    stepped through that block a command at a time, comparing all of RAM
+    before each. Under -O, or with intrinsics, the translated commands don't
+    line up with the VM's, so the last command to write a divergent address
+    is blamed instead.
+    """
+    window = (max(0, index - FULL_EVERY), index + 1)
+    reference = job.reference(window=window, labels=True)
+    hack = job.hack(window=window, labels=True)
+    lines = [reason]
+    checkpoint = first_mismatch(reference.checkpoints, hack.checkpoints)
+    if checkpoint is None and len(reference.checkpoints) != len(hack.checkpoints):
+        checkpoint = min(len(reference.checkpoints), len(hack.checkpoints))
+    if checkpoint is None or checkpoint not in reference.snapshots:
+        return '\n'.join(lines + ['the first divergent command could not be found'])
+    expected = reference.checkpoints[checkpoint]
+    actual = hack.checkpoints[checkpoint] if checkpoint < len(hack.checkpoints) else ('end', '', None)
+    if checkpoint in hack.snapshots:
+        diffs = format_diffs(differences(reference.snapshots[checkpoint], hack.snapshots[checkpoint]))
+    else:
+        diffs = 'the CPU stopped'
+    lines.append(f'first divergent checkpoint: {expected[0]} {expected[1]} on the VM, '
+                 f'{actual[0]} {actual[1]} on the CPU: {diffs}')
+    trace = job.reference(window=window, labels=True, trace_until=checkpoint).trace
+    if job.optimize or job.intrinsics:
+        culprit = last_writer(trace, reference.snapshots[checkpoint], hack.snapshots.get(checkpoint))
+    else:
+        hack_trace = job.hack(window=window, labels=True, trace_until=checkpoint).trace
+        culprit, diffs = first_divergent_command(trace, hack_trace)
+        if culprit is not None:
+            lines.append(f'RAM after it: {diffs}')
+    if culprit is not None:
+        lines.append(f'first divergent command: {format_command(*culprit)}')
+    return '\n'.join(lines)
+
+def first_divergent_command(reference, hack):
+    """Step through both traces together, returning the command after which they differ and how."""
+    for i, ((command, expected), (where, actual)) in enumerate(zip(reference, hack)):
+        if command is not None:
+            function, cmd = command
+            location = (function.file_name, cmd.line)
+        else:
+            location = None
+        if expected != actual or location != where:
+            if not i:
+                return None, None
+            if expected == actual:
+                diffs = f'the CPU went to {where[0]}.vm:{where[1]}' if where else 'the CPU got to a checkpoint'
+            else:
+                diffs = format_diffs(differences(unpack(expected), unpack(actual)))
+            return reference[i - 1][0], diffs
+    return None, None
+
+def last_writer(trace, expected, actual):
+    """Blame the last command to write an address that differs at the checkpoint.
+
+    If only control flow differs, blame the last jump.
+    """
+    divergent = set()
+    if actual is not None:
+        divergent = {address for address, _, _ in differences(expected, actual) if address != 0}
+    states = [unpack(packed) for _, packed in trace]
+    for i in range(len(trace) - 2, -1, -1):
+        function, cmd = trace[i][0]
+        before, after = states[i], states[i + 1]
+        if divergent:
+            changed = {address for address, _, _ in differences(before, after, limit=None)}
+            if divergent & changed:
+                return function, cmd
+        elif cmd.op in (Op.GOTO, Op.IF_GOTO):
+            return function, cmd
+    return trace[-2][0] if len(trace) > 1 else None
+
+def random_inputs(seed, first, last, low, high):
+    rng = random.Random(seed)
+    return {address: rng.randint(low, high) for address in range(first, last + 1)}
+
+class ProgramGenerator(object):
+    """Generates random terminating VM programs that exercise every command.
+
+    Functions only call functions defined after them and every loop runs a
+    fixed number of times, so programs always finish.
+    """
+    def __init__(self, seed, n_functions=6, max_statements=8):
+        self.rng = random.Random(seed)
+        self.n_functions = n_functions
+        self.max_statements = max_statements
+        # Sys.init calls f0 with no arguments
+        self.n_args = [0] + [self.rng.randint(0, 3) for _ in range(n_functions - 1)]
+        self.n_labels = 0
+
+    def files(self):
+        sys_lines = ['function Sys.init 0', 'call Main.f0 0', 'pop static 0', 'call Main.f0 0',
+                     'pop static 1', 'label HALT', 'goto HALT']
+        main_lines = []
+        for i in range(self.n_functions):
+            main_lines.extend(self.function(i))
+        return {'Sys.vm': '\n'.join(sys_lines) + '\n', 'Main.vm': '\n'.join(main_lines) + '\n'}
+
+    def function(self, i):
+        rng = self.rng
+        self.current = i
+        self.n_locals = rng.randint(1, 4)
+        lines = [f'function Main.f{i} {self.n_locals}']
+        # point this and that at heap blocks of our own
+        lines += [f'push constant {3000 + 64 * i}', 'pop pointer 0', f'push constant {6000 + 64 * i}', 'pop pointer 1']
+        for _ in range(rng.randint(1, self.max_statements)):
+            lines.extend(self.statement(depth=0))
+        lines.extend(self.expression(depth=0))
+        lines.append('return')
+        return lines
+
+    def label(self):
+        self.n_labels += 1
+        return f'L{self.n_labels}'
+
+    def target(self):
+        rng = self.rng
+        segment = rng.choice(['local', 'local', 'static', 'temp', 'this', 'that', 'argument'])
+        if segment == 'argument' and not self.n_args[self.current]:
+            segment = 'local'
+        count = {'local': self.n_locals, 'static': 6, 'temp': 8, 'this': 12, 'that': 12,
+                 'argument': self.n_args[self.current]}[segment]
+        if segment == 'local':
+            # local 0 counts loop iterations
+            if count == 1:
+                return 'temp 0'
+            return f'local {rng.randint(1, count - 1)}'
+        return f'{segment} {rng.randint(0, count - 1)}'
+
+    def statement(self, depth):
+        rng = self.rng
+        kind = rng.choice(['assign', 'assign', 'assign', 'if', 'loop'] if depth < 2 else ['assign'])
+        if kind == 'assign':
+            return self.expression(depth) + [f'pop {self.target()}']
+        if kind == 'if':
+            true, end = self.label(), self.label()
+            lines = self.expression(depth) + [f'if-goto {true}']
+            lines += [line for _ in range(rng.randint(0, 2)) for line in self.statement(depth + 1)]
+            lines += [f'goto {end}', f'label {true}']
+            lines += [line for _ in range(rng.randint(0, 2)) for line in self.statement(depth + 1)]
+            return lines + [f'label {end}']
+        top = self.label()
+        lines = [f'push constant {rng.randint(1, 3)}', 'pop local 0', f'label {top}']
+        lines += [line for _ in range(rng.randint(1, 3)) for line in self.statement(2)]
+        lines += ['push local 0', 'push constant 1', 'sub', 'pop local 0',
+                  'push local 0', 'push constant 0', 'gt', f'if-goto {top}']
+        return lines
+
+    def expression(self, depth):
+        rng = self.rng
+        choice = rng.random()
+        if depth > 2 or choice < 0.35:
+            if rng.random() < 0.5:
+                return [f'push constant {rng.choice([0, 1, 2, 7, 255, 32767, rng.randint(0, 32767)])}']
+            return [f'push {self.target()}']
+        if choice < 0.5:
+            return self.expression(depth + 1) + [rng.choice(['neg', 'not'])]
+        callees = range(self.current + 1, self.n_functions)
+        if choice < 0.6 and callees:
+            callee = rng.choice(callees)
+            lines = []
+            for _ in range(self.n_args[callee]):
+                lines.extend(self.expression(depth + 1))
+            return lines + [f'call Main.f{callee} {self.n_args[callee]}']
+        op = rng.choice(['add', 'sub', 'and', 'or', 'eq', 'gt', 'lt'])
+        return self.expression(depth + 1) + self.expression(depth + 1) + [op]
+
+class IntrinsicProgramGenerator(object):
+    """Generates programs that call the tools/OS functions that have intrinsics, with awkward arguments.
+
+    The programs run on the OS's own Array, Math and Memory classes, and
+    keep each result in a static variable, so every call is checked at its
+    return. A Sys class of their own starts them, and halts on any error.
+    Only the `intrinsics` are called.
+    """
+    OS_FILES = ['Array.vm', 'Math.vm', 'Memory.vm']
+    EDGE_VALUES = [0, 1, -1, 2, -2, 3, 181, -181, 255, 256, 32767, -32767, -32768]
+    N_RESULTS = 8
+    N_BLOCKS = 6
+
+    def __init__(self, seed, intrinsics, n_calls=60):
+        self.rng = random.Random(seed)
+        self.kinds = sorted(name.split('.')[1] for name in intrinsics)
+        self.n_calls = n_calls
+
+    def files(self):
+        sys_lines = ['function Sys.init 0', 'call Memory.init 0', 'pop temp 0', 'call Math.init 0', 'pop temp 0',
+                     'call Main.main 0', 'pop temp 0', 'label HALT', 'goto HALT',
+                     'function Sys.error 0', 'label HALT', 'goto HALT']
+        return {'Sys.vm': '\n'.join(sys_lines) + '\n', 'Main.vm': '\n'.join(self.main()) + '\n'}
+
+    def os_files(self):
+        return [os.path.join(OS_DIR, name) for name in self.OS_FILES]
+
+    def value(self, nonzero=False):
+        rng = self.rng
+        while True:
+            if rng.random() < 0.4:
+                value = rng.choice(self.EDGE_VALUES)
+            else:
+                value = rng.randint(-32768, 32767) >> rng.choice([0, 4, 8, 12])
+            if value or not nonzero:
+                return value
+
+    def push(self, value):
+        if value == -32768:
+            return ['push constant 32767', 'neg', 'push constant 1', 'sub']
+        if value < 0:
+            return [f'push constant {-value}', 'neg']
+        return [f'push constant {value}']
+
+    def main(self):
+        rng = self.rng
+        lines = ['function Main.main 0']
+        # the static each block pointer is kept in, after the results
+        blocks = [None] * self.N_BLOCKS
+        for _ in range(self.n_calls):
+            kind = rng.choice(self.kinds)
+            if kind == 'alloc':
+                slot = rng.randrange(self.N_BLOCKS)
+                if blocks[slot] is not None:
+                    lines += [f'push static {self.N_RESULTS + slot}', 'call Memory.deAlloc 1', 'pop temp 0']
+                blocks[slot] = rng.choice([1, 2, 3, rng.randint(1, 400)])
+                lines += self.push(blocks[slot])
+                lines += ['call Memory.alloc 1', f'pop static {self.N_RESULTS + slot}']
+                continue
+            lines += self.push(self.value())
+            lines += self.push(self.value(nonzero=kind == 'divide'))
+            lines += [f'call Math.{kind} 2', f'pop static {rng.randrange(self.N_RESULTS)}']
+        return lines + ['push constant 0', 'return']
+
+def write_program(directory, files):
+    os.makedirs(directory, exist_ok=True)
+    for name, text in files.items():
+        with open(os.path.join(directory, name), mode='w') as f:
+            f.write(text)
+    return [os.path.join(directory, name) for name in sorted(files)]
+
+def run_jobs(jobs, n_workers):
+    """Run both sides of every job across a process pool, returning each job's divergence or None."""
+    if n_workers == 1:
+        results = [(job.reference(), job.hack()) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers or None) as pool:
+            references = pool.map(run_reference_job, jobs)
+            hacks = pool.map(run_hack_job, jobs)
+            results = list(zip(references, hacks))
+    return [compare(job, reference, hack) for job, (reference, hack) in zip(jobs, results)]
+
+def main(paths, seeds=1, randomize=None, value_range=(-32768, 32767), fuzz=0, optimize=False,
+         compact=False, max_steps=1000000, max_cycles=50000000, n_workers=1, intrinsics=(), fuzz_intrinsics=0):
+    jobs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if paths:
+            infiles = check_infiles(paths)
+            for seed in range(seeds):
+                inputs = random_inputs(seed, *randomize, *value_range) if randomize else {}
+                jobs.append(DiffJob(f'seed {seed}', infiles, inputs, max_steps, max_cycles, optimize, compact,
+                                    intrinsics))
+        for seed in range(fuzz):
+            infiles = write_program(os.path.join(workdir, f'fuzz{seed}'), ProgramGenerator(seed).files())
+            jobs.append(DiffJob(f'fuzz {seed}', infiles, {}, max_steps, max_cycles, optimize, compact,
+                                intrinsics))
+        for seed in range(fuzz_intrinsics):
+            generator = IntrinsicProgramGenerator(seed, intrinsics or INTRINSICS)
+            infiles = write_program(os.path.join(workdir, f'intrinsics{seed}'), generator.files())
+            jobs.append(DiffJob(f'intrinsics {seed}', infiles + generator.os_files(), {}, max_steps, max_cycles,
+                                optimize, compact, intrinsics or INTRINSICS))
+        failures = 0
+        for job, divergence in zip(jobs, run_jobs(jobs, n_workers)):
+            if divergence is None:
+                logger.debug('ok %s', job.name)
+                continue
+            failures += 1
+            logger.warning('%s diverged:\n%s', job.name, divergence)
+            if job.name.startswith(('fuzz', 'intrinsics')):
+                for infile in job.infiles[:2]:
+                    with open(infile) as f:
+                        logger.info('%s:\n%s', os.path.basename(infile), f.read())
+    logger.info('%d of %d runs diverged', failures, len(jobs))
+    return failures
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Run VM programs on the VM emulator and as translated Hack code, and compare the RAM.')
+    arg_parser.add_argument('infiles', nargs='*', help='File(s) or directory to test.')
+    arg_parser.add_argument('--seeds', type=int, default=1, help='Number of random inputs to try.')
+    arg_parser.add_argument('--randomize', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                            help='Fill RAM[FIRST..LAST] with random values before each run.')
+    arg_parser.add_argument('--range', type=int, nargs=2, default=(-32768, 32767), metavar=('LOW', 'HIGH'),
+                            help='Range of the random values.')
+    arg_parser.add_argument('--fuzz', type=int, default=0, help='Also test this many generated programs.')
+    arg_parser.add_argument('-O', '--optimize', action='store_true', help='Translate with -O.')
+    arg_parser.add_argument('--compact', action='store_true', help='Translate with --compact.')
+    arg_parser.add_argument('--intrinsic', action='append', choices=sorted(INTRINSICS) + ['all'], default=[],
+                            help='Translate with --intrinsic; may be repeated.')
+    arg_parser.add_argument('--fuzz-intrinsics', type=int, default=0,
+                            help='Also test this many generated programs that call the tools/OS functions with '
+                                 'intrinsics, using the --intrinsic ones or else all of them.')
+    arg_parser.add_argument('--steps', type=int, default=1000000, help='VM command budget per run.')
+    arg_parser.add_argument('--cycles', type=int, default=50000000, help='CPU cycle budget per run.')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes; 0 uses every core.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    intrinsics = set(INTRINSICS) if 'all' in args.intrinsic else set(args.intrinsic)
+    failures = main(args.infiles, seeds=args.seeds, randomize=args.randomize, value_range=args.range,
+                    fuzz=args.fuzz, optimize=args.optimize, compact=args.compact, max_steps=args.steps,
+                    max_cycles=args.cycles, n_workers=args.jobs, intrinsics=intrinsics,
+                    fuzz_intrinsics=args.fuzz_intrinsics)
+    sys.exit(1 if failures else 0)
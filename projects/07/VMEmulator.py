@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+from array import array
+import argparse
+from glob import glob
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+from CPUEmulator import RAM_SIZE, wrap
+from VMtranslator import OS_DIR, Op, Parser, Segment, check_infiles, add_logging_args, set_log_level
+
+logger = logging.getLogger('VMEmulator')
+
+SP, LCL, ARG, THIS, THAT = range(5)
+STACK_BASE = 256
+# calling any of these stops the machine, as the OS's own halt loop never returns
+HALT_FUNCTIONS = {'Sys.halt'}
+# segments addressed from a fixed base
+FIXED_BASES = {Segment.POINTER: 3, Segment.TEMP: 5}
+
+class Halt(Exception):
+    pass
+
+class StepLimit(Exception):
+    pass
+
+class Function(object):
+    """The commands of one VM function, or of a file's code outside any function.
+
+    `n_locals` is None for top-level code, which runs on whatever frame the
+    RAM already holds instead of being called.
+    """
+    def __init__(self, name, file_name, n_locals, commands):
+        self.name = name
+        self.file_name = file_name
+        self.n_locals = n_locals
+        self.commands = commands
+        self.labels = {cmd.name: i for i, cmd in enumerate(commands) if cmd.op is Op.LABEL}
+        for cmd in commands:
+            if cmd.op in (Op.GOTO, Op.IF_GOTO):
+                assert cmd.name in self.labels, f'Unknown label {cmd.name} in {name}.'
+
+    def is_halt_loop(self, index):
+        """True if the goto at `index` jumps straight back to the label before it."""
+        cmd = self.commands[index]
+        return cmd.op is Op.GOTO and self.labels[cmd.name] == index - 1
+
+class VMEmulator(object):
+    """Headless VM that runs parsed .vm files on a Hack-style RAM.
+
+    Memory follows the standard mapping: SP, LCL, ARG, THIS and THAT in
+    RAM[0..4], temp at 5, statics from 16 in order of first reference across
+    the files, the stack from 256. Frames are laid out in RAM exactly as the
+    translated code lays them out, except that the saved return address is
+    the number of the call rather than a ROM address.
+
+    By default each function is compiled to Python source on its first call:
+    every basic block becomes straight-line code with pushes and pops resolved
+    to locals where possible, so only jumps, calls and returns go through
+    the RAM stack. With `compile=False` every command is interpreted in turn.
+    Cells above SP may hold different garbage in the two modes.
+
+    `on_return(name)` and, when interpreting, `on_command(function, index)`
+    are called if set.
+    """
+    def __init__(self, infiles, compile=True):
+        self.compile = compile
+        self.functions = {}
+        self.function_order = []
+        self.toplevel = []
+        self.statics = {}
+        self.compiled = {}
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+        self.on_return = None
+        self.on_command = None
+        self.calls = 0
+        for infile in infiles:
+            self._load(infile)
+        self.reset()
+
+    @classmethod
+    def from_paths(cls, paths, with_os=False, compile=True):
+        """Load a directory or list of .vm files, adding any tools/OS class they don't define."""
+        infiles = check_infiles(paths)
+        if with_os:
+            defined = {os.path.basename(infile) for infile in infiles}
+            infiles = infiles + [path for path in sorted(glob(os.path.join(OS_DIR, '*.vm')))
+                                 if os.path.basename(path) not in defined]
+        return cls(infiles, compile=compile)
+
+    def _load(self, infile):
+        file_name = os.path.basename(infile)[:-len('.vm')]
+        parser = Parser(infile)
+        name, n_locals, commands = None, None, []
+        for cmd in parser.commands:
+            if cmd.op is Op.FUNCTION:
+                self._add_function(name, file_name, n_locals, commands)
+                name, n_locals, commands = cmd.name, cmd.value, []
+                continue
+            if cmd.segment is Segment.STATIC:
+                self.static_address(file_name, cmd.value)
+            commands.append(cmd)
+        self._add_function(name, file_name, n_locals, commands)
+
+    def _add_function(self, name, file_name, n_locals, commands):
+        if name is None:
+            if commands:
+                self.toplevel.append(Function(f'{file_name}$top', file_name, None, commands))
+            return
+        assert name not in self.functions, f'Function {name} is defined twice.'
+        self.functions[name] = Function(name, file_name, n_locals, commands)
+        self.function_order.append(name)
+
+    def static_address(self, file_name, index):
+        # allocated in order of first reference, as the assembler allocates variables
+        key = (file_name, index)
+        if key not in self.statics:
+            self.statics[key] = 16 + len(self.statics)
+        return self.statics[key]
+
+    def reset(self):
+        self.steps = 0
+        self.max_steps = -1
+        self.halted = False
+
+    def run(self, max_steps=None):
+        """Bootstrap and call Sys.init, as the translated code does.
+
+        Without Sys.init, runs the top-level code of each file in order, or if
+        there is none, the first function on the frame already in RAM, as the
+        book's VM emulator does. Stops on halt, when the entry point returns or
+        once `max_steps` commands have run. Returns the number of commands
+        executed by this call.
+        """
+        if 'Sys.init' in self.functions:
+            self.ram[SP] = STACK_BASE
+            return self._run(lambda: self.call('Sys.init', 0), max_steps)
+
+        def run_toplevel():
+            if not self.toplevel:
+                self._invoke(self.functions[self.function_order[0]])
+            for function in self.toplevel:
+                self._invoke(function)
+        return self._run(run_toplevel, max_steps)
+
+    def run_function(self, name, *args, max_steps=None):
+        """Push `args`, call `name` on the current stack and return the value it returns."""
+        ram = self.ram
+        if not ram[SP]:
+            ram[SP] = STACK_BASE
+        for arg in args:
+            ram[ram[SP]] = wrap(arg)
+            ram[SP] += 1
+        self._run(lambda: self.call(name, len(args)), max_steps)
+        ram[SP] -= 1
+        return ram[ram[SP]]
+
+    def _run(self, entry, max_steps):
+        start = self.steps
+        self.max_steps = -1 if max_steps is None else start + max_steps
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 20000))
+        try:
+            entry()
+        except Halt:
+            self.halted = True
+        except StepLimit:
+            pass
+        finally:
+            sys.setrecursionlimit(limit)
+        return self.steps - start
+
+    def call(self, name, n_args):
+        """Push a frame for `name` as `call name n_args` does and run it until it returns."""
+        if name in HALT_FUNCTIONS:
+            raise Halt(name)
+        if name not in self.functions:
+            raise NameError(f'Function {name} is not defined.')
+        if self.max_steps >= 0 and self.steps >= self.max_steps:
+            raise StepLimit()
+        ram = self.ram
+        sp = ram[SP]
+        self.calls += 1
+        ram[sp] = self.calls & 0x7FFF
+        ram[sp + 1] = ram[LCL]
+        ram[sp + 2] = ram[ARG]
+        ram[sp + 3] = ram[THIS]
+        ram[sp + 4] = ram[THAT]
+        sp += 5
+        ram[ARG] = sp - n_args - 5
+        ram[LCL] = sp
+        ram[SP] = sp
+        self._invoke(self.functions[name])
+
+    def _invoke(self, function):
+        if not self.compile:
+            return self._interpret(function)
+        code = self.compiled.get(function.name)
+        if code is None:
+            code = self.compiled[function.name] = self._compile(function)
+        code()
+
+    def _address(self, function, segment, index):
+        ram = self.ram
+        if segment is Segment.LOCAL:
+            return ram[LCL] + index
+        elif segment is Segment.ARGUMENT:
+            return ram[ARG] + index
+        elif segment is Segment.THIS:
+            return ram[THIS] + index
+        elif segment is Segment.THAT:
+            return ram[THAT] + index
+        elif segment is Segment.STATIC:
+            return self.static_address(function.file_name, index)
+        return FIXED_BASES[segment] + index
+
+    def _interpret(self, function):
+        ram = self.ram
+        commands = function.commands
+        n_commands = len(commands)
+        if function.n_locals:
+            sp = ram[SP]
+            for i in range(function.n_locals):
+                ram[sp + i] = 0
+            ram[SP] = sp + function.n_locals
+        pc = 0
+        while pc < n_commands:
+            if self.steps == self.max_steps:
+                raise StepLimit()
+            if self.on_command is not None:
+                self.on_command(function, pc)
+            cmd = commands[pc]
+            op = cmd.op
+            self.steps += 1
+            pc += 1
+            if op is Op.PUSH:
+                if cmd.segment is Segment.CONSTANT:
+                    value = cmd.value
+                else:
+                    value = ram[self._address(function, cmd.segment, cmd.value)]
+                ram[ram[SP]] = value
+                ram[SP] += 1
+            elif op is Op.POP:
+                ram[SP] -= 1
+                ram[self._address(function, cmd.segment, cmd.value)] = ram[ram[SP]]
+            elif op is Op.NEG or op is Op.NOT:
+                top = ram[SP] - 1
+                ram[top] = wrap(-ram[top]) if op is Op.NEG else ~ram[top]
+            elif op in BINARY_FUNCS:
+                ram[SP] -= 1
+                top = ram[SP] - 1
+                ram[top] = BINARY_FUNCS[op](ram[top], ram[top + 1])
+            elif op is Op.LABEL:
+                pass
+            elif op is Op.GOTO:
+                if function.is_halt_loop(pc - 1):
+                    raise Halt(function.name)
+                pc = function.labels[cmd.name]
+            elif op is Op.IF_GOTO:
+                ram[SP] -= 1
+                if ram[ram[SP]]:
+                    pc = function.labels[cmd.name]
+            elif op is Op.CALL:
+                self.call(cmd.name, cmd.value)
+            elif op is Op.RETURN:
+                self._return()
+                if self.on_return is not None:
+                    self.on_return(function.name)
+                return
+            else:
+                raise SyntaxError(f'Invalid command: {cmd.text}')
+
+    def _return(self):
+        ram = self.ram
+        frame = ram[LCL]
+        arg = ram[ARG]
+        ram[arg] = ram[ram[SP] - 1]
+        ram[SP] = arg + 1
+        ram[THAT] = ram[frame - 1]
+        ram[THIS] = ram[frame - 2]
+        ram[ARG] = ram[frame - 3]
+        ram[LCL] = ram[frame - 4]
+
+    def _compile(self, function):
+        source = FunctionCompiler(self, function).source()
+        logger.debug('compiled %s:\n%s', function.name, source)
+        namespace = {}
+        exec(compile(source, f'<vm {function.name}>', 'exec'), namespace)
+        return namespace['make'](self, self.ram, self.call, Halt, StepLimit)
+
+BINARY_FUNCS = {
+    Op.ADD: lambda x, y: wrap(x + y),
+    Op.SUB: lambda x, y: wrap(x - y),
+    Op.AND: lambda x, y: x & y,
+    Op.OR: lambda x, y: x | y,
+    Op.EQ: lambda x, y: -(x == y),
+    Op.GT: lambda x, y: -(x > y),
+    Op.LT: lambda x, y: -(x < y)
+}
+# Python expressions for the same operations in compiled code
+BINARY_EXPRS = {
+    Op.ADD: '(({x} + {y} + 32768) & 65535) - 32768',
+    Op.SUB: '(({x} - {y} + 32768) & 65535) - 32768',
+    Op.AND: '{x} & {y}',
+    Op.OR: '{x} | {y}',
+    Op.EQ: '-({x} == {y})',
+    Op.GT: '-({x} > {y})',
+    Op.LT: '-({x} < {y})'
+}
+UNARY_EXPRS = {
+    Op.NEG: '((32768 - {x}) & 65535) - 32768',
+    Op.NOT: '~{x}'
+}
+
+class FunctionCompiler(object):
+    """Generates the Python source of one VM function for VMEmulator.
+
+    The function body is a loop over basic blocks, numbered in order and
+    selected by `b`; a block that doesn't jump sets `b` to the next block and
+    falls into its `if`. Within a block, pushed values are kept in locals and
+    only written to the RAM stack before a jump, call or the end of the
+    block. SP, LCL and ARG are held in locals, so programs that write them
+    through the pointer segments aren't supported. Commands are counted per
+    block and checked against the step limit on backward jumps and calls.
+    """
+    def __init__(self, vm, function):
+        self.vm = vm
+        self.function = function
+        self.lines = []
+        self.indent = 0
+        self.stack = []
+        self.n_temps = 0
+        self.pending_steps = 0
+        commands = function.commands
+        starts = {0}
+        for i, cmd in enumerate(commands):
+            if cmd.op is Op.LABEL:
+                starts.add(i)
+            elif cmd.op in (Op.GOTO, Op.IF_GOTO, Op.RETURN) and i + 1 < len(commands):
+                starts.add(i + 1)
+        # block number of each command that starts a block
+        self.block_starts = {start: block for block, start in enumerate(sorted(starts))}
+
+    def emit(self, line):
+        self.lines.append(' ' * self.indent + line)
+
+    def temp(self, expr):
+        name = f't{self.n_temps}'
+        self.n_temps += 1
+        self.emit(f'{name} = {expr}')
+        return name
+
+    def pop_value(self):
+        if self.stack:
+            return self.stack.pop()
+        self.emit('sp -= 1')
+        return self.temp('ram[sp]')
+
+    def flush(self):
+        for i, value in enumerate(self.stack):
+            self.emit(f'ram[sp + {i}] = {value}' if i else f'ram[sp] = {value}')
+        if self.stack:
+            self.emit(f'sp += {len(self.stack)}')
+        self.stack = []
+
+    def count_steps(self, check=False):
+        if self.pending_steps:
+            self.emit(f'steps += {self.pending_steps}')
+            self.pending_steps = 0
+        if check:
+            self.emit('vm.steps += steps')
+            self.emit('steps = 0')
+            self.emit('if limit >= 0 and vm.steps >= limit:')
+            self.emit('    ram[0] = sp')
+            self.emit('    raise StepLimit()')
+
+    def address(self, segment, index):
+        if segment is Segment.LOCAL:
+            return f'lcl + {index}' if index else 'lcl'
+        elif segment is Segment.ARGUMENT:
+            return f'arg + {index}' if index else 'arg'
+        elif segment is Segment.THIS:
+            return f'ram[3] + {index}' if index else 'ram[3]'
+        elif segment is Segment.THAT:
+            return f'ram[4] + {index}' if index else 'ram[4]'
+        elif segment is Segment.STATIC:
+            return str(self.vm.static_address(self.function.file_name, index))
+        return str(FIXED_BASES[segment] + index)
+
+    def jump(self, target, from_index):
+        self.count_steps(check=target <= from_index)
+        self.emit(f'b = {self.block_starts[target]}')
+        self.emit('continue')
+
+    def source(self):
+        function = self.function
+        commands = function.commands
+        self.emit('def make(vm, ram, call, Halt, StepLimit):')
+        self.indent = 4
+        self.emit('def run():')
+        self.indent = 8
+        self.emit('sp = ram[0]')
+        self.emit('lcl = ram[1]')
+        self.emit('arg = ram[2]')
+        self.emit('limit = vm.max_steps')
+        self.emit('steps = 0')
+        for i in range(function.n_locals or 0):
+            self.emit(f'ram[sp + {i}] = 0' if i else 'ram[sp] = 0')
+        if function.n_locals:
+            self.emit(f'sp += {function.n_locals}')
+        self.emit('b = 0')
+        self.emit('while True:')
+        for index, cmd in enumerate(commands):
+            if index in self.block_starts:
+                block = self.block_starts[index]
+                if index and commands[index - 1].op not in (Op.GOTO, Op.RETURN):
+                    # fall through from the block before
+                    self.flush()
+                    self.count_steps()
+                    self.emit(f'b = {block}')
+                self.indent = 12
+                self.emit(f'if b == {block}:')
+                self.indent = 16
+            self.pending_steps += 1
+            self.command(index, cmd)
+        if commands and commands[-1].op not in (Op.GOTO, Op.RETURN):
+            self.flush()
+            self.count_steps()
+            self.emit(f'b = {len(self.block_starts)}')
+        # only reached by falling off the end, as top-level code does
+        self.indent = 12
+        self.emit('vm.steps += steps')
+        self.emit('ram[0] = sp')
+        self.emit('return')
+        self.indent = 4
+        self.emit('return run')
+        return '\n'.join(self.lines) + '\n'
+
+    def command(self, index, cmd):
+        op = cmd.op
+        if op is Op.PUSH:
+            if cmd.segment is Segment.CONSTANT:
+                self.stack.append(str(cmd.value))
+            else:
+                self.stack.append(self.temp(f'ram[{self.address(cmd.segment, cmd.value)}]'))
+        elif op is Op.POP:
+            value = self.pop_value()
+            self.emit(f'ram[{self.address(cmd.segment, cmd.value)}] = {value}')
+        elif op in UNARY_EXPRS:
+            x = self.pop_value()
+            self.stack.append(self.temp(UNARY_EXPRS[op].format(x=x)))
+        elif op in BINARY_EXPRS:
+            y = self.pop_value()
+            x = self.pop_value()
+            self.stack.append(self.temp(BINARY_EXPRS[op].format(x=x, y=y)))
+        elif op is Op.LABEL:
+            pass
+        elif op is Op.GOTO:
+            self.flush()
+            if self.function.is_halt_loop(index):
+                self.count_steps()
+                self.emit('vm.steps += steps')
+                self.emit('ram[0] = sp')
+                self.emit(f'raise Halt({self.function.name!r})')
+            else:
+                self.jump(self.function.labels[cmd.name], index)
+        elif op is Op.IF_GOTO:
+            cond = self.pop_value()
+            self.flush()
+            self.count_steps()
+            self.emit(f'if {cond}:')
+            self.indent += 4
+            self.jump(self.function.labels[cmd.name], index)
+            self.indent -= 4
+        elif op is Op.CALL:
+            self.flush()
+            self.count_steps(check=True)
+            self.emit('ram[0] = sp')
+            self.emit(f'call({cmd.name!r}, {cmd.value})')
+            self.emit('sp = ram[0]')
+        elif op is Op.RETURN:
+            value = self.pop_value()
+            self.stack = []
+            self.count_steps()
+            self.emit('vm.steps += steps')
+            self.emit(f'ram[arg] = {value}')
+            self.emit('ram[0] = arg + 1')
+            self.emit('ram[4] = ram[lcl - 1]')
+            self.emit('ram[3] = ram[lcl - 2]')
+            self.emit('ram[2] = ram[lcl - 3]')
+            self.emit('ram[1] = ram[lcl - 4]')
+            self.emit('if vm.on_return is not None:')
+            self.emit(f'    vm.on_return({self.function.name!r})')
+            self.emit('return')
+        else:
+            raise SyntaxError(f'Invalid command: {cmd.text}')
+
+def main(paths, with_os=False, compile=True, max_steps=None, dump=None):
+    vm = VMEmulator.from_paths(paths, with_os=with_os, compile=compile)
+    start = time.perf_counter()
+    steps = vm.run(max_steps=max_steps)
+    elapsed = time.perf_counter() - start
+    logger.info('ran %d commands in %.3fs (%.0f commands/s)%s', steps, elapsed,
+                steps / elapsed if elapsed else 0, ', halted' if vm.halted else '')
+    logger.debug('SP=%d LCL=%d ARG=%d THIS=%d THAT=%d', *vm.ram[:5])
+    if dump is not None:
+        first, last = dump
+        for address in range(first, last + 1):
+            print(f'RAM[{address}] = {vm.ram[address]}')
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('infiles', nargs='+', help='File(s) or directory to run.')
+    arg_parser.add_argument('--os', action='store_true',
+                            help='Also load the tools/OS classes the program does not define.')
+    arg_parser.add_argument('--interpret', action='store_true',
+                            help='Interpret each command instead of compiling functions.')
+    arg_parser.add_argument('--steps', type=int, help='Stop after this many VM commands.')
+    arg_parser.add_argument('--dump', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                            help='Print RAM[FIRST..LAST] when the run stops.')
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    main(args.infiles, with_os=args.os, compile=not args.interpret, max_steps=args.steps, dump=args.dump)
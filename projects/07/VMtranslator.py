@@ -1,44 +1,267 @@
 #!/usr/bin/env python3
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
 from glob import glob
+import io
+from itertools import repeat
+import json
+import logging
 import os
-import re
+import sys
+import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+import Assembler
+from Assembler import TRACE, add_logging_args, assemble_object, log_level, set_log_level, write_text
+from BuildCache import add_cache_args, cache_from_args, source_digest
+from Linker import link as link_modules
+from Profiler import add_profile_args, phase, profiler_from_args, report_profile
+from SourceMap import SourceMap, get_source_map_name
+
+logger = logging.getLogger('VMtranslator')
+
+OS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'tools', 'OS')
+
+class Op(IntEnum):
+    ADD = 0
+    SUB = 1
+    NEG = 2
+    EQ = 3
+    GT = 4
+    LT = 5
+    AND = 6
+    OR = 7
+    NOT = 8
+    PUSH = 9
+    POP = 10
+    LABEL = 11
+    GOTO = 12
+    IF_GOTO = 13
+    FUNCTION = 14
+    CALL = 15
+    RETURN = 16
+
+class Segment(IntEnum):
+    CONSTANT = 0
+    STATIC = 1
+    POINTER = 2
+    TEMP = 3
+    LOCAL = 4
+    ARGUMENT = 5
+    THIS = 6
+    THAT = 7
+
+OPCODES = {
+    'add': Op.ADD,
+    'sub': Op.SUB,
+    'neg': Op.NEG,
+    'eq': Op.EQ,
+    'gt': Op.GT,
+    'lt': Op.LT,
+    'and': Op.AND,
+    'or': Op.OR,
+    'not': Op.NOT,
+    'push': Op.PUSH,
+    'pop': Op.POP,
+    'label': Op.LABEL,
+    'goto': Op.GOTO,
+    'if-goto': Op.IF_GOTO,
+    'function': Op.FUNCTION,
+    'call': Op.CALL,
+    'return': Op.RETURN
+}
+MNEMONICS = {op: mnemonic for mnemonic, op in OPCODES.items()}
+SEGMENTS = {segment.name.lower(): segment for segment in Segment}
 VALID_ARITHMETIC = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not']
-UNARY_OPS = ['not', 'neg']
-BINARY_OPS = ['add', 'sub', 'and', 'or']
-COMP_OPS = ['eq', 'gt', 'lt']
-BASE_SEGMENTS = ['local', 'argument', 'this', 'that']
+ARITHMETIC_OPS = {OPCODES[cmd] for cmd in VALID_ARITHMETIC}
+UNARY_OPS = {Op.NOT, Op.NEG}
+BINARY_OPS = {Op.ADD, Op.SUB, Op.AND, Op.OR}
+COMP_OPS = {Op.EQ, Op.GT, Op.LT}
+BASE_SEGMENTS = {Segment.LOCAL, Segment.ARGUMENT, Segment.THIS, Segment.THAT}
 base_seg_dict = {
-    'local': 'LCL',
-    'argument': 'ARG',
-    'this': 'THIS',
-    'that': 'THAT',
-    'pointer': '3',
-    'temp': '5'
+    Segment.LOCAL: 'LCL',
+    Segment.ARGUMENT: 'ARG',
+    Segment.THIS: 'THIS',
+    Segment.THAT: 'THAT',
+    Segment.POINTER: '3',
+    Segment.TEMP: '5'
+}
+# the book's command types, for Parser.command_type()
+COMMAND_TYPES = dict.fromkeys(ARITHMETIC_OPS, 'C_ARITHMETIC')
+COMMAND_TYPES.update({
+    Op.PUSH: 'C_PUSH',
+    Op.POP: 'C_POP',
+    Op.LABEL: 'C_LABEL',
+    Op.GOTO: 'C_GOTO',
+    Op.IF_GOTO: 'C_IF',
+    Op.FUNCTION: 'C_FUNCTION',
+    Op.CALL: 'C_CALL',
+    Op.RETURN: 'C_RETURN'
+})
+# number of arguments each command takes
+ARITY = dict.fromkeys(ARITHMETIC_OPS, 0)
+ARITY.update({Op.PUSH: 2, Op.POP: 2, Op.LABEL: 1, Op.GOTO: 1, Op.IF_GOTO: 1,
+              Op.FUNCTION: 2, Op.CALL: 2, Op.RETURN: 0})
+
+class Command(object):
+    """One parsed VM command.
+
+    `segment` and `value` are set for push and pop; `name` and `value` for
+    function and call, where `value` is the number of locals or arguments;
+    `name` alone for label, goto and if-goto. `text` is the source line and
+    `line` its number, if it came from a file.
+    """
+    __slots__ = ('op', 'segment', 'value', 'name', 'text', 'line')
+
+    def __init__(self, op, segment=None, value=None, name=None, text=None, line=None):
+        self.op = op
+        self.segment = segment
+        self.value = value
+        self.name = name
+        self.text = text
+        self.line = line
+
+    def __repr__(self):
+        return f'Command({self.text!r})'
+
+def parse_command(text):
+    """Parse one comment-free, stripped line of VM code into a Command."""
+    words = text.split()
+    op = OPCODES.get(words[0])
+    if op is None or len(words) != ARITY[op] + 1:
+        raise SyntaxError(f'Invalid command: {text}')
+    if op is Op.PUSH or op is Op.POP:
+        segment = SEGMENTS.get(words[1])
+        if segment is None or (op is Op.POP and segment is Segment.CONSTANT) or not words[2].isdigit():
+            raise SyntaxError(f'Invalid command: {text}')
+        return Command(op, segment=segment, value=int(words[2]), text=text)
+    if op is Op.FUNCTION or op is Op.CALL:
+        if not words[2].isdigit():
+            raise SyntaxError(f'Invalid command: {text}')
+        return Command(op, name=words[1], value=int(words[2]), text=text)
+    if len(words) == 2:
+        return Command(op, name=words[1], text=text)
+    return Command(op, text=text)
+
+BINARY_OP_LINES = {
+    Op.ADD: 'M=D+M',
+    Op.SUB: 'M=M-D',
+    Op.AND: 'M=D&M',
+    Op.OR: 'M=D|M'
+}
+FOLDABLE_OPS = {
+    Op.ADD: lambda x, y: x + y,
+    Op.SUB: lambda x, y: x - y,
+    Op.AND: lambda x, y: x & y,
+    Op.OR: lambda x, y: x | y
 }
+# past this index, popping through R13 is shorter than stepping A=A+1
+MAX_INLINE_OFFSET = 7
 
 class CodeWriter(object):
-    def __init__(self, outfile):
-        self.outfile = open(outfile, mode='w')
-        self.user_labels = []
+    def __init__(self, outfile, optimize=False, compact=False, profiler=None, source_map=False,
+                 intrinsics=()):
+        # `outfile` is a path, or an open text stream such as io.StringIO
+        self.outfile = open(outfile, mode='w') if isinstance(outfile, str) else outfile
+        self.profiler = profiler
+        # a dict for fast lookups that keeps the labels in order
+        self.user_labels = {}
+        self.function_name = None
+        self.optimize = optimize
+        self.compact = compact
+        # sites using each shared routine: 'call', 'return' and 'compare' in
+        # compact mode, and each of `intrinsics` by function name
+        self.compact_sites = Counter()
+        self.intrinsics = frozenset(intrinsics)
+        self.lines = []
+        # lines written to `outfile`
+        self.n_lines = 0
+        # [output line index, vm file, vm line, function] where the code of each command starts
+        self.marks = [] if source_map else None
 
     def close(self):
-        self.outfile.close()
+        self.finish()
+        with phase(self.profiler, 'write'):
+            self.outfile.close()
 
-    def set_file_name(self, file_name):
+    def finish(self):
+        """Write out everything still buffered, leaving `outfile` open."""
+        if self.compact or self.intrinsics:
+            self.write_runtime()
+        if self.optimize:
+            with phase(self.profiler, 'peephole'):
+                lines = peephole(self.lines, self.marks)
+            with phase(self.profiler, 'write'):
+                self.outfile.write('\n'.join(lines) + '\n')
+            self.n_lines = len(lines)
+
+    def _write(self, lines):
+        if self.optimize:
+            self.lines.extend(lines)
+        else:
+            self.outfile.write('\n'.join(lines) + '\n')
+            self.n_lines += len(lines)
+
+    def _position(self):
+        return len(self.lines) if self.optimize else self.n_lines
+
+    def mark(self, cmd):
+        """Note that the code for `cmd` starts here, for the source map."""
+        function = cmd.name if cmd.op is Op.FUNCTION else self.function_name
+        self.marks.append([self._position(), self.source_name, cmd.line, function])
+
+    def _mark_generated(self, function):
+        # code that comes from no VM file: the bootstrap and the compact mode routines
+        if self.marks is not None:
+            self.marks.append([self._position(), '', 0, function])
+
+    def source_map(self, output):
+        """Return a SourceMap from the lines of `output` to the VM commands they were translated from.
+
+        Only complete once `finish` has run. Under -O the peephole pass can
+        merge the end of one command with the start of the next, so the
+        boundary between them may be off by a line or two.
+        """
+        source_map = SourceMap(output, step=0, end=self.n_lines + 1)
+        for position, source, line, function in self.marks:
+            # positions count from 0 and lines from 1
+            source_map.add(position + 1, source, line, function)
+        return source_map
+
+    def set_file_name(self, file_name, source_name=None):
+        # `source_name` is the file the commands came from, for the source map, if not `file_name`
         if '/' in file_name:
             file_name = file_name.split('/')[-1]
-        self.file_name = file_name.rstrip('.vm')
+        self.source_name = source_name or file_name
+        if file_name.endswith('.vm'):
+            file_name = file_name[:-len('.vm')]
+        self.file_name = file_name
+        self.function_name = None
 
     def write_arithmetic(self, cmd, cmd_number):
+        op = cmd.op
+        if self.compact and op in COMP_OPS:
+            self.compact_sites['compare'] += 1
+            self._write([f'@CONTINUE_{cmd_number}', 'D=A', f'@$$compare_{MNEMONICS[op]}', '0;JMP',
+                         f'(CONTINUE_{cmd_number})'])
+            return
+        self._write(self._arithmetic_lines(op, cmd_number))
+
+    def _arithmetic_lines(self, cmd, cmd_number):
+        # `cmd` is the Op
+        if self.optimize:
+            return self._optimized_arithmetic_lines(cmd, cmd_number)
+        if cmd is Op.GT or cmd is Op.LT:
+            return self._order_result_lines(cmd, cmd_number)
         lines = []
         lines.append('@SP') # get stack pointer
         lines.append('AM=M-1') # point A to first item in stack
         if cmd in UNARY_OPS:
-            if cmd == 'not':
+            if cmd is Op.NOT:
                 lines.append('M=!M') # not first stack item
-            elif cmd == 'neg':
+            elif cmd is Op.NEG:
                 lines.append('M=-M') # negate first stack item
             else:
                 raise
@@ -47,25 +270,20 @@ class CodeWriter(object):
             lines.append('@SP')
             lines.append('AM=M-1') # move down the stack
             if cmd in BINARY_OPS:
-                if cmd == 'and':
+                if cmd is Op.AND:
                     lines.append('M=D&M') # and operands
-                elif cmd == 'add':
+                elif cmd is Op.ADD:
                     lines.append('M=D+M') # add operands
-                elif cmd == 'sub':
+                elif cmd is Op.SUB:
                     lines.append('M=M-D') # sub operands
-                elif cmd == 'or':
+                elif cmd is Op.OR:
                     lines.append('M=D|M') # or operands
                 else:
                     raise
-            elif cmd in COMP_OPS:
+            elif cmd is Op.EQ:
                 lines.append('D=D-M') # sub the two stack items, ready for comparison
                 lines.append(f'@RETURN_TRUE_{cmd_number}')
-                if cmd == 'eq':
-                    lines.append('D;JEQ')
-                elif cmd == 'lt':
-                    lines.append('D;JGT')
-                elif cmd == 'gt':
-                    lines.append('D;JLT')
+                lines.append('D;JEQ')
                 lines.append('@SP')
                 lines.append('A=M')
                 lines.append('M=0') # return False if jump fails
@@ -79,10 +297,27 @@ class CodeWriter(object):
                 lines.append(f'(CONTINUE_{cmd_number})')
         lines.append('@SP')
         lines.append('M=M+1') # move stack pointer to empty cell
-        self.outfile.write('\n'.join(lines) + '\n')
+        return lines
 
     def write_call(self, cmd, cmd_number):
-        _, f, n = cmd.split(' ')
+        if cmd.name in self.intrinsics and cmd.value == INTRINSICS[cmd.name][0]:
+            # D = return address; the routine replaces the arguments with the result
+            self.compact_sites[cmd.name] += 1
+            self._write([f'@intrinsic_return_{cmd_number}', 'D=A', f'@$${cmd.name}', '0;JMP',
+                         f'(intrinsic_return_{cmd_number})'])
+            return
+        if self.compact:
+            # R13 = nArgs, R14 = callee, D = return address
+            f, n = cmd.name, cmd.value
+            self.compact_sites['call'] += 1
+            self._write([f'@{n}', 'D=A', '@R13', 'M=D', f'@{f}', 'D=A', '@R14', 'M=D',
+                         f'@return_address_{cmd_number}', 'D=A', '@$$call', '0;JMP',
+                         f'(return_address_{cmd_number})'])
+            return
+        self._write(self._call_lines(cmd, cmd_number))
+
+    def _call_lines(self, cmd, cmd_number):
+        f, n = cmd.name, cmd.value
 
         def push_address(lines):
             lines.append('@SP')
@@ -132,42 +367,52 @@ class CodeWriter(object):
         lines.append('0;JMP')
         # (return-address)
         lines.append(f'(return_address_{cmd_number})')
-        self.outfile.write('\n'.join(lines) + '\n')
+        return lines
 
     def write_function(self, cmd):
-        _, f, k = cmd.split(' ')
+        f, k = cmd.name, cmd.value
+        self.function_name = f
         lines = []
         # (f)
         lines.append(f'({f})')
+        if self.optimize:
+            # zero the locals in one sweep and bump SP once
+            if k:
+                lines.extend(['@SP', 'A=M'])
+                lines.extend(['M=0', 'A=A+1'] * k)
+                lines.extend(['D=A', '@SP', 'M=D'])
+            self._write(lines)
+            return
         # repeat k times: push 0
         lines.append('@0')
         lines.append('D=A')
-        for _ in range(int(k)):
+        for _ in range(k):
             lines.append('@SP')
             lines.append('A=M')
             lines.append('M=D')
             lines.append('@SP')
             lines.append('M=M+1')
-        self.outfile.write('\n'.join(lines) + '\n')
+        self._write(lines)
 
     def write_goto(self, cmd):
         lines = []
-        words = cmd.split(' ')
-        label = words[1]
+        label = self._scoped_label(cmd.name)
         lines.append(f'@{label}')
         lines.append('0;JMP')
-        self.outfile.write('\n'.join(lines) + '\n')
+        self._write(lines)
 
     def write_if_goto(self, cmd):
         lines = []
-        words = cmd.split(' ')
-        label = words[1]
+        label = self._scoped_label(cmd.name)
+        if self.optimize:
+            self._write(['@SP', 'AM=M-1', 'D=M', f'@{label}', 'D;JNE'])
+            return
         lines.append('@SP')
         lines.append('AM=M-1')
         lines.append('D=M')
         lines.append(f'@{label}')
         lines.append('D;JNE')
-        self.outfile.write('\n'.join(lines) + '\n')
+        self._write(lines)
 
     def write_init(self):
         lines = []
@@ -176,29 +421,41 @@ class CodeWriter(object):
         lines.append('D=A')
         lines.append('@SP')
         lines.append('M=D')
-        self.outfile.write('\n'.join(lines) + '\n')
-        self.write_call('call Sys.init 0', 0)
+        self._mark_generated('$bootstrap')
+        self._write(lines)
+        self.write_call(parse_command('call Sys.init 0'), 0)
 
     def write_label(self, cmd, cmd_ix):
         lines = []
-        words = cmd.split(' ')
-        label = words[1]
+        assert not cmd.name[0].isnumeric()
+        label = self._scoped_label(cmd.name)
         assert label not in self.user_labels, f'Label {label} has already been used.'
-        self.user_labels.append(label)
-        assert not label[0].isnumeric()
+        self.user_labels[label] = None
         lines.append(f'({label})')
-        self.outfile.write('\n'.join(lines) + '\n')
+        self._write(lines)
+
+    def _scoped_label(self, label):
+        # labels are local to the function they appear in
+        if self.function_name is None:
+            return label
+        return f'{self.function_name}${label}'
 
     def write_push_pop(self, cmd):
         lines = []
-        words = cmd.split(' ')
-        assert len(words) == 3, f'`{cmd}` failed: push/pop commands must have exactly 3 words.'
-        command_type, mem_segment, address = words
-        if command_type == 'push':
-            if mem_segment == 'constant':
+        mem_segment, address = cmd.segment, cmd.value
+        if self.optimize:
+            if cmd.op is Op.PUSH:
+                lines = self._load_lines(mem_segment, address) + PUSH_D_LINES
+            else:
+                assert cmd.op is Op.POP, f'Command {cmd.text} not recognized.'
+                lines = self._store_lines(mem_segment, address, POP_D_LINES)
+            self._write(lines)
+            return
+        if cmd.op is Op.PUSH:
+            if mem_segment is Segment.CONSTANT:
                 lines.append(f'@{address}') # load constant
                 lines.append('D=A') # hold constant in D
-            elif mem_segment == 'static':
+            elif mem_segment is Segment.STATIC:
                 lines.append(f'@{self.file_name}.{address}')
                 lines.append('D=M')
             else:
@@ -217,23 +474,121 @@ class CodeWriter(object):
             lines.append('@SP') # access stack pointer again
             lines.append('M=M+1') # increment stack pointer
         else:
-            assert command_type == 'pop', f'Command {command_type} not recognized.'
+            assert cmd.op is Op.POP, f'Command {cmd.text} not recognized.'
             lines.append('@SP')
             lines.append('AM=M-1') # get address of stack head and decrement stack head pointer
             lines.append('D=M') # get value at stack head
-            if mem_segment == 'static':
+            if mem_segment is Segment.STATIC:
                 lines.append(f'@{self.file_name}.{address}')
             else:
                 seg_base = base_seg_dict[mem_segment]
                 lines.append(f'@{seg_base}')
                 if mem_segment in BASE_SEGMENTS:
                     lines.append('A=M')
-                for _ in range(int(address)):
+                for _ in range(address):
                     lines.append('A=A+1')
             lines.append('M=D')
-        self.outfile.write('\n'.join(lines) + '\n')
+        self._write(lines)
+
+    def write_push_fused(self, cmd, next_cmd):
+        """Translate `cmd`, a push, together with `next_cmd` without touching the stack.
+
+        Handles a push followed by a pop, by add/sub/and/or, or by an if-goto.
+        Returns False, writing nothing, if the pair cannot be fused.
+        """
+        load = self._load_lines(cmd.segment, cmd.value)
+        op = next_cmd.op
+        if op is Op.POP:
+            lines = self._store_lines(next_cmd.segment, next_cmd.value, load)
+        elif op in BINARY_OP_LINES:
+            lines = load + ['@SP', 'A=M-1', BINARY_OP_LINES[op]]
+        elif op is Op.IF_GOTO:
+            lines = load + [f'@{self._scoped_label(next_cmd.name)}', 'D;JNE']
+        else:
+            return False
+        self._write(lines)
+        return True
+
+    def _optimized_arithmetic_lines(self, cmd, cmd_number):
+        if cmd in UNARY_OPS:
+            return ['@SP', 'A=M-1', 'M=!M' if cmd is Op.NOT else 'M=-M']
+        lines = ['@SP', 'AM=M-1', 'D=M', 'A=A-1']
+        if cmd in BINARY_OPS:
+            lines.append(BINARY_OP_LINES[cmd])
+            return lines
+        if cmd is Op.GT or cmd is Op.LT:
+            return self._order_result_lines(cmd, cmd_number)
+        lines.append('D=M-D')
+        lines.append(f'@RETURN_TRUE_{cmd_number}')
+        lines.append('D;JEQ')
+        lines.extend(['@SP', 'A=M-1', 'M=0'])
+        lines.append(f'@CONTINUE_{cmd_number}')
+        lines.append('0;JMP')
+        lines.append(f'(RETURN_TRUE_{cmd_number})')
+        lines.extend(['@SP', 'A=M-1', 'M=-1'])
+        lines.append(f'(CONTINUE_{cmd_number})')
+        return lines
+
+    def _order_lines(self, cmd, true, false, y_negative, same_sign):
+        # pop y and jump to `true` or `false` on x gt y or x lt y, leaving x for the result; x - y
+        # overflows when the signs differ, so only operands of the same sign are subtracted
+        x_less, x_greater = (true, false) if cmd is Op.LT else (false, true)
+        return ['@SP', 'AM=M-1', 'D=M', f'@{y_negative}', 'D;JLT',
+                '@SP', 'A=M-1', 'D=M', f'@{x_less}', 'D;JLT', f'@{same_sign}', '0;JMP',
+                f'({y_negative})', '@SP', 'A=M-1', 'D=M', f'@{x_greater}', 'D;JGE',
+                f'({same_sign})', '@SP', 'A=M', 'D=M', 'A=A-1', 'D=M-D',
+                f'@{true}', 'D;JLT' if cmd is Op.LT else 'D;JGT']
+
+    def _order_result_lines(self, cmd, cmd_number):
+        lines = self._order_lines(cmd, f'RETURN_TRUE_{cmd_number}', f'RETURN_FALSE_{cmd_number}',
+                                  f'Y_NEGATIVE_{cmd_number}', f'SAME_SIGN_{cmd_number}')
+        lines.extend([f'(RETURN_FALSE_{cmd_number})', '@SP', 'A=M-1', 'M=0'])
+        lines.append(f'@CONTINUE_{cmd_number}')
+        lines.append('0;JMP')
+        lines.append(f'(RETURN_TRUE_{cmd_number})')
+        lines.extend(['@SP', 'A=M-1', 'M=-1'])
+        lines.append(f'(CONTINUE_{cmd_number})')
+        return lines
+
+    def _load_lines(self, mem_segment, address):
+        """Lines that load `mem_segment address` into D."""
+        if mem_segment is Segment.CONSTANT:
+            if address in (0, 1):
+                return [f'D={address}']
+            return [f'@{address}', 'D=A']
+        return self._address_lines(mem_segment, address, 'D=M')
+
+    def _store_lines(self, mem_segment, address, load):
+        """Lines that run `load` to put a value in D and store it at `mem_segment address`."""
+        if mem_segment in BASE_SEGMENTS and address > MAX_INLINE_OFFSET:
+            # the address needs D, so park it in R13 before loading the value
+            seg_base = base_seg_dict[mem_segment]
+            lines = [f'@{seg_base}', 'D=M', f'@{address}', 'D=D+A', '@R13', 'M=D']
+            return lines + load + ['@R13', 'A=M', 'M=D']
+        return load + self._address_lines(mem_segment, address, 'M=D')
+
+    def _address_lines(self, mem_segment, address, access):
+        """Lines that point A at `mem_segment address` and then run `access`."""
+        if mem_segment is Segment.STATIC:
+            return [f'@{self.file_name}.{address}', access]
+        seg_base = base_seg_dict[mem_segment]
+        if mem_segment not in BASE_SEGMENTS:
+            return [f'@{int(seg_base) + address}', access]
+        offset = address
+        if access == 'D=M' and offset > 2:
+            return [f'@{seg_base}', 'D=M', f'@{address}', 'A=D+A', access]
+        if offset == 0:
+            return [f'@{seg_base}', 'A=M', access]
+        return [f'@{seg_base}', 'A=M+1'] + ['A=A+1'] * (offset - 1) + [access]
 
     def write_return(self):
+        if self.compact:
+            self.compact_sites['return'] += 1
+            self._write(['@$$return', '0;JMP'])
+            return
+        self._write(self._return_lines())
+
+    def _return_lines(self):
 
         def set_reg_to_frame_less_n(n, reg, lines):
             lines.append('@R14')
@@ -277,7 +632,266 @@ class CodeWriter(object):
         lines.append('@R15')
         lines.append('A=M')
         lines.append('0;JMP')
-        self.outfile.write('\n'.join(lines) + '\n')
+        return lines
+
+    def _call_routine(self):
+        # the call site leaves nArgs in R13, the callee in R14 and the return address in D
+        lines = ['($$call)']
+        # push return-address
+        lines.extend(['@SP', 'A=M', 'M=D'])
+        # push LCL, ARG, THIS and THAT
+        for reg in ['LCL', 'ARG', 'THIS', 'THAT']:
+            lines.extend([f'@{reg}', 'D=M', '@SP', 'AM=M+1', 'M=D'])
+        lines.extend(['@SP', 'M=M+1'])
+        # ARG = SP - nArgs - 5
+        lines.extend(['D=M', '@R13', 'D=D-M', '@5', 'D=D-A', '@ARG', 'M=D'])
+        # LCL = SP
+        lines.extend(['@SP', 'D=M', '@LCL', 'M=D'])
+        # goto f
+        lines.extend(['@R14', 'A=M', '0;JMP'])
+        return lines
+
+    def _return_routine(self):
+        return ['($$return)'] + self._return_lines()
+
+    def _compare_routine(self):
+        # the call site leaves the return address in D; R15 holds it while we compare
+        lines = ['($$compare_eq)', '@R15', 'M=D', '@SP', 'AM=M-1', 'D=M', 'A=A-1', 'D=M-D',
+                 '@$$compare_true', 'D;JEQ', '@$$compare_false', '0;JMP']
+        for cmd in (Op.GT, Op.LT):
+            name = f'$$compare_{MNEMONICS[cmd]}'
+            lines.extend([f'({name})', '@R15', 'M=D'])
+            lines.extend(self._order_lines(cmd, '$$compare_true', '$$compare_false', f'{name}.y_negative',
+                                           f'{name}.same_sign'))
+            lines.extend(['@$$compare_false', '0;JMP'])
+        for label, value in [('$$compare_false', '0'), ('$$compare_true', '-1')]:
+            lines.append(f'({label})')
+            lines.extend(['@SP', 'A=M-1', f'M={value}', '@R15', 'A=M', '0;JMP'])
+        return lines
+
+    def _fallback_lines(self, name):
+        # call the OS function after all, with the arguments still on the stack
+        n_args = INTRINSICS[name][0]
+        return [f'($${name}.fallback)', f'@{n_args}', 'D=A', '@R13', 'M=D', f'@{name}', 'D=A', '@R14', 'M=D',
+                '@R15', 'D=M', '@$$call', '0;JMP']
+
+    def _multiply_routine(self):
+        # shift and add, stopping once no bits of y are left
+        lines = ['($$Math.multiply)', '@R15', 'M=D']
+        # R14 = y, the bits still to add; R13 = x shifted to the current bit; the product replaces x
+        lines.extend(['@SP', 'AM=M-1', 'D=M', '@R14', 'M=D', '@SP', 'A=M-1', 'D=M', '@R13', 'M=D',
+                      '@SP', 'A=M-1', 'M=0', '@R14', 'D=M', '@$$Math.multiply.done', 'D;JEQ'])
+        for bit in range(15):
+            lines.extend(['@R14', 'D=M', f'@{1 << bit}', 'D=D&A', f'@$$Math.multiply.skip{bit}', 'D;JEQ'])
+            lines.extend(['@R14', 'M=M-D', '@R13', 'D=M', '@SP', 'A=M-1', 'M=D+M'])
+            lines.extend(['@R14', 'D=M', '@$$Math.multiply.done', 'D;JEQ'])
+            lines.extend([f'($$Math.multiply.skip{bit})', '@R13', 'D=M', 'M=D+M'])
+        # only the sign bit is left
+        lines.extend(['@R13', 'D=M', '@SP', 'A=M-1', 'M=D+M'])
+        lines.extend(['($$Math.multiply.done)', '@R15', 'A=M', '0;JMP'])
+        return lines
+
+    def _divide_routine(self):
+        # as the OS does it, down to the doubled divisors it leaves in its static 1 array and
+        # temp 0, reading the powers of two from static 0; y = 0 and -32768 go to the OS
+        lines = ['($$Math.divide)', '@R15', 'M=D']
+        lines.extend(['@SP', 'A=M-1', 'D=M', '@$$Math.divide.fallback', 'D;JEQ',
+                      '@32767', 'D=D+A', 'D=D+1', '@$$Math.divide.fallback', 'D;JEQ'])
+        lines.extend(['@SP', 'A=M-1', 'A=A-1', 'D=M', '@32767', 'D=D+A', 'D=D+1', '@$$Math.divide.fallback',
+                      'D;JEQ'])
+        # RAM[SP] = whether the quotient is negative; R13 = |x|
+        lines.extend(['@SP', 'A=M', 'M=0', '@SP', 'A=M-1', 'A=A-1', 'D=M', '@$$Math.divide.x', 'D;JGE',
+                      'D=-D', '@SP', 'A=M', 'M=!M', '($$Math.divide.x)', '@R13', 'M=D'])
+        # static1[0] = temp 0 = |y|; R14 points at static1[i]
+        lines.extend(['@SP', 'A=M-1', 'D=M', '@$$Math.divide.y', 'D;JGE', 'D=-D', '@SP', 'A=M', 'M=!M',
+                      '($$Math.divide.y)', '@R5', 'M=D', '@Math.1', 'A=M', 'M=D', '@Math.1', 'D=M', '@R14', 'M=D'])
+        # double while i < 15 and static1[i] < 16385, then stop on the first double greater than |x|
+        lines.extend(['($$Math.divide.double)', '@Math.1', 'D=M', '@R14', 'D=M-D', '@15', 'D=D-A',
+                      '@$$Math.divide.halve', 'D;JGE', '@R14', 'A=M', 'D=M', '@16385', 'D=D-A',
+                      '@$$Math.divide.halve', 'D;JGE', '@R14', 'A=M', 'D=M', 'D=D+M', 'A=A+1', 'M=D', '@R5', 'M=D',
+                      '@R13', 'D=M', '@R14', 'A=M', 'D=D-M', '@$$Math.divide.halve', 'D;JLT', '@R14', 'A=M', 'D=D-M',
+                      '@$$Math.divide.halve', 'D;JLT', '@R14', 'M=M+1', '@$$Math.divide.double', '0;JMP'])
+        # the quotient replaces x; RAM[SP + 1] points at static0[i]
+        lines.extend(['($$Math.divide.halve)', '@SP', 'A=M-1', 'A=A-1', 'M=0', '@Math.1', 'D=M', '@R14',
+                      'D=M-D', '@Math.0', 'D=D+M', '@SP', 'A=M+1', 'M=D'])
+        lines.extend(['($$Math.divide.step)', '@R14', 'A=M', 'D=M', '@R13', 'D=D-M', '@$$Math.divide.next', 'D;JGT',
+                      '@R14', 'A=M', 'D=M', '@R13', 'M=M-D', '@SP', 'A=M+1', 'A=M', 'D=M', '@SP', 'A=M-1',
+                      'A=A-1', 'M=D+M'])
+        lines.extend(['($$Math.divide.next)', '@Math.1', 'D=M', '@R14', 'D=M-D', '@$$Math.divide.sign', 'D;JEQ',
+                      '@R14', 'M=M-1', '@SP', 'A=M+1', 'M=M-1', '@$$Math.divide.step', '0;JMP'])
+        lines.extend(['($$Math.divide.sign)', '@SP', 'A=M', 'D=M', '@$$Math.divide.done', 'D;JEQ',
+                      '@SP', 'A=M-1', 'A=A-1', 'M=-M', '($$Math.divide.done)', '@SP', 'M=M-1', '@R15', 'A=M',
+                      '0;JMP'])
+        return lines + self._fallback_lines('Math.divide')
+
+    def _alloc_routine(self):
+        # first fit over the OS's block list, splitting the block as the OS does; a size
+        # below 1 or a block past the heap goes to the OS for its error
+        lines = ['($$Memory.alloc)', '@R15', 'M=D']
+        # R14 = size; R13 = the block, from 2048
+        lines.extend(['@SP', 'A=M-1', 'D=M', '@$$Memory.alloc.fallback', 'D;JLE', '@R14', 'M=D',
+                      '@2048', 'D=A', '@R13', 'M=D'])
+        lines.extend(['($$Memory.alloc.walk)', '@R13', 'A=M', 'D=M', '@R14', 'D=D-M', '@$$Memory.alloc.found',
+                      'D;JGE', '@R13', 'A=M+1', 'D=M', '@R13', 'M=D', '@$$Memory.alloc.walk', '0;JMP'])
+        lines.extend(['($$Memory.alloc.found)', '@R13', 'D=M', '@R14', 'D=D+M', '@16379', 'D=D-A',
+                      '@$$Memory.alloc.fallback', 'D;JGT'])
+        # split off the rest when it is more than 2 words: RAM[SP] = the new block after this one
+        lines.extend(['@R13', 'A=M', 'D=M', '@R14', 'D=D-M', '@2', 'D=D-A', '@$$Memory.alloc.take', 'D;JLE',
+                      '@R5', 'M=D', '@R13', 'D=M', '@R14', 'D=D+M', '@2', 'D=D+A', '@SP', 'A=M', 'M=D',
+                      '@R5', 'D=M', '@SP', 'A=M', 'A=M', 'M=D'])
+        # its next is the block after, or itself + 2 at the end of the list
+        lines.extend(['@R13', 'A=M+1', 'D=M', '@R13', 'D=D-M', '@2', 'D=D-A', '@$$Memory.alloc.last', 'D;JEQ',
+                      '@R13', 'A=M+1', 'D=M', '@$$Memory.alloc.link', '0;JMP',
+                      '($$Memory.alloc.last)', '@SP', 'A=M', 'D=M', '@2', 'D=D+A',
+                      '($$Memory.alloc.link)', '@SP', 'A=M', 'A=M+1', 'M=D', '@SP', 'A=M', 'D=M', '@R13', 'A=M+1',
+                      'M=D'])
+        # mark the block used, leave temp 0 as the OS does and return the block + 2
+        lines.extend(['($$Memory.alloc.take)', '@R13', 'A=M', 'M=0', '@R5', 'M=0', '@R13', 'D=M', '@2', 'D=D+A',
+                      '@SP', 'A=M-1', 'M=D', '@R15', 'A=M', '0;JMP'])
+        return lines + self._fallback_lines('Memory.alloc')
+
+    def write_runtime(self):
+        """Write the shared routines for the sites translated in compact mode or with intrinsics."""
+        falls_back = any(self.compact_sites[name] and INTRINSICS[name][1] for name in INTRINSICS)
+        routines = [('call', self._call_routine), ('return', self._return_routine),
+                    ('compare', self._compare_routine)]
+        for kind, routine in routines:
+            if self.compact_sites[kind] or (kind == 'call' and falls_back):
+                self._mark_generated(f'$${kind}')
+                self._write(routine())
+        for name in sorted(INTRINSICS):
+            if self.compact_sites[name]:
+                self._mark_generated(f'$${name}')
+                self._write(INTRINSIC_ROUTINES[name](self))
+
+    def size_report(self):
+        """Describe the words saved and cycles added by compact mode, per kind of site."""
+        inline_sizes = {
+            'call': count_instructions(self._call_lines(parse_command('call f 0'), 0)),
+            'return': count_instructions(self._return_lines()),
+            'compare': count_instructions(self._arithmetic_lines(Op.EQ, 0))
+        }
+        routine_sizes = {
+            'call': count_instructions(self._call_routine()),
+            'return': count_instructions(self._return_routine()),
+            'compare': count_instructions(self._compare_routine())
+        }
+        # call and return are straight-line, so their extra cycles are the extra instructions
+        # executed; an eq runs about 7 + 2 + 2 + 6 instructions of its routine on either path, while gt and
+        # lt, which compare the signs first, run between 18 and 30 of theirs
+        cycle_sizes = dict(routine_sizes, compare=17)
+        report = []
+        for kind in ['call', 'return', 'compare']:
+            sites = self.compact_sites[kind]
+            if not sites:
+                continue
+            inline = sites * inline_sizes[kind]
+            compact = sites * COMPACT_STUB_SIZES[kind] + routine_sizes[kind]
+            extra_cycles = COMPACT_STUB_SIZES[kind] + cycle_sizes[kind] - inline_sizes[kind]
+            report.append(f'{kind}: {sites} sites, {inline} words inlined vs {compact} words compact '
+                          f'({inline - compact:+d}), {extra_cycles:+d} cycles per {kind}')
+        return report
+
+# CodeWriter method for each Op, called as `writer(code_writer, cmd, cmd_number)`
+WRITERS = dict.fromkeys(ARITHMETIC_OPS, CodeWriter.write_arithmetic)
+WRITERS.update({
+    Op.PUSH: lambda code_writer, cmd, cmd_number: code_writer.write_push_pop(cmd),
+    Op.POP: lambda code_writer, cmd, cmd_number: code_writer.write_push_pop(cmd),
+    Op.LABEL: CodeWriter.write_label,
+    Op.GOTO: lambda code_writer, cmd, cmd_number: code_writer.write_goto(cmd),
+    Op.IF_GOTO: lambda code_writer, cmd, cmd_number: code_writer.write_if_goto(cmd),
+    Op.FUNCTION: lambda code_writer, cmd, cmd_number: code_writer.write_function(cmd),
+    Op.CALL: CodeWriter.write_call,
+    Op.RETURN: lambda code_writer, cmd, cmd_number: code_writer.write_return()
+})
+
+# OS functions whose calls can be replaced by a routine written straight in assembly, with
+# no frame: name -> (nArgs, whether the routine can fall back on calling the function)
+INTRINSICS = {
+    'Math.multiply': (2, False),
+    'Math.divide': (2, True),
+    'Memory.alloc': (1, True)
+}
+INTRINSIC_ROUTINES = {
+    'Math.multiply': CodeWriter._multiply_routine,
+    'Math.divide': CodeWriter._divide_routine,
+    'Memory.alloc': CodeWriter._alloc_routine
+}
+
+PUSH_D_LINES = ['@SP', 'AM=M+1', 'A=A-1', 'M=D']
+POP_D_LINES = ['@SP', 'AM=M-1', 'D=M']
+# instructions at each compact call, return and comparison site
+COMPACT_STUB_SIZES = {'call': 12, 'return': 2, 'compare': 4}
+
+def count_instructions(lines):
+    return sum(1 for line in lines if not line.startswith('('))
+
+# (pattern, replacement) pairs applied to the tail of the output as it grows
+PEEPHOLE_RULES = [
+    # a push of D straight back off the stack leaves SP where it was
+    (('@SP', 'AM=M+1', 'A=A-1', 'M=D', '@SP', 'AM=M-1'), ('@SP', 'A=M', 'M=D')),
+    # D already holds the value just stored
+    (('M=D', 'D=M'), ('M=D',)),
+    # a jump to the very next instruction
+    (('@{0}', '0;JMP', '({0})'), ('({0})',)),
+]
+
+def peephole(lines, marks=None):
+    """Apply PEEPHOLE_RULES to the assembly `lines` until none match.
+
+    `marks` are `[line index, ...]` lists in order of index, as a CodeWriter
+    keeps for its source map. Their indices are moved to the output in place;
+    a mark inside a replaced stretch moves to the last line replacing it.
+    """
+    out = []
+    m = 0
+    n_marks = len(marks) if marks else 0
+    for i, line in enumerate(lines):
+        while m < n_marks and marks[m][0] <= i:
+            marks[m][0] = len(out)
+            m += 1
+        out.append(line)
+        matched = True
+        while matched:
+            matched = False
+            for pattern, replacement in PEEPHOLE_RULES:
+                n = len(pattern)
+                if len(out) < n:
+                    continue
+                tail = out[-n:]
+                if '{0}' in pattern[0]:
+                    label = tail[-1][1:-1]
+                    pattern = tuple(p.format(label) for p in pattern)
+                    replacement = tuple(r.format(label) for r in replacement)
+                if tuple(tail) == pattern:
+                    out[-n:] = replacement
+                    last = len(out) - 1
+                    j = m - 1
+                    while j >= 0 and marks[j][0] > last:
+                        marks[j][0] = last
+                        j -= 1
+                    matched = True
+                    break
+    for mark in marks[m:] if marks else []:
+        mark[0] = len(out)
+    return out
+
+def fold_constants(commands):
+    """Fold `push constant x`, `push constant y`, `op` into one push where the result fits."""
+    out = []
+    for cmd in commands:
+        out.append(cmd)
+        while (len(out) >= 3 and out[-1].op in FOLDABLE_OPS
+               and is_push_constant(out[-2]) and is_push_constant(out[-3])):
+            result = FOLDABLE_OPS[out[-1].op](out[-3].value, out[-2].value) & 0xFFFF
+            if result > 32767:
+                break
+            out[-3:] = [Command(Op.PUSH, segment=Segment.CONSTANT, value=result,
+                                text=f'push constant {result}')]
+    return out
+
+def is_push_constant(cmd):
+    return cmd.op is Op.PUSH and cmd.segment is Segment.CONSTANT
 
 class Parser(object):
     def __init__(self, infile):
@@ -286,6 +900,25 @@ class Parser(object):
         self._process_commands()
         self.reset()
 
+    @classmethod
+    def from_text(cls, text):
+        """A parser over VM code held in memory."""
+        parser = cls.__new__(cls)
+        parser.lines = text.splitlines()
+        parser._process_commands()
+        parser.reset()
+        return parser
+
+    @classmethod
+    def from_commands(cls, commands):
+        """A parser over Commands made in memory, such as by the Jack compiler."""
+        parser = cls.__new__(cls)
+        parser.lines = []
+        parser.commands = commands
+        parser.n_commands = len(commands)
+        parser.reset()
+        return parser
+
     def advance(self):
         assert self.has_more_commands()
         self.current_command = self.commands[self.command_counter]
@@ -293,45 +926,22 @@ class Parser(object):
 
     def arg1(self):
         cur = self.current_command
-        cmd_type = self.command_type()
-        assert cmd_type != 'C_RETURN', '`arg1` should not be called with command `return`.'
-        if cmd_type == 'C_ARITHMETIC':
-            return cur
+        assert cur.op is not Op.RETURN, '`arg1` should not be called with command `return`.'
+        if cur.op in ARITHMETIC_OPS:
+            return MNEMONICS[cur.op]
+        elif cur.segment is not None:
+            return cur.segment.name.lower()
         else:
-            args = re.split(r'\s', cur)
-            return cur[1]
+            return cur.name
 
     def arg2(self):
         cur = self.current_command
-        cmd_type = self.command_type()
-        valid_cmd_types = ['C_PUSH', 'C_POP', 'C_FUNCTION', 'C_CALL']
-        assert cmd_type in valid_cmd_types, f'Command `{cur}` not of type in {valid_cmd_types}.'
-        args = re.split(r'\s', cur)
-        return cur[2]
+        valid_ops = [Op.PUSH, Op.POP, Op.FUNCTION, Op.CALL]
+        assert cur.op in valid_ops, f'Command `{cur.text}` not of type in {valid_ops}.'
+        return cur.value
 
     def command_type(self):
-        cur = self.current_command
-        for op in VALID_ARITHMETIC:
-            if op == cur:
-                return 'C_ARITHMETIC'
-        if cur.startswith('push '):
-            return 'C_PUSH'
-        elif cur.startswith('pop '):
-            return 'C_POP'
-        elif cur.startswith('label '):
-            return 'C_LABEL'
-        elif cur.startswith('goto '):
-            return 'C_GOTO'
-        elif cur.startswith('if-goto '):
-            return 'C_IF'
-        elif cur.startswith('function '):
-            return 'C_FUNCTION'
-        elif cur == 'return':
-            return 'C_RETURN'
-        elif cur.startswith('call '):
-            return 'C_CALL'
-        else:
-            raise SyntaxError(f'Invalid command: {cur}')
+        return COMMAND_TYPES[self.current_command.op]
 
     def has_more_commands(self):
         if self.command_counter >= self.n_commands:
@@ -341,13 +951,15 @@ class Parser(object):
 
     def _process_commands(self):
         commands = []
-        for line in self.lines:
+        for line_number, line in enumerate(self.lines, 1):
             if '//' in line:
                 index = line.find('//')
                 line = line[:index]
             line = line.strip()
             if not (line.startswith('//') or line == ''):
-                commands.append(line)
+                cmd = parse_command(line)
+                cmd.line = line_number
+                commands.append(cmd)
         self.commands = commands
         self.n_commands = len(self.commands)
 
@@ -356,12 +968,45 @@ class Parser(object):
         self.current_command = None
         self.line_number = 0
 
+class ParsedFiles(object):
+    """The commands of the files parsed so far, for a long-running process to reuse.
+
+    A file is parsed again once its size or modification time changes.
+    Commands are never modified once parsed, so the lists can be shared.
+    """
+    def __init__(self, max_files=1024):
+        self.max_files = max_files
+        self.files = {}
+        self.hits = 0
+
+    def parse(self, infile):
+        path = os.path.abspath(infile)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self.files.get(path)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return Parser.from_commands(list(entry[1]))
+        parser = Parser(infile)
+        if len(self.files) >= self.max_files:
+            self.files.clear()
+        self.files[path] = (version, parser.commands)
+        return parser
+
+# set by a long-running process such as BuildDaemon.py, to keep parsed files between builds
+parsed_files = None
+
+def parse_file(infile):
+    if parsed_files is None:
+        return Parser(infile)
+    return parsed_files.parse(infile)
+
 def check_infiles(infiles):
     if len(infiles) > 1:
         assert all(infile.endswith('.vm') for infile in infiles), 'All infiles must be .vm files.'
     elif not infiles[0].endswith('.vm'):
         assert os.path.isdir(infiles[0]), 'Infiles must be a directory or a list of .vm files.'
-        infiles = glob(os.path.join(infiles[0], '*.vm'))
+        infiles = sorted(glob(os.path.join(infiles[0], '*.vm')))
     return infiles
 
 def get_outfile_name(infiles):
@@ -374,40 +1019,434 @@ def get_outfile_name(infiles):
     return outfile_path
 
 
-def main(infiles):
+# whole-program pruning
+def call_graph(infiles, parsed=None):
+    """Map each function defined in `infiles` to the file it is in and the functions it calls.
+
+    `parsed` maps any of `infiles` already parsed to their commands.
+    """
+    graph = {}
+    for infile in infiles:
+        callees = None
+        commands = parsed[infile] if parsed and infile in parsed else parse_file(infile).commands
+        for cmd in commands:
+            if cmd.op is Op.FUNCTION:
+                callees = set()
+                graph[cmd.name] = (infile, callees)
+            elif cmd.op is Op.CALL and callees is not None:
+                callees.add(cmd.name)
+    return graph
+
+def reachable_functions(graph, entry='Sys.init'):
+    """Return the functions `entry` can call, directly or not, or None if `entry` isn't defined.
+
+    VM code can only call functions by name, so nothing else can run.
+    """
+    if entry not in graph:
+        return None
+    reached = {entry}
+    stack = [entry]
+    while stack:
+        for callee in graph[stack.pop()][1]:
+            # an undefined callee has no code to keep; see `warn_undefined`
+            if callee not in reached and callee in graph:
+                reached.add(callee)
+                stack.append(callee)
+    return reached
+
+def undefined_callees(graph, functions):
+    """Map each function that `functions` call but `graph` doesn't define to the sorted names of its callers."""
+    undefined = {}
+    for name in functions:
+        for callee in graph[name][1]:
+            if callee not in graph:
+                undefined.setdefault(callee, []).append(name)
+    return {callee: sorted(callers) for callee, callers in undefined.items()}
+
+def warn_undefined(graph, functions):
+    """Warn of the calls `functions` make to functions `graph` doesn't define.
+
+    The assembler takes the label of an undefined function for a variable,
+    so such a call jumps to a RAM address instead of failing.
+    """
+    for callee, callers in sorted(undefined_callees(graph, functions).items()):
+        logger.warning('%s is called by %s but is not defined', callee, ', '.join(callers))
+
+def group_by_file(graph, functions):
+    """Map each file in `graph` to the sorted names of its `functions`."""
+    by_file = {infile: [] for infile, _ in graph.values()}
+    for name in functions:
+        by_file[graph[name][0]].append(name)
+    return {infile: tuple(sorted(names)) for infile, names in by_file.items()}
+
+def kept_functions(keep, infile):
+    """The functions of `infile` in `keep`, or None when every function is kept."""
+    if keep is None:
+        return None
+    return keep.get(infile, ())
+
+def drop_functions(commands, keep):
+    """Return `commands` without the functions whose names aren't in `keep`."""
+    kept = []
+    keeping = True
+    for cmd in commands:
+        if cmd.op is Op.FUNCTION:
+            keeping = cmd.name in keep
+        if keeping:
+            kept.append(cmd)
+    return kept
+
+def prune_report(graph, reached, optimize=False, compact=False):
+    """Describe the functions, statics and words left out, per file and in all.
+
+    The words are counted by translating the functions left out on their
+    own, so they don't include any peephole savings across functions.
+    """
+    dropped = {}
+    for name, (infile, _) in graph.items():
+        if name not in reached:
+            dropped.setdefault(infile, set()).add(name)
+    report = []
+    total_functions = total_statics = total_words = 0
+    for infile in sorted(dropped):
+        names = dropped[infile]
+        code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact)
+        code_writer.set_file_name(infile)
+        statics = {True: set(), False: set()}
+        keeping = True
+        for ix, cmd in enumerate(parse_file(infile).commands):
+            if cmd.op is Op.FUNCTION:
+                keeping = cmd.name not in names
+            if cmd.segment is Segment.STATIC:
+                statics[keeping].add(cmd.value)
+            if not keeping:
+                WRITERS[cmd.op](code_writer, cmd, f'{code_writer.file_name}_{ix}')
+        words = count_instructions(writer_lines(code_writer))
+        n_statics = len(statics[False] - statics[True])
+        n_functions = sum(1 for infile_, _ in graph.values() if infile_ == infile)
+        report.append(f'{os.path.basename(infile)}: left out {len(names)} of {n_functions} functions, '
+                      f'{n_statics} statics and {words} words')
+        total_functions += len(names)
+        total_statics += n_statics
+        total_words += words
+    report.append(f'left out {total_functions} functions, {total_statics} statics and {total_words} words '
+                  f'({2 * total_words} bytes of ROM)')
+    return report
+
+def translate_file(code_writer, infile, keep=None):
+    """Translate the commands of `infile` through `code_writer`.
+
+    With `keep`, only the functions named in it are translated.
+    """
+    with phase(code_writer.profiler, 'parse'):
+        parser = parse_file(infile)
+    translate_parsed(code_writer, parser, infile, keep)
+
+def translate_parsed(code_writer, parser, file_name, keep=None, source_name=None):
+    """Translate the commands of `parser`, as if they were the file `file_name`, through `code_writer`.
+
+    The labels the translator makes up are named for the file, so the code
+    doesn't depend on which other files are translated with it.
+    """
+    tracing = logger.isEnabledFor(TRACE)
+    optimize = code_writer.optimize
+    profiler = code_writer.profiler
+    if keep is not None:
+        parser.commands = drop_functions(parser.commands, keep)
+        parser.n_commands = len(parser.commands)
+    if optimize:
+        with phase(profiler, 'fold'):
+            parser.commands = fold_constants(parser.commands)
+            parser.n_commands = len(parser.commands)
+    code_writer.set_file_name(file_name, source_name)
+    with phase(profiler, 'codegen'):
+        write_commands(code_writer, parser, tracing)
+
+def write_commands(code_writer, parser, tracing=False):
+    """Write the remaining commands of `parser` through `code_writer`."""
+    optimize = code_writer.optimize
+    profiler = code_writer.profiler
+    profiling = profiler is not None
+    marking = code_writer.marks is not None
+    commands = parser.commands
+    while parser.has_more_commands():
+        if profiling:
+            start = time.perf_counter()
+        parser.advance()
+        cmd = parser.current_command
+        if tracing:
+            logger.log(TRACE, '%s', cmd.text)
+        command_ix = f'{code_writer.file_name}_{parser.command_counter}'
+        if marking:
+            code_writer.mark(cmd)
+        if (optimize and cmd.op is Op.PUSH and parser.has_more_commands()
+                and code_writer.write_push_fused(cmd, commands[parser.command_counter])):
+            parser.advance()
+        else:
+            WRITERS[cmd.op](code_writer, cmd, command_ix)
+        if profiling:
+            # a fused push is counted as a push
+            profiler.command(COMMAND_TYPES[cmd.op], time.perf_counter() - start)
+
+def translate_to_buffer(infile, optimize=False, compact=False, keep=None, intrinsics=()):
+    """Translate `infile` on its own, returning what `merge_translation` needs.
+
+    In optimize mode the output is returned as unoptimized lines, so the
+    peephole pass can run over the merged program exactly as it does serially.
+    """
+    buffer = io.StringIO()
+    # marks are cheap to keep, and a cached translation may later be wanted with a source map
+    code_writer = CodeWriter(buffer, optimize=optimize, compact=compact, source_map=True, intrinsics=intrinsics)
+    translate_file(code_writer, infile, keep)
+    output = code_writer.lines if optimize else buffer.getvalue()
+    return output, list(code_writer.user_labels), code_writer.compact_sites, code_writer.marks
+
+def merge_translation(code_writer, translation):
+    """Append a `translate_to_buffer` result to `code_writer`."""
+    output, user_labels, compact_sites, marks = translation
+    for label in user_labels:
+        assert label not in code_writer.user_labels, f'Label {label} has already been used.'
+        code_writer.user_labels[label] = None
+    code_writer.compact_sites.update(compact_sites)
+    if code_writer.marks is not None:
+        offset = code_writer._position()
+        code_writer.marks.extend([position + offset, *rest] for position, *rest in marks)
+    if code_writer.optimize:
+        code_writer.lines.extend(output)
+    else:
+        code_writer.outfile.write(output)
+        code_writer.n_lines += output.count('\n')
+
+def encode_translation(translation):
+    return json.dumps(list(translation)).encode('utf-8')
+
+def decode_translation(data):
+    output, user_labels, compact_sites, marks = json.loads(data)
+    return output, user_labels, Counter(compact_sites), marks
+
+def translate_all(infiles, optimize=False, compact=False, jobs=1, cache=None, keep=None, intrinsics=()):
+    """Translate every file with `translate_to_buffer`, in input order.
+
+    Files whose contents, name, translator options, kept functions and
+    intrinsics match a cached translation are not translated again.
+    """
+    translations = [None] * len(infiles)
+    keys = [None] * len(infiles)
+    if cache is not None:
+        digest = source_digest(__file__)
+        for i, infile in enumerate(infiles):
+            with open(infile, mode='rb') as f:
+                keys[i] = cache.key(digest, optimize, compact, os.path.basename(infile), f.read(),
+                                    kept_functions(keep, infile), sorted(intrinsics))
+            data = cache.get(keys[i])
+            if data is not None:
+                translations[i] = decode_translation(data)
+        logger.debug('build cache: %d of %d files unchanged', cache.hits, len(infiles))
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+    args = ([infiles[i] for i in missing], repeat(optimize), repeat(compact),
+            [kept_functions(keep, infiles[i]) for i in missing], repeat(intrinsics))
+    if jobs == 1:
+        results = list(map(translate_to_buffer, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+            results = list(pool.map(translate_to_buffer, *args))
+    for i, translation in zip(missing, results):
+        translations[i] = translation
+        if cache is not None:
+            cache.put(keys[i], encode_translation(translation))
+    return translations
+
+# separately assembled objects
+def writer_lines(code_writer):
+    """The assembly written so far by a CodeWriter on an io.StringIO, after the peephole pass under -O."""
+    if code_writer.optimize:
+        return peephole(code_writer.lines)
+    return code_writer.outfile.getvalue().splitlines()
+
+def translate_object(infile, optimize=False, compact=False, keep=None, intrinsics=()):
+    """Translate and assemble `infile` on its own into an object module.
+
+    Its private labels are named for the file, so its object doesn't depend
+    on where it comes in the program.
+    """
+    code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact, intrinsics=intrinsics)
+    translate_file(code_writer, infile, keep)
+    return assemble_object(os.path.basename(infile)[:-len('.vm')], writer_lines(code_writer))
+
+def runtime_objects(modules, optimize=False, compact=False):
+    """Assemble the bootstrap, and the compact mode and intrinsic routines that `modules` use, as objects.
+
+    They go first and last in ROM, where the translator puts them in a
+    single program.
+    """
+    code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact)
+    code_writer.write_init()
+    boot = assemble_object('$boot', writer_lines(code_writer))
+    code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact)
+    imports = set()
+    for module in [boot] + modules:
+        imports.update(module.imports)
+    if compact:
+        code_writer.compact_sites.update({
+            'call': int('$$call' in imports),
+            'return': int('$$return' in imports),
+            'compare': int(any(sym.startswith('$$compare_') for sym in imports))
+        })
+    code_writer.compact_sites.update({name: 1 for name in INTRINSICS if f'$${name}' in imports})
+    code_writer.write_runtime()
+    return boot, assemble_object('$runtime', writer_lines(code_writer))
+
+def build_objects(infiles, optimize=False, compact=False, jobs=1, cache=None, keep=None, intrinsics=()):
+    """Return an object module for every file, reusing cached objects for files that haven't changed.
+
+    An object doesn't depend on the other files of the program, so library
+    classes such as the OS are only ever translated and assembled once.
+    """
+    modules = [None] * len(infiles)
+    keys = [None] * len(infiles)
+    if cache is not None:
+        digests = (source_digest(__file__), source_digest(Assembler.__file__))
+        for i, infile in enumerate(infiles):
+            with open(infile, mode='rb') as f:
+                keys[i] = cache.key(*digests, 'object', optimize, compact, os.path.basename(infile), f.read(),
+                                    kept_functions(keep, infile), sorted(intrinsics))
+            data = cache.get(keys[i])
+            if data is not None:
+                modules[i] = Assembler.ObjectModule.from_bytes(data)
+        logger.debug('build cache: %d of %d objects unchanged', cache.hits, len(infiles))
+    missing = [i for i, module in enumerate(modules) if module is None]
+    args = ([infiles[i] for i in missing], repeat(optimize), repeat(compact),
+            [kept_functions(keep, infiles[i]) for i in missing], repeat(intrinsics))
+    if jobs == 1:
+        results = list(map(translate_object, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+            results = list(pool.map(translate_object, *args))
+    for i, module in zip(missing, results):
+        modules[i] = module
+        if cache is not None:
+            cache.put(keys[i], module.to_bytes())
+    return modules
+
+def link_program(infiles, outfile, optimize=False, compact=False, jobs=1, cache=None, profiler=None, keep=None,
+                 intrinsics=()):
+    """Translate each of `infiles` into an object module and link them into the program `outfile`."""
+    with phase(profiler, 'objects'):
+        modules = build_objects(infiles, optimize, compact, jobs, cache, keep, intrinsics)
+        boot, runtime = runtime_objects(modules, optimize, compact)
+    with phase(profiler, 'link'):
+        words, _ = link_modules([boot] + modules + [runtime])
+    with phase(profiler, 'write'):
+        write_text(outfile, words)
+
+def check_intrinsics(infiles, names):
+    """Return those of the intrinsics `names` that can replace their functions in `infiles`.
+
+    Each routine does just what the tools/OS implementation does, down to
+    the memory it leaves behind, so it is only used where that is the
+    implementation being translated.
+    """
+    defined = {os.path.basename(infile): infile for infile in infiles}
+    usable = set()
+    for name in names:
+        file_name = name.split('.')[0] + '.vm'
+        if file_name not in defined:
+            logger.warning('no %s to take %s from, so it is not replaced', file_name, name)
+            continue
+        with open(defined[file_name], mode='rb') as f, open(os.path.join(OS_DIR, file_name), mode='rb') as os_file:
+            if f.read() != os_file.read():
+                logger.warning('%s is not the tools/OS one, so %s is not replaced', defined[file_name], name)
+                continue
+        usable.add(name)
+    return usable
+
+def main(infiles, optimize=False, compact=False, jobs=1, cache=None, profiler=None, link=False, prune=False,
+         source_map=False, intrinsics=()):
     outfile = get_outfile_name(infiles)
     infiles = check_infiles(infiles)
-    print(f'Translating the following files: ', *infiles, sep='\n\t')
-    print(f'Writing to {outfile}')
-    code_writer = CodeWriter(outfile)
+    logger.info('Translating the following files: \n\t%s', '\n\t'.join(infiles))
+    intrinsics = check_intrinsics(infiles, intrinsics)
+    if cache is not None and (profiler is not None or logger.isEnabledFor(TRACE)):
+        # a cached translation has no commands to trace or time
+        logger.debug('build cache: not used under --trace or profiling')
+        cache = None
+    keep = None
+    if prune:
+        with phase(profiler, 'prune'):
+            graph = call_graph(infiles)
+            reached = reachable_functions(graph)
+        if reached is None:
+            logger.warning('Sys.init is not defined, so no functions are left out')
+        else:
+            warn_undefined(graph, reached)
+            keep = group_by_file(graph, reached)
+            for line in prune_report(graph, reached, optimize, compact):
+                logger.info(line)
+    if link:
+        outfile = os.path.splitext(outfile)[0] + '.hack'
+        logger.info('Linking to %s', outfile)
+        if source_map:
+            logger.warning('no source map is written for a linked program')
+        link_program(infiles, outfile, optimize, compact, jobs, cache, profiler, keep, intrinsics)
+        return
+    logger.info('Writing to %s', outfile)
+    code_writer = CodeWriter(outfile, optimize=optimize, compact=compact, profiler=profiler,
+                             source_map=source_map, intrinsics=intrinsics)
     code_writer.write_init()
-    for i, infile in enumerate(infiles):
-        parser = Parser(infile)
-        code_writer.set_file_name(infile)
-        while parser.has_more_commands():
-            parser.advance()
-            print(parser.current_command)
-            command_ix = f'{i}_{parser.command_counter}'
-            if parser.command_type() in ['C_PUSH', 'C_POP']:
-                code_writer.write_push_pop(parser.current_command)
-            elif parser.command_type() == 'C_ARITHMETIC':
-                code_writer.write_arithmetic(parser.current_command, command_ix)
-            elif parser.command_type() == 'C_LABEL':
-                code_writer.write_label(parser.current_command, command_ix)
-            elif parser.command_type() == 'C_GOTO':
-                code_writer.write_goto(parser.current_command)
-            elif parser.command_type() == 'C_IF':
-                code_writer.write_if_goto(parser.current_command)
-            elif parser.command_type() == 'C_CALL':
-                code_writer.write_call(parser.current_command, command_ix)
-            elif parser.command_type() == 'C_FUNCTION':
-                code_writer.write_function(parser.current_command)
-            elif parser.command_type() == 'C_RETURN':
-                code_writer.write_return()
+    if jobs == 1 and cache is None:
+        for infile in infiles:
+            translate_file(code_writer, infile, kept_functions(keep, infile))
+    else:
+        # worker processes don't report per-command timings
+        with phase(profiler, 'translate'):
+            translations = translate_all(infiles, optimize, compact, jobs, cache, keep, intrinsics)
+        with phase(profiler, 'merge'):
+            for translation in translations:
+                merge_translation(code_writer, translation)
     code_writer.close()
+    if source_map:
+        map_file = get_source_map_name(outfile)
+        code_writer.source_map(os.path.basename(outfile)).write(map_file)
+        logger.info('wrote source map to %s', map_file)
+    if compact:
+        for line in code_writer.size_report():
+            logger.info(line)
+    for name in sorted(intrinsics):
+        logger.info('%s: %d calls replaced by an intrinsic', name, code_writer.compact_sites[name])
 
-if __name__ == '__main__':
+def build_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('infiles', nargs='+', help='File(s) or directory to translate.')
-    args = parser.parse_args()
-    main(args.infiles)
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='Fuse and fold stack operations and run a peephole pass over the output.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Share one call, return and comparison routine instead of inlining them.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Translate files in this many processes; 0 uses every core.')
+    parser.add_argument('--prune', action='store_true',
+                        help='Leave out the functions that Sys.init can never reach, and report the space saved.')
+    parser.add_argument('--link', action='store_true',
+                        help='Assemble each file into an object module and link them into a .hack program.')
+    parser.add_argument('--intrinsic', action='append', choices=sorted(INTRINSICS) + ['all'], default=[],
+                        help='Replace calls to this tools/OS function with a routine written in assembly; '
+                             'may be repeated.')
+    parser.add_argument('--source-map', action='store_true',
+                        help='Also write a .asm.srcmap mapping each line of assembly to its VM command.')
+    add_cache_args(parser)
+    add_profile_args(parser)
+    add_logging_args(parser)
+    return parser
+
+def run(args):
+    """Do what the command line `args`, from `build_arg_parser`, ask for."""
+    profiler = profiler_from_args(args)
+    intrinsics = set(INTRINSICS) if 'all' in args.intrinsic else set(args.intrinsic)
+    main(args.infiles, optimize=args.optimize, compact=args.compact, jobs=args.jobs,
+         cache=cache_from_args(args), profiler=profiler, link=args.link, prune=args.prune,
+         source_map=args.source_map, intrinsics=intrinsics)
+    report_profile(profiler, args)
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    set_log_level(args)
+    run(args)
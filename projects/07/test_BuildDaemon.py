@@ -0,0 +1,116 @@
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import BuildClient
+from BuildClient import server_is_running
+from BuildDaemon import run_job
+from VMtranslator import main
+
+@pytest.fixture(autouse=True)
+def root_logger():
+    # run_job takes over the root logger, as it does in a worker process
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield
+    root.handlers = handlers
+    root.setLevel(level)
+
+def test_assemble_job():
+    response = run_job({'tool': 'assemble', 'text': '@2\nD=A\n(END)\n@END\n0;JMP\n'})
+    assert response['ok']
+    assert response['hack'] == ('0000000000000010\n1110110000010000\n0000000000000010\n1110101010000111\n')
+
+def test_translate_job_matches_the_translator(copy_into):
+    infile, = copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    main([infile])
+    with open(infile) as f:
+        response = run_job({'tool': 'translate', 'files': {'SimpleAdd.vm': f.read()}})
+    with open(infile[:-len('.vm')] + '.asm') as f:
+        assert response['asm'] == f.read()
+
+def test_translate_job_with_functions_and_the_os(copy_into):
+    infiles = copy_into('08/FunctionCalls/FibonacciElement/Main.vm', '08/FunctionCalls/FibonacciElement/Sys.vm')
+    main(infiles)
+    files = {}
+    for infile in infiles:
+        with open(infile) as f:
+            files[os.path.basename(infile)] = f.read()
+    with open(infiles[0][:-len('.vm')] + '.asm') as f:
+        assert run_job({'tool': 'translate', 'files': files})['asm'] == f.read()
+    response = run_job({'tool': 'translate', 'files': files, 'os': True})
+    assert response['ok']
+    assert '(Math.multiply)' in response['asm'].splitlines()
+
+def test_command_line_job(copy_into, tmp_path):
+    copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    cwd = os.getcwd()
+    response = run_job({'tool': 'translate', 'argv': ['-O', 'SimpleAdd.vm'], 'cwd': str(tmp_path)})
+    assert response['ok']
+    assert (tmp_path / 'SimpleAdd.asm').exists()
+    assert 'Writing to SimpleAdd.asm' in response['log']
+    # a failing job leaves the worker where it was too
+    response = run_job({'tool': 'translate', 'argv': ['Missing.vm'], 'cwd': str(tmp_path)})
+    assert not response['ok']
+    assert os.getcwd() == cwd
+
+@pytest.mark.parametrize('job, ok', [
+    ({'tool': 'link', 'text': ''}, False),
+    ({'tool': 'assemble', 'argv': ['--no-such-flag']}, False),
+    ({'tool': 'assemble', 'argv': ['--help']}, True),
+])
+def test_job_errors(job, ok):
+    assert run_job(job)['ok'] == ok
+
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BuildDaemon.py')
+
+def test_server(tmp_path):
+    socket_path = str(tmp_path / 'build.sock')
+    # a socket left by a server that didn't shut down
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert not server_is_running(socket_path)
+    server = subprocess.Popen([sys.executable, DAEMON, '--socket', socket_path, '-j', '2', '-q'],
+                              stderr=subprocess.PIPE, text=True)
+    try:
+        for _ in range(100):
+            if server_is_running(socket_path):
+                break
+            time.sleep(0.05)
+        # a second server leaves the socket to the first
+        second = subprocess.run([sys.executable, DAEMON, '--socket', socket_path, '-q'],
+                                capture_output=True, text=True, timeout=30)
+        assert second.returncode == 1
+        assert 'already serving' in second.stdout
+        client = BuildClient.BuildClient(socket_path)
+        other = BuildClient.BuildClient(socket_path)
+        assert client.assemble('@7\n') == '0000000000000111\n'
+        assert other.translate({'Main.vm': 'push constant 1\n'}).startswith('@256\n')
+        with pytest.raises(RuntimeError, match='Invalid command: push heap 1'):
+            client.translate({'Main.vm': 'push heap 1\n'})
+        assert client.request({'tool': 'status'})['jobs'] == 3
+        # shutting down closes the other connection, which is idle
+        assert client.request({'tool': 'shutdown'}) == {'ok': True}
+        assert server.wait(timeout=10) == 0
+        assert server.stderr.read() == ''
+        assert other.file.readline() == b''
+        client.close()
+        other.close()
+    finally:
+        server.kill()
+        server.stderr.close()
+    assert not os.path.exists(socket_path)
+
+def test_client_runs_the_tool_without_a_server(copy_into, tmp_path, capsys):
+    infile, = copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    socket_path = str(tmp_path / 'none.sock')
+    assert BuildClient.main(['--socket', socket_path, 'translate', '--no-cache', infile]) == 0
+    assert (tmp_path / 'SimpleAdd.asm').exists()
+    assert BuildClient.main(['--socket', socket_path, 'status']) == 1
+    assert 'no build server is running' in capsys.readouterr().err
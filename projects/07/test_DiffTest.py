@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from DiffTest import DiffJob, ProgramGenerator, compare, main, write_program
+from VMtranslator import INTRINSICS, WRITERS, Op
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+@pytest.mark.parametrize('options', [{}, {'optimize': True}, {'compact': True}])
+@pytest.mark.parametrize('program', ['08/FunctionCalls/FibonacciElement', '08/FunctionCalls/StaticsTest'])
+def test_programs_agree(program, options):
+    assert main([os.path.join(PROJECTS_DIR, program)], **options) == 0
+
+def test_random_inputs_agree():
+    program = os.path.join(PROJECTS_DIR, '07/MemoryAccess/BasicTest')
+    assert main([program], seeds=2, randomize=(300, 310), value_range=(-100, 100)) == 0
+
+@pytest.mark.parametrize('options', [{}, {'optimize': True}, {'compact': True}])
+def test_fuzz_agrees(options):
+    assert main([], fuzz=3, **options) == 0
+
+def test_generated_programs_are_deterministic():
+    assert ProgramGenerator(7).files() == ProgramGenerator(7).files()
+
+def test_divergence_is_located(tmp_path, monkeypatch):
+    infiles = write_program(str(tmp_path), {'Sys.vm': 'function Sys.init 0\npush constant 5\nneg\n'
+                                                      'pop static 0\nlabel END\ngoto END\n'})
+    # translate neg as not
+    monkeypatch.setitem(WRITERS, Op.NEG, lambda code_writer, cmd, cmd_number:
+                        code_writer._write(['@SP', 'A=M-1', 'M=!M']))
+    job = DiffJob('neg', infiles, {}, 1000, 10000, False, False)
+    divergence = compare(job, job.reference(), job.hack())
+    assert 'VM=-5 Hack=-6' in divergence
+
+def test_comparison_overflow_is_caught(tmp_path, monkeypatch):
+    infiles = write_program(str(tmp_path), {'Sys.vm': 'function Sys.init 0\npush constant 20000\npush constant 20000\n'
+                                                      'neg\ngt\npop static 0\nlabel END\ngoto END\n'})
+    job = DiffJob('gt', infiles, {}, 1000, 10000, False, False)
+    assert compare(job, job.reference(), job.hack()) is None
+    # translate gt as it was before the signs were compared, so 20000 - -20000 overflows
+    monkeypatch.setitem(WRITERS, Op.GT, lambda code_writer, cmd, cmd_number: code_writer._write([
+        '@SP', 'AM=M-1', 'D=M', 'A=A-1', 'D=M-D', f'@RETURN_TRUE_{cmd_number}', 'D;JGT', '@SP', 'A=M-1', 'M=0',
+        f'@CONTINUE_{cmd_number}', '0;JMP', f'(RETURN_TRUE_{cmd_number})', '@SP', 'A=M-1', 'M=-1',
+        f'(CONTINUE_{cmd_number})']))
+    divergence = compare(job, job.reference(), job.hack())
+    assert 'VM=-1 Hack=0' in divergence
+
+@pytest.mark.parametrize('intrinsic', sorted(INTRINSICS))
+def test_intrinsics_agree(intrinsic):
+    assert main([], intrinsics={intrinsic}, fuzz_intrinsics=2) == 0
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from VMEmulator import VMEmulator
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+def load(program, **options):
+    return VMEmulator.from_paths([os.path.join(PROJECTS_DIR, program)], **options)
+
+@pytest.mark.parametrize('compile', [True, False])
+@pytest.mark.parametrize('program, expected', [
+    ('08/FunctionCalls/FibonacciElement', {0: 262, 261: 3}),
+    ('08/FunctionCalls/StaticsTest', {0: 263, 261: -2, 262: 8}),
+])
+def test_matches_compare_files(program, expected, compile):
+    vm = load(program, compile=compile)
+    vm.run(max_steps=10000)
+    assert {address: vm.ram[address] for address in expected} == expected
+
+def test_compiled_and_interpreted_agree():
+    runs = []
+    for compile in (True, False):
+        vm = load('08/FunctionCalls/FibonacciElement', compile=compile)
+        steps = vm.run()
+        runs.append((steps, vm.halted, vm.calls, list(vm.ram[:vm.ram[0]])))
+    assert runs[0] == runs[1]
+    assert runs[0][1]
+
+def test_toplevel_code_runs_on_the_frame_in_ram():
+    vm = load('07/StackArithmetic/SimpleAdd')
+    vm.ram[0] = 256
+    assert vm.run() == 3
+    assert (vm.ram[0], vm.ram[256]) == (257, 15)
+
+def test_step_limit():
+    vm = load('08/FunctionCalls/FibonacciElement', compile=False)
+    assert vm.run(max_steps=20) == 20
+    assert not vm.halted
+    # compiled code checks the limit at the end of each basic block
+    vm = load('08/FunctionCalls/FibonacciElement')
+    assert 20 <= vm.run(max_steps=20) < 103
+    assert not vm.halted
+
+def test_run_function():
+    vm = load('08/FunctionCalls/FibonacciElement')
+    returned = []
+    vm.on_return = returned.append
+    assert vm.run_function('Main.fibonacci', 10) == 55
+    assert set(returned) == {'Main.fibonacci'}
+    with pytest.raises(NameError, match='Main.missing'):
+        vm.run_function('Main.missing')
+
+def test_statics_are_allocated_in_order_of_reference():
+    vm = load('08/FunctionCalls/StaticsTest')
+    assert vm.statics == {('Class1', 0): 16, ('Class1', 1): 17, ('Class2', 0): 18, ('Class2', 1): 19}
+    assert vm.static_address('Sys', 0) == 20
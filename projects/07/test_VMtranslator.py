@@ -0,0 +1,407 @@
+from glob import glob
+import hashlib
+import io
+import logging
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+import Assembler
+from Assembler import assemble
+from BuildCache import BuildCache
+from CPUEmulator import CPU
+from SourceMap import read_source_map, trace_back
+from VMtranslator import (INTRINSICS, OS_DIR, TRACE, CodeWriter, Op, ParsedFiles, Parser, Segment, build_arg_parser,
+                          call_graph, check_infiles, check_intrinsics, count_instructions, log_level, main,
+                          parse_command, peephole, reachable_functions, run, translate_file, translate_parsed,
+                          undefined_callees)
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# the SHA-256 of what the translator writes for each test program, given its files in sorted order: byte for
+# byte what it wrote before any of its options existed, but for the labels inside functions, which are now
+# scoped to them as function$label, the labels it makes up, which are now named for the file rather than its
+# position, and gt and lt, which now compare the signs before subtracting
+BASELINE_DIGESTS = {
+    '07/MemoryAccess/BasicTest': '92509f8e9d5e094cf6a0a969e0cbc579e0da193fbd70da8172a51288296856a8',
+    '07/MemoryAccess/PointerTest': '8d0acd8fcce309b5215b14f37d6ac79d4756bb726ce5e0152b59fb74bd25db43',
+    '07/MemoryAccess/StaticTest': '0a5687b0bb3605152a9931c46a33e8dcaba77715ec27b1c6110821070b694bb8',
+    '07/StackArithmetic/SimpleAdd': '395894745b0ae17386abd6ff6280427fbb37fa5657f42f4da41f35cc7c7eec5a',
+    '07/StackArithmetic/StackTest': '2542da7775a193dec5e9d28b19324934be0a68eab076bc4ad8bb6125981b3da4',
+    '08/FunctionCalls/FibonacciElement': 'a518610a12bb940bf83c33260cf21a31992fd365027fe070e7921aed8b54aee0',
+    '08/FunctionCalls/NestedCall': '52bf4f7b00fccfe7b2fef9ce0b14e4b77e359c89a1e401609a119f0bd5b9e582',
+    '08/FunctionCalls/SimpleFunction': 'ae96f88a2cfa1b371d140f9bc74b9274f9c5d11063adba76e9d6eb3782a16868',
+    '08/FunctionCalls/StaticsTest': '5abe215e64869c4b02a318aedf0b4571e9d6c8422551ceba41415e8fca5722d0',
+    '08/ProgramFlow/BasicLoop': '26f7cadf2aba5e9bf4ccda5554dde9076c7ee813269153c3ab667a980438d44b',
+    '08/ProgramFlow/FibonacciSeries': '8cbe830a71b809f2c42ab378025c43c9ceb0d298dc998854b1ce5c890585db7c',
+}
+PROGRAMS = sorted(BASELINE_DIGESTS)
+
+def vm_files(program):
+    directory = os.path.join(PROJECTS_DIR, program)
+    return sorted(os.path.join(program, name) for name in os.listdir(directory) if name.endswith('.vm'))
+
+def translate(program, **options):
+    """Translate `program` in memory, with the bootstrap if it has a Sys.init to call and a halt loop if not.
+
+    Without the loop, a program would run on into any routines written after it.
+    """
+    code_writer = CodeWriter(io.StringIO(), **options)
+    paths = [os.path.join(PROJECTS_DIR, path) for path in vm_files(program)]
+    has_sys = any(path.endswith('Sys.vm') for path in paths)
+    if has_sys:
+        code_writer.write_init()
+    for path in paths:
+        translate_file(code_writer, path)
+    if not has_sys:
+        translate_parsed(code_writer, Parser.from_text('label HALT\ngoto HALT\n'), 'Halt.vm')
+    code_writer.finish()
+    return code_writer.outfile.getvalue().splitlines()
+
+def run_test_script(program, lines, slack=10):
+    """Run assembly `lines` as the program's .tst script does, returning what it outputs and what the .cmp expects.
+
+    The script's cycle budget is stretched by `slack`, as translator options can make a program slower.
+    """
+    name = os.path.join(PROJECTS_DIR, program, os.path.basename(program))
+    with open(name + '.tst') as f:
+        script = f.read()
+    with open(name + '.cmp') as f:
+        expected = [int(value) for value in f.read().splitlines()[1].split('|')[1:-1]]
+    cpu = CPU(assemble(lines)[0])
+    for address, value in re.findall(r'set RAM\[(\d+)\] (-?\d+)', script):
+        cpu.ram[int(address)] = int(value)
+    cpu.run(max_cycles=slack * int(re.search(r'repeat (\d+)', script).group(1)))
+    output_list = script[script.index('output-list'):script.index(';', script.index('output-list'))]
+    return [cpu.ram[int(address)] for address in re.findall(r'RAM\[(\d+)\]', output_list)], expected
+
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_matches_baseline(copy_into, program):
+    infiles = copy_into(*vm_files(program))
+    main(infiles)
+    with open(infiles[0][:-len('.vm')] + '.asm', mode='rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == BASELINE_DIGESTS[program]
+
+OPTIONS = [{}, {'optimize': True}, {'compact': True}, {'optimize': True, 'compact': True}]
+
+@pytest.mark.parametrize('options', OPTIONS)
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_test_scripts(program, options):
+    output, expected = run_test_script(program, translate(program, **options))
+    assert output == expected
+
+def test_labels_are_scoped_to_functions():
+    assert '(Main.fibonacci$IF_TRUE)' in translate('08/FunctionCalls/FibonacciElement')
+    # outside any function, labels are left as they are
+    assert '(LOOP_START)' in translate('08/ProgramFlow/BasicLoop')
+
+def push_value(value):
+    if value == -32768:
+        return ['push constant 32767', 'neg', 'push constant 1', 'sub']
+    return [f'push constant {abs(value)}'] + (['neg'] if value < 0 else [])
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_comparisons_dont_overflow(options):
+    values = [-32768, -20000, -1, 0, 1, 20000, 32767]
+    cases = [(x, op, y) for x in values for y in values for op in ('eq', 'gt', 'lt')]
+    lines = ['push constant 3000', 'pop pointer 1']
+    for i, (x, op, y) in enumerate(cases):
+        lines += push_value(x) + push_value(y) + [op, f'pop that {i}']
+    code_writer = CodeWriter(io.StringIO(), **options)
+    translate_parsed(code_writer, Parser.from_text('\n'.join(lines + ['label HALT', 'goto HALT'])), 'Main.vm')
+    code_writer.finish()
+    cpu = CPU(assemble(code_writer.outfile.getvalue().splitlines())[0])
+    cpu.ram[0] = 256
+    cpu.run(max_cycles=100000)
+    compare = {'eq': int.__eq__, 'gt': int.__gt__, 'lt': int.__lt__}
+    assert [cpu.ram[3000 + i] for i in range(len(cases))] == [-compare[op](x, y) for x, op, y in cases]
+
+def test_optimize_shrinks_programs():
+    for program in PROGRAMS:
+        assert len(translate(program, optimize=True)) < len(translate(program))
+
+def test_compact_shrinks_the_os():
+    paths = sorted(glob(os.path.join(OS_DIR, '*.vm')))
+    sizes = {}
+    for compact in (False, True):
+        code_writer = CodeWriter(io.StringIO(), compact=compact)
+        for path in paths:
+            translate_file(code_writer, path)
+        code_writer.finish()
+        sizes[compact] = count_instructions(code_writer.outfile.getvalue().splitlines())
+        if compact:
+            report = code_writer.size_report()
+    assert sizes[True] < sizes[False]
+    assert [line.split(':')[0] for line in report] == ['call', 'return', 'compare']
+
+@pytest.mark.parametrize('text, fields', [
+    ('push local 3', (Op.PUSH, Segment.LOCAL, 3, None)),
+    ('pop that 0', (Op.POP, Segment.THAT, 0, None)),
+    ('call Math.multiply 2', (Op.CALL, None, 2, 'Math.multiply')),
+    ('function Main.main 0', (Op.FUNCTION, None, 0, 'Main.main')),
+    ('if-goto LOOP', (Op.IF_GOTO, None, None, 'LOOP')),
+    ('lt', (Op.LT, None, None, None)),
+])
+def test_parse_command(text, fields):
+    cmd = parse_command(text)
+    assert (cmd.op, cmd.segment, cmd.value, cmd.name) == fields
+    assert cmd.text == text
+
+@pytest.mark.parametrize('text', ['pop constant 1', 'push local', 'push heap 1', 'push local x', 'goto', 'jump END'])
+def test_parse_command_rejects_invalid_commands(text):
+    with pytest.raises(SyntaxError):
+        parse_command(text)
+
+def test_parser():
+    parser = Parser.from_text('// a comment\n\npush constant 7 // seven\n  add\n')
+    assert [(cmd.text, cmd.line) for cmd in parser.commands] == [('push constant 7', 3), ('add', 4)]
+    parser.advance()
+    assert (parser.command_type(), parser.arg1(), parser.arg2()) == ('C_PUSH', 'constant', 7)
+    parser.advance()
+    assert (parser.command_type(), parser.arg1()) == ('C_ARITHMETIC', 'add')
+    assert not parser.has_more_commands()
+
+def read_bytes(path):
+    with open(path, mode='rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_jobs_match_serial(copy_into, options):
+    infiles = copy_into(*sorted(glob(os.path.join(OS_DIR, '*.vm'))))
+    outfile = infiles[0][:-len('.vm')] + '.asm'
+    main(infiles, **options)
+    serial = read_bytes(outfile)
+    main(infiles, jobs=3, **options)
+    assert read_bytes(outfile) == serial
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_cache(copy_into, tmp_path, jobs):
+    infiles = copy_into(*vm_files('08/FunctionCalls/StaticsTest'))
+    outfile = infiles[0][:-len('.vm')] + '.asm'
+    main(infiles)
+    expected = read_bytes(outfile)
+    cache = BuildCache(str(tmp_path / 'cache'))
+    main(infiles, jobs=jobs, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    with open(infiles[1], mode='a') as f:
+        f.write('// changed\n')
+    main(infiles, jobs=jobs, cache=cache)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert read_bytes(outfile) == expected
+    # a file translates the same wherever it comes in the program
+    main(infiles[1:], jobs=jobs, cache=cache)
+    assert (cache.hits, cache.misses) == (4, 4)
+
+def test_directory_files_are_sorted(copy_into):
+    infiles = copy_into(*vm_files('08/FunctionCalls/StaticsTest'))
+    assert check_infiles([os.path.dirname(infiles[0])]) == sorted(infiles)
+
+def test_cache_is_not_used_to_trace(copy_into, tmp_path, caplog):
+    infile, = copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    cache = BuildCache(str(tmp_path / 'cache'))
+    main([infile], cache=cache)
+    with caplog.at_level(TRACE):
+        main([infile], cache=cache)
+    assert cache.hits == 0
+    assert caplog.messages[-3:] == ['push constant 7', 'push constant 8', 'add']
+
+def test_jobs_reject_labels_used_twice(tmp_path):
+    for name in ('A', 'B'):
+        (tmp_path / f'{name}.vm').write_text('label LOOP\ngoto LOOP\n')
+    with pytest.raises(AssertionError, match='LOOP'):
+        main([str(tmp_path / 'A.vm'), str(tmp_path / 'B.vm')], jobs=2)
+
+@pytest.mark.parametrize('lines, optimized', [
+    (['@SP', 'AM=M+1', 'A=A-1', 'M=D', '@SP', 'AM=M-1', 'D=M'], ['@SP', 'A=M', 'M=D']),
+    (['@5', 'M=D', 'D=M', '0;JMP'], ['@5', 'M=D', '0;JMP']),
+    (['@END', '0;JMP', '(END)', '@END', '0;JMP', '(END)'], ['(END)', '(END)']),
+])
+def test_peephole(lines, optimized):
+    assert peephole(lines) == optimized
+
+@pytest.mark.parametrize('argv, level', [
+    ([], logging.INFO),
+    (['-q'], logging.WARNING),
+    (['-v'], logging.DEBUG),
+    (['--trace'], TRACE),
+])
+def test_log_level(argv, level):
+    assert log_level(build_arg_parser().parse_args(argv + ['Main.vm'])) == level
+
+def test_logging(copy_into, caplog):
+    infile, = copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    with caplog.at_level(logging.WARNING):
+        main([infile])
+    assert caplog.messages == []
+    with caplog.at_level(TRACE):
+        main([infile])
+    assert caplog.messages[-3:] == ['push constant 7', 'push constant 8', 'add']
+
+def test_profile(copy_into, capsys):
+    infiles = copy_into(*vm_files('08/FunctionCalls/FibonacciElement'))
+    run(build_arg_parser().parse_args(['--profile', '--no-cache', '-q', os.path.dirname(infiles[0])]))
+    report = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in report if 'commands' in line] == [
+        'C_ARITHMETIC', 'C_CALL', 'C_FUNCTION', 'C_GOTO', 'C_IF', 'C_LABEL', 'C_PUSH', 'C_RETURN']
+
+def linked_and_assembled(infiles, **options):
+    """Translate `infiles` with --link and without, returning both .hack programs as text."""
+    main(infiles, **options)
+    name = infiles[0][:-len('.vm')]
+    with open(name + '.asm') as f:
+        words, _ = assemble(f)
+    main(infiles, link=True, **options)
+    with open(name + '.hack') as f:
+        return f.read(), ''.join(f'{word:016b}\n' for word in words)
+
+@pytest.mark.parametrize('options', OPTIONS)
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_link_matches_assembling(copy_into, program, options):
+    linked, assembled = linked_and_assembled(copy_into(*vm_files(program)), **options)
+    assert linked == assembled
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_link_the_os(copy_into, tmp_path, jobs):
+    infiles = copy_into(*sorted(glob(os.path.join(OS_DIR, '*.vm'))))
+    cache = BuildCache(str(tmp_path / 'cache'))
+    linked, assembled = linked_and_assembled(infiles, compact=True, jobs=jobs, cache=cache)
+    assert linked == assembled
+    assert cache.misses == 2 * len(infiles)
+    # objects don't depend on the rest of the program, so each is reused once built
+    main(infiles[1:], link=True, compact=True, jobs=jobs, cache=cache)
+    assert cache.hits == len(infiles) - 1
+
+PRUNED_PROGRAM = {
+    'Main.vm': 'function Main.main 0\ncall Main.used 0\nreturn\nfunction Main.used 0\npush constant 7\n'
+               'pop static 0\npush constant 0\nreturn\nfunction Main.unused 0\npush static 1\n'
+               'call Missing.f 1\nreturn\n',
+    'Sys.vm': 'function Sys.init 0\ncall Main.main 0\npop temp 0\nlabel HALT\ngoto HALT\n',
+}
+
+def write_files(directory, files):
+    for name, text in files.items():
+        (directory / name).write_text(text)
+    return [str(directory / name) for name in sorted(files)]
+
+def test_call_graph(tmp_path):
+    infiles = write_files(tmp_path, PRUNED_PROGRAM)
+    graph = call_graph(infiles)
+    assert graph['Main.main'] == (infiles[0], {'Main.used'})
+    assert reachable_functions(graph) == {'Sys.init', 'Main.main', 'Main.used'}
+    assert reachable_functions(graph, 'Main.unused') == {'Main.unused'}
+    assert reachable_functions(call_graph(infiles[:1])) is None
+    assert undefined_callees(graph, graph) == {'Missing.f': ['Main.unused']}
+    assert undefined_callees(graph, reachable_functions(graph)) == {}
+
+@pytest.mark.parametrize('link', [False, True])
+def test_prune(tmp_path, caplog, link):
+    infiles = write_files(tmp_path, PRUNED_PROGRAM)
+    name = infiles[0][:-len('.vm')]
+    main(infiles, link=link)
+    full = read_bytes(name + ('.hack' if link else '.asm'))
+    with caplog.at_level(logging.INFO):
+        main(infiles, link=link, prune=True)
+    pruned = read_bytes(name + ('.hack' if link else '.asm'))
+    assert len(pruned) < len(full)
+    assert 'Main.vm: left out 1 of 3 functions, 1 statics and' in caplog.text
+    if not link:
+        assert b'(Main.unused)' in full and b'(Main.unused)' not in pruned
+        cpu = CPU(assemble(pruned.decode().splitlines())[0])
+        cpu.run(max_cycles=1000)
+        assert cpu.ram[16] == 7
+
+def test_prune_warns_of_undefined_functions(tmp_path, caplog):
+    infiles = write_files(tmp_path, PRUNED_PROGRAM)
+    main(infiles, prune=True)
+    # Main.unused calls Missing.f, but is left out
+    assert caplog.messages == []
+    with open(infiles[0], mode='a') as f:
+        f.write('function Main.more 0\ncall Missing.f 0\nreturn\n')
+    with open(infiles[1], mode='a') as f:
+        f.write('function Sys.more 0\ncall Main.more 0\ncall Missing.f 0\nreturn\n')
+    main(infiles, prune=True)
+    assert caplog.messages == []
+    main(infiles)
+    assert caplog.messages == []
+    (tmp_path / 'Sys.vm').write_text(PRUNED_PROGRAM['Sys.vm'].replace('pop temp 0', 'pop temp 0\ncall Sys.more 0')
+                                     + 'function Sys.more 0\ncall Main.more 0\ncall Missing.f 0\nreturn\n')
+    main(infiles, prune=True)
+    assert caplog.messages == ['Missing.f is called by Main.more, Sys.more but is not defined']
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_source_maps_trace_back_to_vm_code(copy_into, options):
+    infiles = copy_into(*vm_files('08/FunctionCalls/FibonacciElement'))
+    main(infiles, source_map=True, **options)
+    name = infiles[0][:-len('.vm')]
+    Assembler.main(name + '.asm', source_map=True)
+    source_maps = [read_source_map(name + '.hack.srcmap'), read_source_map(name + '.asm.srcmap')]
+    with open(name + '.asm') as f:
+        words, sym_table = assemble(f)
+    assert trace_back(source_maps, 0)[-1] == ('', 0, '$bootstrap')
+    # Main.vm:11 is `function Main.fibonacci 0`, which -O writes no code for, and line 12 the command after it
+    _, line, function = trace_back(source_maps, sym_table.get_address('Main.fibonacci'))[-1]
+    assert (line, function) == (12 if options.get('optimize') else 11, 'Main.fibonacci')
+    for address in range(len(words)):
+        chain = trace_back(source_maps, address)
+        assert len(chain) == 2
+        assert chain[-1][0] in ('', 'Main.vm', 'Sys.vm')
+    assert trace_back(source_maps, len(words)) == []
+
+INTRINSIC_PROGRAM = {
+    'Sys.vm': 'function Sys.init 0\ncall Memory.init 0\npop temp 0\ncall Math.init 0\npop temp 0\n'
+              'push constant 181\npush constant 179\nneg\ncall Math.multiply 2\npop static 0\n'
+              'push constant 3000\npush constant 7\ncall Math.divide 2\npop static 1\n'
+              'push constant 20\ncall Memory.alloc 1\npop static 2\n'
+              'push constant 300\ncall Memory.alloc 1\npop static 3\nlabel HALT\ngoto HALT\n',
+}
+
+def run_intrinsic_program(infiles, **options):
+    """Translate and run `infiles` to Sys.init's halt loop, returning the CPU and the results in Sys's statics."""
+    main(infiles, **options)
+    with open(infiles[0][:-len('.vm')] + '.asm') as f:
+        words, sym_table = assemble(f)
+    cpu = CPU(words)
+    cpu.run(max_cycles=100000, until=sym_table.get_address('Sys.init$HALT'))
+    assert cpu.pc == sym_table.get_address('Sys.init$HALT')
+    return cpu, [cpu.ram[sym_table.get_address(f'Sys.{i}')] for i in range(4)]
+
+def test_intrinsics_match_the_os(copy_into, tmp_path, caplog):
+    infiles = sorted(copy_into(*[os.path.join(OS_DIR, name) for name in ('Array.vm', 'Math.vm', 'Memory.vm')])
+                     + write_files(tmp_path, INTRINSIC_PROGRAM))
+    cpu, expected = run_intrinsic_program(infiles)
+    assert expected[:2] == [-32399, 428]
+    for name in sorted(INTRINSICS):
+        with caplog.at_level(logging.INFO):
+            fast, results = run_intrinsic_program(infiles, intrinsics={name})
+        assert results == expected
+        assert fast.cycles < cpu.cycles
+        # the OS calls some of them too, as Math.divide does Math.multiply
+        assert re.fullmatch(f'{name}: [1-9] calls replaced by an intrinsic', caplog.messages[-1])
+    # the heap is left just as the OS leaves it
+    fast, results = run_intrinsic_program(infiles, intrinsics=set(INTRINSICS), compact=True)
+    assert results == expected
+    assert fast.ram[2048:16384] == cpu.ram[2048:16384]
+
+def test_intrinsics_need_the_os_implementation(tmp_path, caplog):
+    infiles = write_files(tmp_path, INTRINSIC_PROGRAM)
+    assert check_intrinsics(infiles, {'Math.multiply'}) == set()
+    assert caplog.messages == ['no Math.vm to take Math.multiply from, so it is not replaced']
+    caplog.clear()
+    (tmp_path / 'Math.vm').write_text('function Math.multiply 0\npush constant 0\nreturn\n')
+    infiles = sorted(infiles + [str(tmp_path / 'Math.vm')])
+    assert check_intrinsics(infiles, {'Math.multiply'}) == set()
+    assert caplog.messages == [f'{tmp_path / "Math.vm"} is not the tools/OS one, so Math.multiply is not replaced']
+
+def test_parsed_files(copy_into):
+    infile, = copy_into('07/StackArithmetic/SimpleAdd/SimpleAdd.vm')
+    parsed_files = ParsedFiles()
+    commands = parsed_files.parse(infile).commands
+    assert parsed_files.parse(infile).commands == commands
+    assert parsed_files.hits == 1
+    with open(infile, mode='a') as f:
+        f.write('neg\n')
+    assert parsed_files.parse(infile).commands[-1].op is Op.NEG
+    assert parsed_files.hits == 1
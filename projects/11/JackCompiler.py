@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import io
+import logging
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '07'))
+from Assembler import ROM_SIZE, assemble, write_text
+from Profiler import add_profile_args, phase, profiler_from_args, report_profile
+from VMtranslator import (INTRINSICS, MNEMONICS, OS_DIR, CodeWriter, Command, Op, Parser, Segment, call_graph,
+                          check_intrinsics, group_by_file, kept_functions, reachable_functions, translate_file,
+                          translate_parsed, warn_undefined, add_logging_args, set_log_level)
+
+logger = logging.getLogger('JackCompiler')
+
+# token kinds, named as in the project 10 XML
+KEYWORD = 'keyword'
+SYMBOL = 'symbol'
+IDENTIFIER = 'identifier'
+INT_CONST = 'integerConstant'
+STRING_CONST = 'stringConstant'
+
+KEYWORDS = {'class', 'constructor', 'function', 'method', 'field', 'static', 'var', 'int', 'char', 'boolean',
+            'void', 'true', 'false', 'null', 'this', 'let', 'do', 'if', 'else', 'while', 'return'}
+# whitespace and comments, integers, strings, words and symbols, in that order of groups
+TOKEN_PATTERN = re.compile(r'(\s+|//[^\n]*|/\*.*?\*/)|(\d+)|"([^"\n]*)"|([A-Za-z_]\w*)|([{}()\[\].,;+\-*/&|<>=~])',
+                           re.DOTALL)
+MAX_INT = 32767
+
+BINARY_OPS = {
+    '+': Op.ADD,
+    '-': Op.SUB,
+    '&': Op.AND,
+    '|': Op.OR,
+    '<': Op.LT,
+    '>': Op.GT,
+    '=': Op.EQ
+}
+# operators the OS implements
+OS_OPS = {'*': 'Math.multiply', '/': 'Math.divide'}
+UNARY_OPS = {'-': Op.NEG, '~': Op.NOT}
+KIND_SEGMENTS = {'static': Segment.STATIC, 'field': Segment.THIS}
+
+def tokenize(text, source='<jack>'):
+    """Split Jack source into a list of `(kind, value, line)` tokens.
+
+    A string constant's value is its text without the quotes, and an
+    integer constant's its int value.
+    """
+    tokens = []
+    line = 1
+    position = 0
+    end = len(text)
+    match = TOKEN_PATTERN.match
+    while position < end:
+        m = match(text, position)
+        if m is None:
+            raise SyntaxError(f'{source}:{line}: unexpected character {text[position]!r}')
+        skipped, integer, string, word, symbol = m.groups()
+        if skipped is not None:
+            line += skipped.count('\n')
+        elif integer is not None:
+            value = int(integer)
+            if value > MAX_INT:
+                raise SyntaxError(f'{source}:{line}: integer constant {value} is too large')
+            tokens.append((INT_CONST, value, line))
+        elif string is not None:
+            tokens.append((STRING_CONST, string, line))
+        elif word is not None:
+            tokens.append((KEYWORD if word in KEYWORDS else IDENTIFIER, word, line))
+        else:
+            tokens.append((SYMBOL, symbol, line))
+        position = m.end()
+    return tokens
+
+class SymbolTable(object):
+    """The variables in scope, as `name -> (segment, index, type)`.
+
+    Statics and fields are in the class scope, and arguments and locals in
+    the subroutine scope, which hides it. Each variable's segment is the one
+    it is kept in: static, this, argument or local.
+    """
+    def __init__(self):
+        self.class_scope = {}
+        self.subroutine_scope = {}
+        self.counts = dict.fromkeys(Segment, 0)
+
+    def start_subroutine(self):
+        self.subroutine_scope = {}
+        self.counts[Segment.ARGUMENT] = 0
+        self.counts[Segment.LOCAL] = 0
+
+    def define(self, name, type_, segment):
+        scope = self.class_scope if segment in (Segment.STATIC, Segment.THIS) else self.subroutine_scope
+        if name in scope:
+            raise NameError(f'{name} is already defined')
+        scope[name] = (segment, self.counts[segment], type_)
+        self.counts[segment] += 1
+
+    def lookup(self, name):
+        """Return `(segment, index, type)` for the variable `name`, or None if it isn't one."""
+        symbol = self.subroutine_scope.get(name)
+        if symbol is None:
+            symbol = self.class_scope.get(name)
+        return symbol
+
+class CompilationEngine(object):
+    """Compiles the tokens of one Jack class into VM Commands.
+
+    The code is what the book's compiler writes, down to the names and
+    numbering of its labels. Each command's `line` is the line of the Jack
+    source it was compiled from.
+    """
+    def __init__(self, tokens, source='<jack>'):
+        self.tokens = tokens
+        self.source = source
+        self.position = 0
+        self.line = 0
+        self.commands = []
+        self.symbols = SymbolTable()
+        self.class_name = None
+        self.if_count = 0
+        self.while_count = 0
+
+    # tokens
+    def error(self, message):
+        return SyntaxError(f'{self.source}:{self.line}: {message}')
+
+    def peek(self, ahead=0):
+        if self.position + ahead >= len(self.tokens):
+            return None, None, self.line
+        return self.tokens[self.position + ahead]
+
+    def advance(self):
+        if self.position >= len(self.tokens):
+            raise self.error('unexpected end of file')
+        token = self.tokens[self.position]
+        self.position += 1
+        self.line = token[2]
+        return token
+
+    def at(self, value):
+        return self.peek()[1] == value and self.peek()[0] in (SYMBOL, KEYWORD)
+
+    def expect(self, value):
+        kind, actual, _ = self.advance()
+        if actual != value or kind not in (SYMBOL, KEYWORD):
+            raise self.error(f'expected {value!r}, not {actual!r}')
+
+    def identifier(self):
+        kind, value, _ = self.advance()
+        if kind != IDENTIFIER:
+            raise self.error(f'expected a name, not {value!r}')
+        return value
+
+    def type_name(self, allow_void=False):
+        kind, value, _ = self.advance()
+        if kind == IDENTIFIER or value in ('int', 'char', 'boolean') or (allow_void and value == 'void'):
+            return value
+        raise self.error(f'expected a type, not {value!r}')
+
+    def variable(self, name):
+        symbol = self.symbols.lookup(name)
+        if symbol is None:
+            raise self.error(f'{name} is not defined')
+        return symbol
+
+    # commands
+    def push(self, segment, index):
+        self.commands.append(Command(Op.PUSH, segment=segment, value=index,
+                                     text=f'push {segment.name.lower()} {index}', line=self.line))
+
+    def pop(self, segment, index):
+        self.commands.append(Command(Op.POP, segment=segment, value=index,
+                                     text=f'pop {segment.name.lower()} {index}', line=self.line))
+
+    def write(self, op):
+        self.commands.append(Command(op, text=MNEMONICS[op], line=self.line))
+
+    def write_label(self, op, label):
+        self.commands.append(Command(op, name=label, text=f'{MNEMONICS[op]} {label}', line=self.line))
+
+    def write_call(self, op, name, n):
+        self.commands.append(Command(op, name=name, value=n, text=f'{MNEMONICS[op]} {name} {n}', line=self.line))
+
+    # program structure
+    def compile_class(self):
+        self.expect('class')
+        self.class_name = self.identifier()
+        self.expect('{')
+        while self.at('static') or self.at('field'):
+            self.compile_class_var_dec()
+        while self.at('constructor') or self.at('function') or self.at('method'):
+            self.compile_subroutine()
+        self.expect('}')
+        if self.position != len(self.tokens):
+            self.advance()
+            raise self.error('expected the end of the file after the class')
+
+    def compile_class_var_dec(self):
+        segment = KIND_SEGMENTS[self.advance()[1]]
+        type_ = self.type_name()
+        self.define(self.identifier(), type_, segment)
+        while self.at(','):
+            self.advance()
+            self.define(self.identifier(), type_, segment)
+        self.expect(';')
+
+    def define(self, name, type_, segment):
+        try:
+            self.symbols.define(name, type_, segment)
+        except NameError as e:
+            raise self.error(str(e)) from None
+
+    def compile_subroutine(self):
+        kind = self.advance()[1]
+        self.type_name(allow_void=True)
+        name = self.identifier()
+        self.symbols.start_subroutine()
+        self.if_count = 0
+        self.while_count = 0
+        if kind == 'method':
+            # argument 0 is the object
+            self.symbols.counts[Segment.ARGUMENT] = 1
+        self.expect('(')
+        self.compile_parameter_list()
+        self.expect(')')
+        self.expect('{')
+        while self.at('var'):
+            self.compile_var_dec()
+        self.write_call(Op.FUNCTION, f'{self.class_name}.{name}', self.symbols.counts[Segment.LOCAL])
+        if kind == 'constructor':
+            self.push(Segment.CONSTANT, self.symbols.counts[Segment.THIS])
+            self.write_call(Op.CALL, 'Memory.alloc', 1)
+            self.pop(Segment.POINTER, 0)
+        elif kind == 'method':
+            self.push(Segment.ARGUMENT, 0)
+            self.pop(Segment.POINTER, 0)
+        self.compile_statements()
+        self.expect('}')
+
+    def compile_parameter_list(self):
+        if self.at(')'):
+            return
+        while True:
+            type_ = self.type_name()
+            self.define(self.identifier(), type_, Segment.ARGUMENT)
+            if not self.at(','):
+                return
+            self.advance()
+
+    def compile_var_dec(self):
+        self.expect('var')
+        type_ = self.type_name()
+        self.define(self.identifier(), type_, Segment.LOCAL)
+        while self.at(','):
+            self.advance()
+            self.define(self.identifier(), type_, Segment.LOCAL)
+        self.expect(';')
+
+    # statements
+    def compile_statements(self):
+        while True:
+            kind, value, _ = self.peek()
+            if kind != KEYWORD:
+                return
+            if value == 'let':
+                self.compile_let()
+            elif value == 'if':
+                self.compile_if()
+            elif value == 'while':
+                self.compile_while()
+            elif value == 'do':
+                self.compile_do()
+            elif value == 'return':
+                self.compile_return()
+            else:
+                return
+
+    def compile_let(self):
+        self.expect('let')
+        segment, index, _ = self.variable(self.identifier())
+        if self.at('['):
+            self.advance()
+            self.compile_expression()
+            self.expect(']')
+            self.push(segment, index)
+            self.write(Op.ADD)
+            self.expect('=')
+            self.compile_expression()
+            self.expect(';')
+            self.pop(Segment.TEMP, 0)
+            self.pop(Segment.POINTER, 1)
+            self.push(Segment.TEMP, 0)
+            self.pop(Segment.THAT, 0)
+            return
+        self.expect('=')
+        self.compile_expression()
+        self.expect(';')
+        self.pop(segment, index)
+
+    def compile_if(self):
+        n = self.if_count
+        self.if_count += 1
+        self.expect('if')
+        self.expect('(')
+        self.compile_expression()
+        self.expect(')')
+        self.write_label(Op.IF_GOTO, f'IF_TRUE{n}')
+        self.write_label(Op.GOTO, f'IF_FALSE{n}')
+        self.write_label(Op.LABEL, f'IF_TRUE{n}')
+        self.expect('{')
+        self.compile_statements()
+        self.expect('}')
+        if not self.at('else'):
+            self.write_label(Op.LABEL, f'IF_FALSE{n}')
+            return
+        self.write_label(Op.GOTO, f'IF_END{n}')
+        self.write_label(Op.LABEL, f'IF_FALSE{n}')
+        self.advance()
+        self.expect('{')
+        self.compile_statements()
+        self.expect('}')
+        self.write_label(Op.LABEL, f'IF_END{n}')
+
+    def compile_while(self):
+        n = self.while_count
+        self.while_count += 1
+        self.expect('while')
+        self.write_label(Op.LABEL, f'WHILE_EXP{n}')
+        self.expect('(')
+        self.compile_expression()
+        self.expect(')')
+        self.write(Op.NOT)
+        self.write_label(Op.IF_GOTO, f'WHILE_END{n}')
+        self.expect('{')
+        self.compile_statements()
+        self.expect('}')
+        self.write_label(Op.GOTO, f'WHILE_EXP{n}')
+        self.write_label(Op.LABEL, f'WHILE_END{n}')
+
+    def compile_do(self):
+        self.expect('do')
+        self.compile_subroutine_call(self.identifier())
+        self.expect(';')
+        # the returned value is thrown away
+        self.pop(Segment.TEMP, 0)
+
+    def compile_return(self):
+        self.expect('return')
+        if self.at(';'):
+            self.push(Segment.CONSTANT, 0)
+        else:
+            self.compile_expression()
+        self.expect(';')
+        self.write(Op.RETURN)
+
+    # expressions, evaluated left to right with no precedence
+    def compile_expression(self):
+        self.compile_term()
+        while True:
+            kind, value, _ = self.peek()
+            if kind != SYMBOL or (value not in BINARY_OPS and value not in OS_OPS):
+                return
+            self.advance()
+            self.compile_term()
+            if value in OS_OPS:
+                self.write_call(Op.CALL, OS_OPS[value], 2)
+            else:
+                self.write(BINARY_OPS[value])
+
+    def compile_term(self):
+        kind, value, _ = self.advance()
+        if kind == INT_CONST:
+            self.push(Segment.CONSTANT, value)
+        elif kind == STRING_CONST:
+            self.push(Segment.CONSTANT, len(value))
+            self.write_call(Op.CALL, 'String.new', 1)
+            for char in value:
+                self.push(Segment.CONSTANT, ord(char))
+                self.write_call(Op.CALL, 'String.appendChar', 2)
+        elif kind == KEYWORD and value in ('true', 'false', 'null'):
+            self.push(Segment.CONSTANT, 0)
+            if value == 'true':
+                self.write(Op.NOT)
+        elif kind == KEYWORD and value == 'this':
+            self.push(Segment.POINTER, 0)
+        elif kind == SYMBOL and value == '(':
+            self.compile_expression()
+            self.expect(')')
+        elif kind == SYMBOL and value in UNARY_OPS:
+            self.compile_term()
+            self.write(UNARY_OPS[value])
+        elif kind == IDENTIFIER:
+            if self.at('['):
+                self.advance()
+                self.compile_expression()
+                self.expect(']')
+                self.push(*self.variable(value)[:2])
+                self.write(Op.ADD)
+                self.pop(Segment.POINTER, 1)
+                self.push(Segment.THAT, 0)
+            elif self.at('(') or self.at('.'):
+                self.compile_subroutine_call(value)
+            else:
+                self.push(*self.variable(value)[:2])
+        else:
+            raise self.error(f'expected a term, not {value!r}')
+
+    def compile_subroutine_call(self, name):
+        """Compile a call to `name`, a method of this class or else the class or object before a `.`."""
+        n_args = 0
+        if self.at('.'):
+            self.advance()
+            subroutine = self.identifier()
+            symbol = self.symbols.lookup(name)
+            if symbol is None:
+                # a function or constructor of the class `name`
+                callee = f'{name}.{subroutine}'
+            else:
+                segment, index, type_ = symbol
+                self.push(segment, index)
+                callee = f'{type_}.{subroutine}'
+                n_args = 1
+        else:
+            self.push(Segment.POINTER, 0)
+            callee = f'{self.class_name}.{name}'
+            n_args = 1
+        self.expect('(')
+        n_args += self.compile_expression_list()
+        self.expect(')')
+        self.write_call(Op.CALL, callee, n_args)
+
+    def compile_expression_list(self):
+        if self.at(')'):
+            return 0
+        n = 1
+        self.compile_expression()
+        while self.at(','):
+            self.advance()
+            self.compile_expression()
+            n += 1
+        return n
+
+def compile_file(infile):
+    """Compile the Jack class in `infile`, returning its name and VM commands."""
+    with open(infile) as f:
+        text = f.read()
+    engine = CompilationEngine(tokenize(text, infile), infile)
+    engine.compile_class()
+    file_name = os.path.splitext(os.path.basename(infile))[0]
+    assert engine.class_name == file_name, f'{infile} defines class {engine.class_name}, not {file_name}.'
+    return engine.class_name, engine.commands
+
+def compile_all(infiles, jobs=1):
+    """Compile every file with `compile_file`, in input order."""
+    if jobs == 1:
+        return list(map(compile_file, infiles))
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        return list(pool.map(compile_file, infiles))
+
+def write_vm(outfile, commands):
+    with open(outfile, mode='w') as f:
+        f.writelines(cmd.text + '\n' for cmd in commands)
+
+def check_infiles(infiles):
+    if len(infiles) > 1:
+        assert all(infile.endswith('.jack') for infile in infiles), 'All infiles must be .jack files.'
+    elif not infiles[0].endswith('.jack'):
+        assert os.path.isdir(infiles[0]), 'Infiles must be a directory or a list of .jack files.'
+        infiles = sorted(glob(os.path.join(infiles[0], '*.jack')))
+    return infiles
+
+def get_outfile_name(infiles):
+    if not infiles[0].endswith('.jack'):
+        return os.path.join(infiles[0], os.path.basename(os.path.normpath(infiles[0])) + '.hack')
+    return infiles[0][:-len('.jack')] + '.hack'
+
+def library_files(infiles, class_names):
+    """The .vm files beside `infiles`, and then those of tools/OS, for the classes they don't compile."""
+    defined = set(class_names)
+    libraries = []
+    directories = sorted({os.path.dirname(infile) for infile in infiles})
+    for directory in directories + [OS_DIR]:
+        for path in sorted(glob(os.path.join(directory, '*.vm'))):
+            name = os.path.basename(path)[:-len('.vm')]
+            if name not in defined:
+                defined.add(name)
+                libraries.append(path)
+    return libraries
+
+def main(infiles, optimize=False, compact=False, jobs=1, profiler=None, prune=False, intrinsics=(),
+         keep_vm=False, keep_asm=False):
+    outfile = get_outfile_name(infiles)
+    infiles = check_infiles(infiles)
+    logger.info('Compiling the following files: \n\t%s', '\n\t'.join(infiles))
+    with phase(profiler, 'compile'):
+        classes = compile_all(infiles, jobs)
+    # each class is translated as the .vm file the book's compiler would write
+    vm_files = [infile[:-len('.jack')] + '.vm' for infile in infiles]
+    if keep_vm:
+        for vm_file, (_, commands) in zip(vm_files, classes):
+            write_vm(vm_file, commands)
+        logger.info('wrote %d .vm files', len(vm_files))
+    libraries = library_files(infiles, [name for name, _ in classes])
+    logger.debug('linking with: \n\t%s', '\n\t'.join(libraries))
+    intrinsics = check_intrinsics(libraries, intrinsics)
+    keep = None
+    if prune:
+        with phase(profiler, 'prune'):
+            parsed = {vm_file: commands for vm_file, (_, commands) in zip(vm_files, classes)}
+            graph = call_graph(vm_files + libraries, parsed)
+            reached = reachable_functions(graph)
+        if reached is None:
+            logger.warning('Sys.init is not defined, so no functions are left out')
+        else:
+            warn_undefined(graph, reached)
+            keep = group_by_file(graph, reached)
+            logger.info('left out %d of %d functions', len(graph) - len(reached), len(graph))
+    code_writer = CodeWriter(io.StringIO(), optimize=optimize, compact=compact, profiler=profiler,
+                             intrinsics=intrinsics)
+    code_writer.write_init()
+    for infile, vm_file, (_, commands) in zip(infiles, vm_files, classes):
+        translate_parsed(code_writer, Parser.from_commands(commands), vm_file, kept_functions(keep, vm_file),
+                         source_name=os.path.basename(infile))
+    for library in libraries:
+        translate_file(code_writer, library, kept_functions(keep, library))
+    code_writer.finish()
+    lines = code_writer.outfile.getvalue().splitlines()
+    if keep_asm:
+        asm_file = outfile[:-len('.hack')] + '.asm'
+        with open(asm_file, mode='w') as f:
+            f.write(code_writer.outfile.getvalue())
+        logger.info('wrote the assembly to %s', asm_file)
+    with phase(profiler, 'assemble'):
+        words, _ = assemble(lines)
+    if len(words) > ROM_SIZE:
+        logger.warning('the program is %d words, more than the %d that fit in ROM; try -O, --compact or --prune',
+                       len(words), ROM_SIZE)
+    with phase(profiler, 'write'):
+        write_text(outfile, words)
+    logger.info('wrote %d words to %s', len(words), outfile)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Compile Jack classes and the VM code they use into a Hack program.')
+    arg_parser.add_argument('infiles', nargs='+', help='File(s) or directory to compile.')
+    arg_parser.add_argument('-O', '--optimize', action='store_true', help='Translate with VMtranslator.py -O.')
+    arg_parser.add_argument('--compact', action='store_true', help='Translate with VMtranslator.py --compact.')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Compile classes in this many processes; 0 uses every core.')
+    arg_parser.add_argument('--prune', action='store_true',
+                            help='Leave out the functions that Sys.init can never reach.')
+    arg_parser.add_argument('--intrinsic', action='append', choices=sorted(INTRINSICS) + ['all'], default=[],
+                            help='Translate with VMtranslator.py --intrinsic; may be repeated.')
+    arg_parser.add_argument('--vm', action='store_true', help='Also write each class\'s .vm file.')
+    arg_parser.add_argument('--asm', action='store_true', help='Also write the program\'s .asm file.')
+    add_profile_args(arg_parser)
+    add_logging_args(arg_parser)
+    args = arg_parser.parse_args()
+    set_log_level(args)
+    profiler = profiler_from_args(args)
+    intrinsics = set(INTRINSICS) if 'all' in args.intrinsic else set(args.intrinsic)
+    main(args.infiles, optimize=args.optimize, compact=args.compact, jobs=args.jobs, profiler=profiler,
+         prune=args.prune, intrinsics=intrinsics, keep_vm=args.vm, keep_asm=args.asm)
+    report_profile(profiler, args)
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from JackCompiler import INTRINSICS, IDENTIFIER, INT_CONST, KEYWORD, STRING_CONST, SYMBOL, main, tokenize
+from Assembler import assemble, load_rom
+from CPUEmulator import CPU
+from VMEmulator import VMEmulator
+
+def test_tokenize():
+    tokens = tokenize('let x = "a // b";\n/* a\ncomment */ do Output.printInt(32767); // done\n')
+    assert tokens == [(KEYWORD, 'let', 1), (IDENTIFIER, 'x', 1), (SYMBOL, '=', 1), (STRING_CONST, 'a // b', 1),
+                      (SYMBOL, ';', 1), (KEYWORD, 'do', 3), (IDENTIFIER, 'Output', 3), (SYMBOL, '.', 3),
+                      (IDENTIFIER, 'printInt', 3), (SYMBOL, '(', 3), (INT_CONST, 32767, 3), (SYMBOL, ')', 3),
+                      (SYMBOL, ';', 3)]
+
+@pytest.mark.parametrize('text, message', [('let x = 32768;', 'Main.jack:1: integer constant 32768 is too large'),
+                                           ('\nlet x = #;', "Main.jack:2: unexpected character '#'")])
+def test_tokenize_rejects_invalid_source(text, message):
+    with pytest.raises(SyntaxError, match=message):
+        tokenize(text, 'Main.jack')
+
+@pytest.mark.parametrize('options', [
+    {'prune': True, 'intrinsics': set(INTRINSICS)},
+    {'optimize': True, 'compact': True, 'prune': True},
+    {'optimize': True, 'compact': True, 'prune': True, 'intrinsics': set(INTRINSICS)},
+])
+def test_convert_to_bin(copy_into, options):
+    infile, = copy_into('11/ConvertToBin/Main.jack')
+    main([infile], keep_asm=True, **options)
+    with open(infile[:-len('.jack')] + '.asm') as f:
+        words, sym_table = assemble(f)
+    assert load_rom(infile[:-len('.jack')] + '.hack') == words
+    cpu = CPU(words)
+    # the OS initializes the heap, so the input is only set once it is done
+    cpu.run(max_cycles=10000000, until=sym_table.get_address('Main.main'))
+    cpu.ram[8000] = -11
+    cpu.run(max_cycles=100000, until=sym_table.get_address('Sys.halt'))
+    assert cpu.pc == sym_table.get_address('Sys.halt')
+    assert cpu.ram[8001:8017].tolist() == [1, 0, 1, 0] + [1] * 12
+
+def test_vm_files_run_on_the_vm_emulator(copy_into):
+    infile, = copy_into('11/ConvertToBin/Main.jack')
+    main([infile], keep_vm=True, prune=True)
+    vm = VMEmulator.from_paths([infile[:-len('.jack')] + '.vm'], with_os=True)
+    # Main.nextMask multiplies, which needs the OS's Math class set up
+    vm.run_function('Memory.init')
+    vm.run_function('Math.init')
+    vm.run_function('Main.convert', 6)
+    assert vm.ram[8001:8017].tolist() == [0, 1, 1] + [0] * 13
+    assert vm.run_function('Main.nextMask', 0) == 1
+    assert vm.run_function('Main.nextMask', 16384) == -32768
+
+def test_programs_too_big_for_rom_are_warned_about(copy_into, caplog):
+    infile, = copy_into('11/ConvertToBin/Main.jack')
+    main([infile])
+    assert any(message.startswith('the program is') and message.endswith('try -O, --compact or --prune')
+               for message in caplog.messages)
+
+def test_jobs_match_serial(copy_into, tmp_path):
+    infiles = copy_into(*[os.path.join('11/Pong', name) for name in ('Ball.jack', 'Bat.jack', 'Main.jack',
+                                                                     'PongGame.jack')])
+    outfile = infiles[0][:-len('.jack')] + '.hack'
+    main(infiles, optimize=True, prune=True)
+    serial = load_rom(outfile)
+    main(infiles, optimize=True, prune=True, jobs=2)
+    assert load_rom(outfile) == serial
+
+def test_class_names_match_file_names(tmp_path):
+    (tmp_path / 'Main.jack').write_text('class Other { function void main() { return; } }\n')
+    with pytest.raises(AssertionError, match='defines class Other, not Main'):
+        main([str(tmp_path / 'Main.jack')])
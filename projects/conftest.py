@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import pytest
+
+PROJECTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def copy_into(tmp_path):
+    """Copy files, given relative to projects/, into `tmp_path`, so the tools write their outputs there.
+
+    Returns the paths of the copies in the order given.
+    """
+    def copy(*paths):
+        return [shutil.copy(os.path.join(PROJECTS_DIR, path), tmp_path) for path in paths]
+    return copy
+
+@pytest.fixture
+def project(tmp_path):
+    """Copy a project directory, given relative to projects/, into `tmp_path`, so the scripts write
+    their .out files there.
+    """
+    def copy(name):
+        directory = str(tmp_path / name.replace('/', '_'))
+        shutil.copytree(os.path.join(PROJECTS_DIR, name), directory)
+        return directory
+    return copy